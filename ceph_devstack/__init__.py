@@ -1,22 +1,29 @@
 import argparse
-import logging.config
-import tomlkit
-import tomlkit.items
-import tomlkit.exceptions
+import logging
 
 from pathlib import Path
-from typing import List, Optional, Union
+from typing import List, Optional, Union, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import tomlkit.items
 
 
 VERBOSE = 15
 logging.addLevelName(15, "VERBOSE")
-logging.config.fileConfig(Path(__file__).parent / "logging.conf")
 logger = logging.getLogger("ceph-devstack")
 
 PROJECT_ROOT = Path(__file__).parent
 DEFAULT_CONFIG_PATH = Path("~/.config/ceph-devstack/config.toml")
 
 
+def setup_logging():
+    # Called by the CLI rather than at import, so that merely importing the
+    # package doesn't configure handlers or open the log file
+    import logging.config
+
+    logging.config.fileConfig(PROJECT_ROOT / "logging.conf")
+
+
 def parse_args(args: List[str]) -> argparse.Namespace:
     parser = argparse.ArgumentParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter
@@ -41,6 +48,20 @@ def parse_args(args: List[str]) -> argparse.Namespace:
         default=DEFAULT_CONFIG_PATH,
         help="Path to the ceph-devstack config file",
     )
+    parser.add_argument(
+        "--cluster",
+        type=str,
+        default=None,
+        help="Operate on the named cluster. Each cluster has its own containers, "
+        "ports, loop devices and data directory, so several can share a host",
+    )
+    parser.add_argument(
+        "--trace",
+        type=Path,
+        default=None,
+        help="Write a trace of the commands and actions run to this file, in "
+        "Chrome's trace event format (viewable with e.g. ui.perfetto.dev)",
+    )
     subparsers = parser.add_subparsers(dest="command")
     parser_config = subparsers.add_parser("config", help="Get or set config items")
     subparsers_config = parser_config.add_subparsers(dest="config_op")
@@ -71,6 +92,13 @@ def parse_args(args: List[str]) -> argparse.Namespace:
         nargs="*",
         help="Specific image(s) to build",
     )
+    parser_build.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        default=False,
+        help="Build even if the image is up to date with its repo",
+    )
     parser_create = subparsers.add_parser(
         "create",
         help="Create the cluster",
@@ -104,6 +132,88 @@ def parse_args(args: List[str]) -> argparse.Namespace:
         "container",
         help="The container to wait for",
     )
+    parser_status = subparsers.add_parser(
+        "status", help="Show the state of the cluster and the latest run"
+    )
+    parser_status.add_argument(
+        "-w",
+        "--watch",
+        action="store_true",
+        default=False,
+        help="Keep refreshing the status",
+    )
+    parser_status.add_argument(
+        "-i",
+        "--interval",
+        type=float,
+        default=5,
+        help="Seconds between refreshes, with --watch",
+    )
+    parser_runs = subparsers.add_parser("runs", help="Query archived test runs")
+    subparsers_runs = parser_runs.add_subparsers(dest="runs_op", required=True)
+    parser_runs_list = subparsers_runs.add_parser(
+        "list", help="List runs, most recent first"
+    )
+    parser_runs_list.add_argument(
+        "-n",
+        "--limit",
+        type=int,
+        default=20,
+        help="Show at most this many runs",
+    )
+    parser_runs_show = subparsers_runs.add_parser(
+        "show", help="Show a run and its jobs"
+    )
+    parser_runs_show.add_argument(
+        "run_name",
+        nargs="?",
+        default=None,
+        help="The run to show (default: the most recent)",
+    )
+    parser_archive = subparsers.add_parser("archive", help="Manage the test archive")
+    subparsers_archive = parser_archive.add_subparsers(dest="archive_op", required=True)
+    parser_archive_compact = subparsers_archive.add_parser(
+        "compact", help="Compress the logs of old, finished runs"
+    )
+    parser_archive_compact.add_argument(
+        "--older-than",
+        type=str,
+        default="7d",
+        help="Only compress runs older than this, e.g. 12h, 7d or 2w",
+    )
+    parser_archive_compact.add_argument(
+        "--format",
+        choices=["gz", "zst"],
+        default="gz",
+        help="Compression format; zst requires the zstandard package",
+    )
+    parser_archive_compact.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="Number of logs to compress in parallel (default: one per CPU)",
+    )
+    parser_metrics = subparsers.add_parser(
+        "metrics", help="Export metrics about the cluster"
+    )
+    subparsers_metrics = parser_metrics.add_subparsers(dest="metrics_op", required=True)
+    parser_metrics_serve = subparsers_metrics.add_parser(
+        "serve", help="Serve metrics for Prometheus to scrape"
+    )
+    parser_metrics_serve.add_argument(
+        "--bind",
+        type=str,
+        default="0.0.0.0",
+        help="Address to listen on",
+    )
+    parser_metrics_serve.add_argument(
+        "-p",
+        "--port",
+        type=int,
+        default=None,
+        help="Port to listen on (default: metrics.port from the config)",
+    )
     parser_log = subparsers.add_parser("logs", help="Dump teuthology logs")
     parser_log.add_argument("-r", "--run-name", type=str, default=None)
     parser_log.add_argument("-j", "--job-id", type=str, default=None)
@@ -112,6 +222,20 @@ def parse_args(args: List[str]) -> argparse.Namespace:
         action=argparse.BooleanOptionalAction,
         help="Display log file path instead of contents",
     )
+    parser_log.add_argument(
+        "-n",
+        "--tail",
+        type=int,
+        default=None,
+        help="Only display the last N lines",
+    )
+    parser_log.add_argument(
+        "-f",
+        "--follow",
+        action="store_true",
+        default=False,
+        help="Keep displaying data as it is appended to the log",
+    )
     return parser.parse_args(args)
 
 
@@ -129,24 +253,32 @@ class Config(dict):
     __slots__ = ["user_obj", "user_path"]
 
     def load(self, config_path: Optional[Path] = None):
-        parsed = tomlkit.parse((Path(__file__).parent / "config.toml").read_text())
-        self.update(parsed)
+        import tomlkit
+
+        # The defaults only need parsing once
+        if not self:
+            parsed = tomlkit.parse((PROJECT_ROOT / "config.toml").read_text())
+            self.update(parsed)
         if config_path:
             self.user_path = config_path.expanduser()
             if self.user_path.exists():
                 self.user_obj: dict = tomlkit.parse(self.user_path.read_text()) or {}
-                self.update(deep_merge(config, self.user_obj))
+                self.update(deep_merge(self, self.user_obj))
             elif self.user_path != DEFAULT_CONFIG_PATH.expanduser():
                 raise OSError(f"Config file at {self.user_path} not found!")
             else:
                 self.user_obj = {}
 
     def dump(self):
+        import tomlkit
+
         return tomlkit.dumps(self)
 
     def get_value(self, name: str) -> str:
+        import tomlkit
+
         path = name.split(".")
-        obj = config
+        obj = self
         i = 0
         while i < len(path):
             sub_path = path[i]
@@ -161,11 +293,14 @@ class Config(dict):
         return tomlkit.dumps(obj).strip()
 
     def set_value(self, name: str, value: str):
+        import tomlkit
+        import tomlkit.exceptions
+
         path = name.split(".")
         obj = self.user_obj
         i = 0
         last_index = len(path) - 1
-        item: Union[tomlkit.items.Item, str] = value
+        item: Union["tomlkit.items.Item", str] = value
         try:
             item = tomlkit.value(item)
         except tomlkit.exceptions.UnexpectedCharError:
@@ -183,5 +318,12 @@ class Config(dict):
             i += 1
 
 
-config = Config()
-config.load()
+def __getattr__(name: str):
+    # The config is loaded on first use, rather than whenever anything in the
+    # package is imported
+    if name == "config":
+        global config
+        config = Config()
+        config.load()
+        return config
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
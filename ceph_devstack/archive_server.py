@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+# Serves the teuthology archive over HTTP, for the Archive container:
+#
+#   python3 archive_server.py [--port 8000] [--directory /archive]
+#
+# Unlike `python3 -m http.server`, requests are handled concurrently, files
+# are sent with sendfile(), byte ranges are supported, logs compressed by
+# `ceph-devstack archive compact` are served with a Content-Encoding so
+# browsers decompress them, and directory listings are cached until the
+# directory changes.
+#
+# This runs inside the Archive container rather than in ceph-devstack's
+# environment, so it must only use the standard library.
+import argparse
+import asyncio
+import collections
+import contextlib
+import email.utils
+import gzip
+import html
+import mimetypes
+import os
+import sys
+import urllib.parse
+
+from typing import Dict, List, Optional, Tuple
+
+MAX_HEADER_BYTES = 64 * 1024
+CHUNK_SIZE = 256 * 1024
+LISTING_CACHE_SIZE = 256
+# Compressed variants of a missing file, and the encodings they're served as
+ENCODINGS = [(".gz", "gzip"), (".zst", "zstd")]
+# What `archive compact` compresses; other compressed files are teuthology's
+# own (e.g. remote/*/log/*.log.gz), and are listed as they are
+COMPACTED_NAME = "teuthology.log"
+TEXT_SUFFIXES = [".log", ".yaml", ".yml", ".txt", ".conf"]
+REASONS = {
+    200: "OK",
+    206: "Partial Content",
+    301: "Moved Permanently",
+    304: "Not Modified",
+    400: "Bad Request",
+    403: "Forbidden",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    406: "Not Acceptable",
+    416: "Range Not Satisfiable",
+}
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, headers: Optional[Dict[str, str]] = None):
+        self.status = status
+        self.headers = headers or {}
+        super().__init__(status)
+
+
+def content_type(path: str) -> str:
+    if any(path.endswith(suffix) for suffix in TEXT_SUFFIXES):
+        return "text/plain; charset=utf-8"
+    return mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+
+def parse_range(value: str, size: int) -> Tuple[int, int]:
+    # Returns (start, end) with end exclusive. Only single ranges are
+    # supported; for anything else, the whole file is sent.
+    unit, _, spec = value.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return 0, size
+    first, _, last = spec.strip().partition("-")
+    try:
+        if not first:
+            start, end = max(size - int(last), 0), size
+        else:
+            start = int(first)
+            end = min(int(last) + 1, size) if last else size
+    except ValueError:
+        return 0, size
+    if start >= size or start >= end:
+        raise HTTPError(416, {"Content-Range": f"bytes */{size}"})
+    return start, end
+
+
+def accepts(headers: Dict[str, str], encoding: str) -> bool:
+    accepted = headers.get("accept-encoding", "")
+    return encoding in [part.split(";")[0].strip() for part in accepted.split(",")]
+
+
+class ArchiveServer:
+    def __init__(self, root: str):
+        self.root = os.path.realpath(root)
+        self.listings: "collections.OrderedDict[str, Tuple[int, bytes]]" = (
+            collections.OrderedDict()
+        )
+
+    def resolve(self, url_path: str) -> str:
+        path = urllib.parse.unquote(url_path)
+        full = os.path.realpath(os.path.join(self.root, path.lstrip("/")))
+        if os.path.commonpath([full, self.root]) != self.root:
+            raise HTTPError(403)
+        return full
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while await self.handle_request(reader, writer):
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def read_request(self, reader: asyncio.StreamReader):
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.LimitOverrunError:
+            raise HTTPError(400) from None
+        lines = head.decode("latin-1").split("\r\n")
+        parts = lines[0].split()
+        if len(parts) != 3:
+            raise HTTPError(400)
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                key, _, value = line.partition(":")
+                headers[key.strip().lower()] = value.strip()
+        return parts[0], parts[1], parts[2], headers
+
+    async def handle_request(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> bool:
+        try:
+            method, target, version, headers = await self.read_request(reader)
+        except asyncio.IncompleteReadError:
+            return False
+        except HTTPError as e:
+            await self.send_error(writer, e, keep_alive=False)
+            return False
+        keep_alive = version == "HTTP/1.1" and (
+            headers.get("connection", "").lower() != "close"
+        )
+        try:
+            if method not in ("GET", "HEAD"):
+                raise HTTPError(405, {"Allow": "GET, HEAD"})
+            url_path = urllib.parse.urlsplit(target).path
+            path = self.resolve(url_path)
+            if os.path.isdir(path):
+                if not url_path.endswith("/"):
+                    raise HTTPError(301, {"Location": url_path + "/"})
+                index = os.path.join(path, "index.html")
+                if os.path.isfile(index):
+                    return await self.send_file(
+                        writer, method, index, headers, keep_alive
+                    )
+                return await self.send_listing(
+                    writer, method, path, url_path, keep_alive
+                )
+            return await self.send_file(writer, method, path, headers, keep_alive)
+        except HTTPError as e:
+            # Other methods may have sent a body, which we haven't read
+            keep_alive = keep_alive and method in ("GET", "HEAD")
+            await self.send_error(writer, e, keep_alive, method)
+            return keep_alive
+
+    async def send_head(
+        self,
+        writer: asyncio.StreamWriter,
+        status: int,
+        headers: Dict[str, str],
+        keep_alive: bool,
+    ):
+        lines = [f"HTTP/1.1 {status} {REASONS.get(status, '')}"]
+        headers = {
+            "Server": "ceph-devstack-archive",
+            "Date": email.utils.formatdate(usegmt=True),
+            "Connection": "keep-alive" if keep_alive else "close",
+            **headers,
+        }
+        lines += [f"{key}: {value}" for key, value in headers.items()]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        await writer.drain()
+
+    async def send_error(
+        self,
+        writer: asyncio.StreamWriter,
+        error: HTTPError,
+        keep_alive: bool,
+        method: str = "GET",
+    ):
+        body = f"{error.status} {REASONS.get(error.status, '')}\n".encode()
+        await self.send_head(
+            writer,
+            error.status,
+            {
+                "Content-Type": "text/plain",
+                "Content-Length": str(len(body)),
+                **error.headers,
+            },
+            keep_alive,
+        )
+        if method != "HEAD":
+            writer.write(body)
+            await writer.drain()
+
+    def find_encoded(self, path: str, headers: Dict[str, str]):
+        # Logs may have been compressed after pulpito linked to them
+        for suffix, encoding in ENCODINGS:
+            if os.path.isfile(path + suffix):
+                if accepts(headers, encoding):
+                    return path + suffix, encoding
+                if encoding == "gzip":
+                    return path + suffix, None
+                raise HTTPError(406)
+        raise HTTPError(404)
+
+    async def send_file(
+        self,
+        writer: asyncio.StreamWriter,
+        method: str,
+        path: str,
+        headers: Dict[str, str],
+        keep_alive: bool,
+    ) -> bool:
+        encoding: Optional[str] = ""
+        served = path
+        if not os.path.isfile(path):
+            served, encoding = self.find_encoded(path, headers)
+        if encoding is None:
+            # The client can't decompress; do it for them
+            return await self.send_decompressed(writer, method, served, path)
+        st = os.stat(served)
+        last_modified = email.utils.formatdate(st.st_mtime, usegmt=True)
+        response_headers = {
+            "Content-Type": content_type(path),
+            "Last-Modified": last_modified,
+            "Accept-Ranges": "bytes",
+        }
+        if encoding:
+            response_headers["Content-Encoding"] = encoding
+            response_headers["Vary"] = "Accept-Encoding"
+        if_modified_since = headers.get("if-modified-since")
+        if if_modified_since == last_modified:
+            await self.send_head(writer, 304, response_headers, keep_alive)
+            return keep_alive
+        status, start, end = 200, 0, st.st_size
+        if "range" in headers:
+            try:
+                start, end = parse_range(headers["range"], st.st_size)
+            except HTTPError as e:
+                e.headers.update(response_headers)
+                raise
+            if (start, end) != (0, st.st_size):
+                status = 206
+                response_headers["Content-Range"] = (
+                    f"bytes {start}-{end - 1}/{st.st_size}"
+                )
+        response_headers["Content-Length"] = str(end - start)
+        await self.send_head(writer, status, response_headers, keep_alive)
+        if method == "GET" and end > start:
+            with open(served, "rb") as f:
+                loop = asyncio.get_running_loop()
+                await loop.sendfile(writer.transport, f, start, end - start)
+        return keep_alive
+
+    async def send_decompressed(
+        self, writer: asyncio.StreamWriter, method: str, served: str, path: str
+    ) -> bool:
+        # The decompressed length isn't known up front, so the end of the
+        # body is marked by closing the connection
+        await self.send_head(writer, 200, {"Content-Type": content_type(path)}, False)
+        if method == "GET":
+            loop = asyncio.get_running_loop()
+            with gzip.open(served, "rb") as f:
+                while chunk := await loop.run_in_executor(None, f.read, CHUNK_SIZE):
+                    writer.write(chunk)
+                    await writer.drain()
+        return False
+
+    def render_listing(self, path: str, url_path: str) -> bytes:
+        entries: List[str] = []
+        with os.scandir(path) as it:
+            names = sorted(e.name + ("/" if e.is_dir() else "") for e in it)
+        # Link compacted logs by their original names, which is what pulpito
+        # links to, unless the original is still there
+        compacted = {COMPACTED_NAME + suffix for suffix, _ in ENCODINGS}
+        linked = set()
+        for name in names:
+            if name in compacted and COMPACTED_NAME not in names:
+                name = COMPACTED_NAME
+            if name in linked:
+                continue
+            linked.add(name)
+            href = urllib.parse.quote(name)
+            entries.append(f'<li><a href="{href}">{html.escape(name)}</a></li>')
+        title = html.escape(urllib.parse.unquote(url_path))
+        return (
+            "<!DOCTYPE HTML>\n<html>\n<head>\n"
+            '<meta charset="utf-8">\n'
+            f"<title>Directory listing for {title}</title>\n</head>\n<body>\n"
+            f"<h1>Directory listing for {title}</h1>\n<hr>\n<ul>\n"
+            + "\n".join(entries)
+            + "\n</ul>\n<hr>\n</body>\n</html>\n"
+        ).encode()
+
+    async def listing(self, path: str, url_path: str) -> bytes:
+        # Adding or removing an entry changes a directory's mtime, so a
+        # listing is good for as long as that stays the same
+        mtime = os.stat(path).st_mtime_ns
+        cached = self.listings.get(path)
+        if cached and cached[0] == mtime:
+            self.listings.move_to_end(path)
+            return cached[1]
+        loop = asyncio.get_running_loop()
+        body = await loop.run_in_executor(None, self.render_listing, path, url_path)
+        self.listings[path] = (mtime, body)
+        while len(self.listings) > LISTING_CACHE_SIZE:
+            self.listings.popitem(last=False)
+        return body
+
+    async def send_listing(
+        self,
+        writer: asyncio.StreamWriter,
+        method: str,
+        path: str,
+        url_path: str,
+        keep_alive: bool,
+    ) -> bool:
+        body = await self.listing(path, url_path)
+        await self.send_head(
+            writer,
+            200,
+            {
+                "Content-Type": "text/html; charset=utf-8",
+                "Content-Length": str(len(body)),
+            },
+            keep_alive,
+        )
+        if method == "GET":
+            writer.write(body)
+            await writer.drain()
+        return keep_alive
+
+
+async def serve(root: str, host: str, port: int):
+    archive_server = ArchiveServer(root)
+    server = await asyncio.start_server(
+        archive_server.handle, host, port, limit=MAX_HEADER_BYTES
+    )
+    print(f"Serving {root} on {host}:{port}", file=sys.stderr, flush=True)
+    async with server:
+        await server.serve_forever()
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bind", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--directory", default=".")
+    args = parser.parse_args(argv)
+    with contextlib.suppress(KeyboardInterrupt):
+        asyncio.run(serve(args.directory, args.bind, args.port))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
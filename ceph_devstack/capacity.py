@@ -0,0 +1,193 @@
+import os
+
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from ceph_devstack import logger
+from ceph_devstack.cluster import LOOP_DEVICE_STRIDE
+from ceph_devstack.jsonfile import locked_json
+from ceph_devstack.loop_helper import parse_size
+
+MEMINFO_PATH = Path("/proc/meminfo")
+GiB = 2**30
+# Where an automatically chosen loop device size is kept, in the data dir
+CAPACITY_FILE = "capacity.json"
+
+
+def loop_img_dir(data_dir) -> Path:
+    return (Path(data_dir) / "disk_images").expanduser()
+
+
+def memory_total(path: Path = MEMINFO_PATH) -> Optional[int]:
+    try:
+        with open(path) as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def cpu_count() -> int:
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def disk_free(path: Path) -> int:
+    # The directory may not exist yet; its nearest existing parent is on the
+    # filesystem it will be created on
+    path = Path(path).expanduser()
+    while not path.exists() and path != path.parent:
+        path = path.parent
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+def format_size(size: float) -> str:
+    return f"{size / GiB:.1f} GiB"
+
+
+class CapacityPlan:
+    # How many testnodes to run, and how large to make their loop devices,
+    # given the host's CPUs, memory and free disk. Settings other than "auto"
+    # are taken as they are. Free disk shrinks as the images fill, so an
+    # automatic size, once chosen, is passed back in as saved_size.
+    def __init__(
+        self,
+        testnode_config: Dict,
+        cpus: int,
+        memory: Optional[int],
+        disk: int,
+        saved_size: Optional[int] = None,
+    ):
+        self.cpus = cpus
+        self.memory = memory
+        self.disk = disk
+        self.saved_size = saved_size
+        self.notes: List[str] = []
+        self.loop_device_count = testnode_config.get("loop_device_count", 1)
+        self.count = self._plan_count(testnode_config)
+        self.loop_device_size = self._plan_loop_device_size(testnode_config)
+
+    def _plan_count(self, testnode_config: Dict) -> int:
+        count = testnode_config.get("count", 1)
+        if count != "auto":
+            return int(count)
+        cpus_per = testnode_config.get("cpus_per_testnode", 2)
+        by_cpu = self.cpus // cpus_per
+        self.notes.append(f"{self.cpus} CPUs / {cpus_per} per testnode = {by_cpu}")
+        count = by_cpu
+        if self.memory is not None:
+            memory_per = parse_size(testnode_config.get("memory_per_testnode", "4G"))
+            by_memory = self.memory // memory_per
+            self.notes.append(
+                f"{format_size(self.memory)} memory / {format_size(memory_per)} "
+                f"per testnode = {by_memory}"
+            )
+            count = min(count, by_memory)
+        # A cluster's loop devices must fit in its block of them
+        by_devices = LOOP_DEVICE_STRIDE // max(self.loop_device_count, 1)
+        if count > by_devices:
+            self.notes.append(
+                f"{LOOP_DEVICE_STRIDE} loop devices per cluster / "
+                f"{self.loop_device_count} per testnode = {by_devices}"
+            )
+            count = by_devices
+        return max(count, 1)
+
+    def _plan_loop_device_size(self, testnode_config: Dict) -> int:
+        size = testnode_config.get("loop_device_size", "5G")
+        if size != "auto":
+            return parse_size(size)
+        if self.saved_size:
+            self.notes.append(
+                f"loop devices are {format_size(self.saved_size)}, as first planned"
+            )
+            return self.saved_size
+        reserve = parse_size(testnode_config.get("disk_reserve", "20G"))
+        devices = max(self.count * self.loop_device_count, 1)
+        # Whole GiB, and no more than the maximum
+        size = (max(self.disk - reserve, 0) // devices) // GiB * GiB
+        maximum = parse_size(testnode_config.get("max_loop_device_size", "50G"))
+        size = min(size, maximum)
+        self.notes.append(
+            f"({format_size(self.disk)} free - {format_size(reserve)} reserved) "
+            f"/ {devices} loop devices = {format_size(size)} each, "
+            f"at most {format_size(maximum)}"
+        )
+        # Too little disk is caught when creating; see unallocated_bytes()
+        return max(size, GiB)
+
+    @property
+    def total_loop_device_size(self) -> int:
+        return self.count * self.loop_device_count * self.loop_device_size
+
+    def describe(self) -> List[str]:
+        memory = format_size(self.memory) if self.memory is not None else "unknown"
+        return [
+            f"Host: {self.cpus} CPUs, {memory} memory, "
+            f"{format_size(self.disk)} free disk",
+            f"Testnodes: {self.count}, each with {self.loop_device_count} loop "
+            f"device(s) of {format_size(self.loop_device_size)}; "
+            f"{format_size(self.total_loop_device_size)} in all",
+            *[f"  auto: {note}" for note in self.notes],
+        ]
+
+
+def unallocated_bytes(devices: List[Dict]) -> int:
+    # How much more disk loop devices' images could come to use: sparse
+    # images grow as they're written, up to their full size
+    needed = 0
+    for device in devices:
+        size = parse_size(device["size"])
+        try:
+            allocated = os.stat(device["image"]).st_blocks * 512
+        except FileNotFoundError:
+            allocated = 0
+        needed += max(size - allocated, 0)
+    return needed
+
+
+def plan_capacity(
+    testnode_config: Dict, data_dir: Path, saved_size: Optional[int] = None
+) -> CapacityPlan:
+    return CapacityPlan(
+        testnode_config,
+        cpu_count(),
+        memory_total(),
+        disk_free(loop_img_dir(data_dir)),
+        saved_size,
+    )
+
+
+def forget_loop_device_size(data_dir: Path):
+    # Once the testnodes are gone, the next create may choose afresh
+    with locked_json(Path(data_dir) / CAPACITY_FILE) as saved:
+        saved.pop("loop_device_size", None)
+
+
+def resolve_auto(config: Dict) -> Optional[CapacityPlan]:
+    # Replaces "auto" settings in the config with what the host can take, so
+    # that everything which reads them sees numbers
+    testnode_config = config["containers"]["testnode"]
+    if "auto" not in (
+        testnode_config.get("count"),
+        testnode_config.get("loop_device_size"),
+    ):
+        return None
+    data_dir = Path(config["data_dir"])
+    if testnode_config.get("loop_device_size") != "auto":
+        plan = plan_capacity(testnode_config, data_dir)
+    else:
+        with locked_json(data_dir / CAPACITY_FILE) as saved:
+            plan = plan_capacity(
+                testnode_config, data_dir, saved.get("loop_device_size")
+            )
+            saved["loop_device_size"] = plan.loop_device_size
+    for line in plan.describe():
+        logger.debug(line)
+    testnode_config["count"] = plan.count
+    testnode_config["loop_device_size"] = str(plan.loop_device_size)
+    return plan
@@ -3,14 +3,22 @@ import logging
 import sys
 
 from pathlib import Path
+from subprocess import CalledProcessError
 
-from ceph_devstack import config, logger, parse_args, VERBOSE
-from ceph_devstack.requirements import check_requirements
-from ceph_devstack.resources.ceph import CephDevStack
+from ceph_devstack import logger, parse_args, setup_logging, VERBOSE
+from ceph_devstack.trace import tracer
+
+# These only deal with files or report on state, so needn't check for podman
+# and friends
+FILE_COMMANDS = ["archive", "logs", "metrics", "runs", "status"]
 
 
 def main():  # noqa: C901
     args = parse_args(sys.argv[1:])
+    setup_logging()
+    # Imported here so that it's only loaded once, including the user's file
+    from ceph_devstack import config
+
     config.load(args.config_file)
     if args.verbose:
         for handler in logging.getLogger("root").handlers:
@@ -25,30 +33,104 @@ def main():  # noqa: C901
             config.set_value(args.name, args.value)
         return
     config["args"] = vars(args)
+    if args.cluster:
+        from ceph_devstack.cluster import cluster
+
+        base_data_dir = Path(config["data_dir"]).expanduser()
+        try:
+            cluster.select(args.cluster, base_data_dir)
+        except (ValueError, RuntimeError) as e:
+            logger.error(str(e))
+            sys.exit(1)
+        config["data_dir"] = str(cluster.data_dir(base_data_dir))
     data_path = Path(config["data_dir"]).expanduser()
     data_path.mkdir(parents=True, exist_ok=True)
+    # The config command above needn't pay to import any of this
+    from ceph_devstack.resources import log_command_failure
+    from ceph_devstack.resources.ceph import CephDevStack
+    from ceph_devstack.resources.exceptions import (
+        HealthCheckTimeout,
+        InsufficientCapacity,
+    )
+
     obj = CephDevStack()
 
     async def run():
-        if not await asyncio.gather(
-            check_requirements(),
-            obj.check_requirements(),
+        if args.command not in FILE_COMMANDS and not await meets_requirements(
+            obj, args.command == "doctor"
         ):
             logger.error("Requirements not met!")
             sys.exit(1)
         if args.command == "doctor":
+            obj.show_capacity_plan()
             return
         elif args.command == "wait":
             return await obj.wait(container_name=args.container)
-        elif args.command == "logs":
-            return await obj.logs(
-                run_name=args.run_name, job_id=args.job_id, locate=args.locate
-            )
+        elif args.command in FILE_COMMANDS:
+            return await run_file_command(obj, args)
         else:
-            await obj.apply(args.command)
+            try:
+                await obj.apply(args.command)
+            except (HealthCheckTimeout, InsufficientCapacity):
+                return 1
+            except CalledProcessError as e:
+                log_command_failure(e)
+                return 1
             return 0
 
+    if args.trace:
+        tracer.enable()
     try:
-        sys.exit(asyncio.run(run()))
+        with tracer.span(f"ceph-devstack {args.command}", "cli"):
+            result = asyncio.run(run())
+        sys.exit(result)
     except KeyboardInterrupt:
         logger.debug("Exiting!")
+    finally:
+        if args.trace:
+            tracer.write(args.trace)
+            logger.info(f"Wrote trace to {args.trace}")
+
+
+async def run_file_command(obj, args):
+    if args.command == "status":
+        return await obj.status(watch=args.watch, interval=args.interval)
+    elif args.command == "metrics" and args.metrics_op == "serve":
+        return await obj.serve_metrics(bind=args.bind, port=args.port)
+    elif args.command == "runs" and args.runs_op == "list":
+        return await obj.list_runs(limit=args.limit)
+    elif args.command == "runs" and args.runs_op == "show":
+        return await obj.show_run(run_name=args.run_name)
+    elif args.command == "archive" and args.archive_op == "compact":
+        return await obj.compact_archive(
+            older_than=args.older_than, format=args.format, jobs=args.jobs
+        )
+    elif args.command == "logs":
+        return await obj.logs(
+            run_name=args.run_name,
+            job_id=args.job_id,
+            locate=args.locate,
+            tail=args.tail,
+            follow=args.follow,
+        )
+
+
+async def meets_requirements(obj, force: bool = False) -> bool:
+    from ceph_devstack.requirements import (
+        cache_requirements,
+        check_requirements,
+        requirements_cached,
+    )
+
+    # doctor always checks; other commands skip the checks if nothing they
+    # depend on has changed since they last passed
+    if not force and requirements_cached():
+        return True
+    results = await asyncio.gather(
+        check_requirements(),
+        obj.check_requirements(),
+    )
+    if not all(results):
+        return False
+    cache_requirements()
+    return True
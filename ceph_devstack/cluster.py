@@ -0,0 +1,96 @@
+import re
+
+from pathlib import Path
+from typing import Dict, Optional
+
+from ceph_devstack.jsonfile import locked_json, read_json
+
+# Each named cluster gets a slot, which decides the host ports and loop
+# devices it uses so that clusters on the same host don't collide. Slot 0 is
+# the unnamed, default cluster.
+PORT_STRIDE = 1000
+LOOP_DEVICE_STRIDE = 100
+# The highest port we publish is 11300; leave room below 65535
+MAX_SLOTS = 50
+NAME_PATTERN = re.compile(r"^[a-zA-Z0-9][a-zA-Z0-9_.-]*$")
+REGISTRY_NAME = "clusters.json"
+
+
+def validate_name(name: str) -> str:
+    if not NAME_PATTERN.match(name):
+        raise ValueError(
+            f"Invalid cluster name '{name}'; use letters, digits, '_', '.' and '-'"
+        )
+    return name
+
+
+class SlotRegistry:
+    # Records which slot each named cluster has, in a JSON file shared by
+    # every cluster on the host. Changes are made under an exclusive lock, so
+    # that concurrent invocations can't hand out the same slot twice.
+    def __init__(self, path: Path):
+        self.path = Path(path).expanduser()
+
+    def locked(self):
+        return locked_json(self.path)
+
+    def read(self) -> Dict[str, int]:
+        return read_json(self.path)
+
+    def allocate(self, name: str) -> int:
+        with self.locked() as slots:
+            if name in slots:
+                return slots[name]
+            used = set(slots.values())
+            for slot in range(1, MAX_SLOTS):
+                if slot not in used:
+                    slots[name] = slot
+                    return slot
+        raise RuntimeError(f"No free cluster slots; at most {MAX_SLOTS - 1} allowed")
+
+    def release(self, name: str):
+        with self.locked() as slots:
+            slots.pop(name, None)
+
+
+class Cluster:
+    # The namespace resources live in. The default cluster uses the names,
+    # ports and loop devices ceph-devstack always has; a named one prefixes
+    # names with its own, and offsets ports and loop devices by its slot.
+    def __init__(self):
+        self.name = ""
+        self.slot = 0
+        self.registry: Optional[SlotRegistry] = None
+
+    def select(self, name: str, base_data_dir: Path):
+        self.name = validate_name(name)
+        self.registry = SlotRegistry(Path(base_data_dir) / REGISTRY_NAME)
+        self.slot = self.registry.allocate(name)
+
+    def release(self):
+        if self.registry is not None:
+            self.registry.release(self.name)
+
+    def prefix(self, name: str) -> str:
+        return f"{self.name}-{name}" if self.name else name
+
+    def port(self, port: int) -> int:
+        return port + self.slot * PORT_STRIDE
+
+    @property
+    def loop_device_offset(self) -> int:
+        return self.slot * LOOP_DEVICE_STRIDE
+
+    def data_dir(self, base_data_dir: Path) -> Path:
+        if not self.name:
+            return Path(base_data_dir)
+        return Path(base_data_dir) / "clusters" / self.name
+
+    def secret_arg(self, secret: str) -> str:
+        # Secrets are mounted under their own names unless told otherwise
+        if not self.name:
+            return secret
+        return f"{self.prefix(secret)},target={secret}"
+
+
+cluster = Cluster()
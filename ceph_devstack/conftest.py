@@ -0,0 +1,36 @@
+import json
+
+from unittest.mock import AsyncMock
+
+import pytest
+
+from ceph_devstack.metrics import METRICS_FILE, MetricsStore
+
+
+@pytest.fixture(autouse=True)
+def metrics_path(tmp_path, monkeypatch):
+    # Commands record metrics as they go; keep tests' out of the real data dir
+    path = tmp_path / METRICS_FILE
+    monkeypatch.setattr(MetricsStore, "path", property(lambda self: path))
+    return path
+
+
+@pytest.fixture
+def fake_arun():
+    # Stands in for host.arun, answering podman commands with the JSON in
+    # outputs, keyed by subcommand; inspect only returns the names asked for
+    def make(outputs):
+        calls = []
+
+        async def arun(args):
+            calls.append(args)
+            proc = AsyncMock(returncode=0)
+            output = outputs.get(args[2], [])
+            if args[2] == "inspect":
+                output = [entry for entry in output if entry["Name"] in args[3:]]
+            proc.communicate.return_value = (json.dumps(output).encode(), b"")
+            return proc
+
+        return arun, calls
+
+    return make
@@ -1,27 +1,103 @@
 import asyncio
 from asyncio.subprocess import SubprocessStreamProtocol
+import codecs
+import collections
 import functools
 import os
 import pathlib
 import subprocess
 
-from typing import Dict, List, Optional
+from typing import Deque, Dict, List, Optional
 
 from ceph_devstack import logger, VERBOSE
+from ceph_devstack.trace import Span, tracer
 
+# How many lines of a streamed command's output to keep for diagnostics
+OUTPUT_TAIL_LINES = 50
 
-class LoggingStreamProtocol(asyncio.subprocess.SubprocessStreamProtocol):
-    def __init__(self, limit, loop, log_level):
-        self.log_level = log_level
+
+class TracingStreamProtocol(asyncio.subprocess.SubprocessStreamProtocol):
+    # Closes the command's span when its process exits, noting how much output
+    # it produced. Output may still arrive after the process exits, so keep
+    # counting until the pipes close.
+    def __init__(self, limit, loop, span: Optional[Span] = None):
+        self.span = span
+        if span is not None:
+            span.args["output_bytes"] = 0
         super().__init__(limit=limit, loop=loop)
 
     def pipe_data_received(self, fd, data):
-        logger.log(
-            self.log_level,
-            (data.decode() if isinstance(data, bytes) else str(data)).rstrip("\n"),
-        )
+        if self.span is not None:
+            self.span.args["output_bytes"] += len(data)
         super().pipe_data_received(fd, data)
 
+    def process_exited(self):
+        if self.span is not None:
+            self.span.finish(returncode=self._transport.get_returncode())
+        super().process_exited()
+
+
+class LineBuffer:
+    # Turns a stream of bytes into lines, decoding incrementally so that
+    # multi-byte characters split across reads survive. A "line" with no end
+    # in sight is cut off at max_line, so memory use stays bounded.
+    def __init__(self, max_line: int = 2**16):
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.partial = ""
+        self.max_line = max_line
+
+    def feed(self, data: bytes) -> List[str]:
+        lines = (self.partial + self.decoder.decode(data)).splitlines(keepends=True)
+        self.partial = ""
+        if lines and not lines[-1].endswith(("\n", "\r")):
+            self.partial = lines.pop()
+            if len(self.partial) >= self.max_line:
+                lines.append(self.partial)
+                self.partial = ""
+        return [line.rstrip("\r\n") for line in lines]
+
+    def flush(self) -> List[str]:
+        rest = self.partial + self.decoder.decode(b"", final=True)
+        self.partial = ""
+        return [rest] if rest else []
+
+
+class LoggingStreamProtocol(TracingStreamProtocol):
+    # Logs output line by line as it arrives, rather than buffering it for
+    # a reader; the process's stdout and stderr readers will be empty. Only
+    # the last few lines are kept, as output_tail, for diagnosing failures.
+    def __init__(
+        self,
+        limit,
+        loop,
+        log_level,
+        span: Optional[Span] = None,
+        tail_lines: int = OUTPUT_TAIL_LINES,
+    ):
+        self.log_level = log_level
+        self.buffers = {1: LineBuffer(), 2: LineBuffer()}
+        self.output_tail: Deque[str] = collections.deque(maxlen=tail_lines)
+        super().__init__(limit=limit, loop=loop, span=span)
+
+    def _log_lines(self, lines: List[str]):
+        enabled = logger.isEnabledFor(self.log_level)
+        for line in lines:
+            self.output_tail.append(line)
+            if enabled:
+                logger.log(self.log_level, "%s", line)
+
+    def pipe_data_received(self, fd, data):
+        if self.span is not None:
+            self.span.args["output_bytes"] += len(data)
+        if isinstance(data, str):
+            data = data.encode()
+        self._log_lines(self.buffers[fd].feed(data))
+
+    def pipe_connection_lost(self, fd, exc):
+        if fd in self.buffers:
+            self._log_lines(self.buffers[fd].flush())
+        super().pipe_connection_lost(fd, exc)
+
 
 class Command:
     def __init__(
@@ -49,17 +125,21 @@ class Command:
 
     def run(self) -> subprocess.Popen:
         logger.log(VERBOSE, self._make_log_msg())
+        span = tracer.start(str(self), "command")
         proc = subprocess.Popen(
             args=self.args,
             env=self.env,
             **self.kwargs,
         )
         proc.wait()
+        if span is not None:
+            span.finish(returncode=proc.returncode)
         return proc
 
     async def arun(self) -> asyncio.subprocess.Process:
         logger.log(VERBOSE, self._make_log_msg())
         loop = asyncio.get_running_loop()
+        span = tracer.start(str(self), "command")
         protocol_factory: functools.partial[SubprocessStreamProtocol]
         if self.stream_output:
             protocol_factory = functools.partial(
@@ -67,6 +147,14 @@ class Command:
                 limit=2**16,
                 loop=loop,
                 log_level=VERBOSE,
+                span=span,
+            )
+        elif span is not None:
+            protocol_factory = functools.partial(
+                TracingStreamProtocol,
+                limit=2**16,
+                loop=loop,
+                span=span,
             )
         else:
             protocol_factory = functools.partial(
@@ -74,17 +162,25 @@ class Command:
                 limit=2**16,
                 loop=loop,
             )
-        transport, protocol = await loop.subprocess_exec(
-            protocol_factory,
-            *self.args,
-            env=self.env,
-            **self.kwargs,
-        )
-        return asyncio.subprocess.Process(
+        try:
+            transport, protocol = await loop.subprocess_exec(
+                protocol_factory,
+                *self.args,
+                env=self.env,
+                **self.kwargs,
+            )
+        except OSError as e:
+            if span is not None:
+                span.finish(error=repr(e))
+            raise
+        proc = asyncio.subprocess.Process(
             transport,
             protocol,
             loop,
         )
+        if isinstance(protocol, LoggingStreamProtocol):
+            proc.output_tail = protocol.output_tail  # type: ignore[attr-defined]
+        return proc
 
     def __str__(self):
         return " ".join(self.args)
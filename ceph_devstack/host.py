@@ -1,15 +1,24 @@
+import asyncio
+import json
 import logging
 import os
 import pathlib
+import shutil
 import socket
 import sys
-import yaml
+import tempfile
 
 from packaging.version import parse as parse_version, Version
-from typing import Dict, List, Optional, Union
+from typing import AsyncIterator, Dict, List, Optional, Union, TYPE_CHECKING
+
+from ceph_devstack import config
+from ceph_devstack.trace import tracer
 
 from .exec import Command
 
+if TYPE_CHECKING:
+    from ceph_devstack.podman_api import APIBackend
+
 logger = logging.getLogger(__name__)
 
 
@@ -38,6 +47,27 @@ class Host:
     ):
         return self.cmd(args, cwd=cwd, env=env).run()
 
+    def podman_api(self) -> Optional["APIBackend"]:
+        if not hasattr(self, "_podman_api"):
+            self._podman_api = None
+            if config.get("backend", "cli") == "api":
+                from ceph_devstack.podman_api import (
+                    APIBackend,
+                    LibpodClient,
+                    default_socket_path,
+                )
+
+                socket_path = config.get("podman_socket") or default_socket_path()
+                if os.path.exists(socket_path):
+                    self._podman_api = APIBackend(LibpodClient(socket_path))
+                else:
+                    logger.warning(
+                        f"podman API socket not found at {socket_path}; "
+                        "falling back to the CLI. Try: systemctl --user start "
+                        "podman.socket"
+                    )
+        return self._podman_api
+
     async def arun(
         self,
         args: List[str],
@@ -45,6 +75,14 @@ class Host:
         env: Optional[Dict] = None,
         stream_output: bool = False,
     ):
+        api = self.podman_api() if args and args[0] == "podman" else None
+        if api:
+            with tracer.span(" ".join(args), "api") as span:
+                proc = await api.run(args)
+                if span is not None:
+                    span.args["returncode"] = proc.returncode if proc else None
+            if proc is not None:
+                return proc
         return await self.cmd(
             args, cwd=cwd, env=env, stream_output=stream_output
         ).arun()
@@ -55,12 +93,14 @@ class Host:
         return os.path.exists(path)
 
     def hostname(self) -> str:
-        name = socket.getfqdn()
-        try:
-            socket.gethostbyname(name)
-            return name
-        except socket.gaierror:
-            return "localhost"
+        # Resolving can be slow, so only do it when needed, and only once
+        if not hasattr(self, "_hostname"):
+            self._hostname = socket.getfqdn()
+            try:
+                socket.gethostbyname(self._hostname)
+            except socket.gaierror:
+                self._hostname = "localhost"
+        return self._hostname
 
     def kernel_version(self) -> Version:
         if not hasattr(self, "_kernel_version"):
@@ -80,13 +120,43 @@ class Host:
         return self._os_type
 
     async def podman_info(self, force: bool = False) -> Dict:
+        # Shared by concurrent callers, so podman info only runs once
         if force or not hasattr(self, "_podman_info"):
-            proc = await self.arun(["podman", "info"])
-            assert proc.stdout is not None
-            await proc.wait()
-            stdout = await proc.stdout.read()
-            self._podman_info = yaml.safe_load(stdout.decode().strip())
-        return self._podman_info
+            self._podman_info = asyncio.ensure_future(self._get_podman_info())
+        return await self._podman_info
+
+    async def _get_podman_info(self) -> Dict:
+        proc = await self.arun(["podman", "info", "--format", "json"])
+        out, _ = await proc.communicate()
+        if proc.returncode:
+            return {}
+        return json.loads(out or b"{}")
+
+    async def podman_events(self, filters: List[str]) -> AsyncIterator[Dict]:
+        if api := self.podman_api():
+            from ceph_devstack.podman_api import parse_event_filters
+
+            try:
+                async for event in api.client.events(parse_event_filters(filters)):
+                    yield event
+                return
+            except OSError as e:
+                logger.debug(f"podman API unavailable ({e}); using the CLI")
+        args = ["podman", "events", "--format", "json"]
+        for filter in filters:
+            args.extend(["--filter", filter])
+        proc = await self.arun(args)
+        assert proc.stdout is not None
+        try:
+            while line := await proc.stdout.readline():
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    logger.debug(f"Ignoring unparseable event: {line!r}")
+        finally:
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
 
     async def selinux_enforcing(self) -> bool:
         proc = await host.arun(["cat", "/sys/fs/selinux/enforce"])
@@ -99,7 +169,7 @@ class Host:
         proc = await host.arun(["getsebool", name])
         assert proc.stdout is not None
         out = await proc.stdout.read()
-        return out.decode().strip() != f"{name} --> on"
+        return out.decode().strip() == f"{name} --> on"
 
     async def get_sysctl_value(self, name: str) -> int:
         proc = await host.arun(["sysctl", "-b", name])
@@ -107,14 +177,119 @@ class Host:
         out = await proc.stdout.read()
         return int(out.decode().strip())
 
+    async def test_path(self, flag: str, path: str) -> bool:
+        proc = await self.arun(["test", flag, path])
+        return await proc.wait() == 0
+
+    async def which(self, name: str) -> Optional[str]:
+        proc = await self.arun(["sh", "-c", f"command -v {name}"])
+        out, _ = await proc.communicate()
+        return out.decode().strip() or None
+
 
 class LocalHost(Host):
-    pass
+    # Answer what we can by reading files, rather than running commands
+
+    def kernel_version(self) -> Version:
+        return parse_version(os.uname().release.split("-")[0])
+
+    def os_type(self) -> str:
+        if not hasattr(self, "_os_type"):
+            self._os_type = ""
+            with open("/etc/os-release") as f:
+                for line in f:
+                    key, _, value = line.strip().partition("=")
+                    if key == "ID":
+                        self._os_type = value.strip("\"'").lower()
+        return self._os_type
+
+    async def selinux_enforcing(self) -> bool:
+        try:
+            return pathlib.Path("/sys/fs/selinux/enforce").read_text().strip() == "1"
+        except OSError:
+            return False
+
+    async def check_selinux_bool(self, name: str):
+        try:
+            path = pathlib.Path("/sys/fs/selinux/booleans", name)
+            # The file holds the current value, then the pending value
+            return path.read_text().split()[0] == "1"
+        except (OSError, IndexError):
+            return False
+
+    async def get_sysctl_value(self, name: str) -> int:
+        path = pathlib.Path("/proc/sys", *name.split("."))
+        return int(path.read_text().split()[0])
+
+    async def test_path(self, flag: str, path: str) -> bool:
+        if flag == "-e":
+            return os.path.exists(path)
+        if flag == "-w":
+            return os.access(path, os.W_OK)
+        if flag == "-x":
+            return os.path.isfile(path) and os.access(path, os.X_OK)
+        return await super().test_path(flag, path)
+
+    async def which(self, name: str) -> Optional[str]:
+        return shutil.which(name)
 
 
 class RemoteHost(Host):
     type = "remote"
-    base_args = ["podman", "machine", "ssh", "--"]
+    fallback_args = ["podman", "machine", "ssh", "--"]
+
+    @property
+    def base_args(self) -> List[str]:
+        if not hasattr(self, "_base_args"):
+            self._base_args = self.ssh_args() or self.fallback_args
+        return self._base_args
+
+    def ssh_args(self) -> Optional[List[str]]:
+        # `podman machine ssh` does a full SSH handshake every time. Instead,
+        # connect to the machine ourselves and multiplex every command over
+        # a single persistent master connection.
+        proc = local_host.run(["podman", "machine", "inspect"])
+        assert proc.stdout is not None
+        if proc.returncode != 0:
+            return None
+        try:
+            machine = json.loads(proc.stdout.read())[0]
+            ssh_config = machine["SSHConfig"]
+            identity = ssh_config["IdentityPath"]
+            port = str(ssh_config["Port"])
+            user = ssh_config["RemoteUsername"]
+        except (ValueError, IndexError, KeyError, TypeError):
+            logger.debug("Could not parse `podman machine inspect` output")
+            return None
+        control_path = os.path.join(tempfile.gettempdir(), "ceph-devstack-ssh-%C")
+        ssh = [
+            "ssh",
+            "-i",
+            identity,
+            "-p",
+            port,
+            "-o",
+            f"ControlPath={control_path}",
+            "-o",
+            "ControlMaster=auto",
+            "-o",
+            "ControlPersist=10m",
+            "-o",
+            "StrictHostKeyChecking=no",
+            "-o",
+            "UserKnownHostsFile=/dev/null",
+            "-o",
+            "LogLevel=ERROR",
+        ]
+        destination = f"{user}@localhost"
+        # Start the master up front, so concurrent commands don't race to
+        # become it
+        if local_host.run([*ssh, "-O", "check", destination]).returncode != 0:
+            master = local_host.run([*ssh, "-M", "-N", "-f", destination])
+            if master.returncode != 0:
+                logger.debug("Could not start an SSH master connection")
+                return None
+        return [*ssh, destination, "--"]
 
     def cmd(
         self,
@@ -133,9 +308,11 @@ class RemoteHost(Host):
         return proc.returncode == 0
 
     def hostname(self) -> str:
-        proc = self.run(["hostname"])
-        assert proc.stdout is not None
-        return proc.stdout.read().decode().strip()
+        if not hasattr(self, "_hostname"):
+            proc = self.run(["hostname"])
+            assert proc.stdout is not None
+            self._hostname = proc.stdout.read().decode().strip()
+        return self._hostname
 
 
 local_host = LocalHost()
@@ -0,0 +1,33 @@
+import contextlib
+import copy
+import fcntl
+import json
+import os
+
+from pathlib import Path
+from typing import Dict, Iterator
+
+
+def read_json(path: Path) -> Dict:
+    try:
+        return json.loads(Path(path).read_text())
+    except FileNotFoundError:
+        return {}
+
+
+@contextlib.contextmanager
+def locked_json(path: Path) -> Iterator[Dict]:
+    # For state shared by concurrent invocations: the file is read, modified
+    # and written back under an exclusive lock, and replaced atomically so
+    # that readers which don't lock never see half of it
+    path = Path(path).expanduser()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path.with_name(f"{path.name}.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        data = read_json(path)
+        before = copy.deepcopy(data)
+        yield data
+        if data != before:
+            tmp = path.with_name(f"{path.name}.tmp")
+            tmp.write_text(json.dumps(data, indent=2, sort_keys=True))
+            os.replace(tmp, path)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# Sets up or tears down a batch of loop devices in one privileged invocation:
+#
+#   sudo python3 loop_helper.py setup|teardown MANIFEST
+#
+# MANIFEST is a JSON file (or, where the file can't be shared, its contents)
+# like:
+#
+#   {"uid": 1000, "gid": 1000,
+#    "devices": [{"device": "/dev/loop4", "image": "/path/img", "size": "5G"}]}
+#
+# Devices may also specify:
+#   "pool": keep the image at teardown, and reuse it (after discarding its
+#     contents) at the next setup, rather than deleting and recreating it
+#   "preallocate": allocate the image's blocks up front rather than sparsely
+#   "golden": reflink-clone images from this one rather than creating them
+#
+# This runs as root, and outside of the ceph_devstack package's environment, so
+# it must only use the standard library.
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import json
+import os
+import shutil
+import stat
+import subprocess
+import sys
+
+LOOP_MAJOR = 7
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+FALLOC_FL_ZERO_RANGE = 0x10
+FICLONE = 0x40049409
+SIZE_SUFFIXES = {"": 1, "K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+
+
+def parse_size(size) -> int:
+    size = str(size).strip().upper().removesuffix("B")
+    suffix = size[-1:] if size[-1:] in SIZE_SUFFIXES else ""
+    return int(size.removesuffix(suffix) or 0) * SIZE_SUFFIXES[suffix]
+
+
+def run(args):
+    subprocess.run(args, check=True, stdout=subprocess.DEVNULL)
+
+
+def mounted_devices():
+    with open("/proc/mounts") as f:
+        return {line.split()[0] for line in f}
+
+
+def ensure_loop_module():
+    if not os.path.exists("/sys/module/loop"):
+        run(["modprobe", "loop"])
+
+
+def fallocate(fd: int, mode: int, offset: int, length: int):
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    libc.fallocate.argtypes = [
+        ctypes.c_int,
+        ctypes.c_int,
+        ctypes.c_longlong,
+        ctypes.c_longlong,
+    ]
+    if libc.fallocate(fd, mode, offset, length) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+
+def clone_image(golden, image):
+    # A reflink shares the golden image's blocks until either copy writes to
+    # them; where the filesystem can't do that, the blocks are copied
+    try:
+        with open(golden, "rb") as src, open(image, "wb") as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return
+    except OSError as e:
+        if e.errno not in (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL, errno.ENOTTY):
+            raise
+        print(f"{image}: can't reflink {golden} ({e}); copying", file=sys.stderr)
+    shutil.copyfile(golden, image)
+
+
+def create_image(entry):
+    image = entry["image"]
+    size = parse_size(entry["size"])
+    if golden := entry.get("golden"):
+        clone_image(golden, image)
+    else:
+        open(image, "wb").close()
+    with open(image, "r+b") as f:
+        # The device is as large as its entry says, whatever the golden
+        # image's size. Without preallocation this is a sparse file; blocks
+        # are only allocated as they're written.
+        f.truncate(size)
+        if entry.get("preallocate"):
+            os.posix_fallocate(f.fileno(), 0, size)
+
+
+def scrub_image(entry):
+    # Discard a pooled image's contents without giving up its allocation (if
+    # preallocated) or doing any I/O
+    size = parse_size(entry["size"])
+    mode = FALLOC_FL_KEEP_SIZE
+    mode |= FALLOC_FL_ZERO_RANGE if entry.get("preallocate") else FALLOC_FL_PUNCH_HOLE
+    with open(entry["image"], "r+b") as f:
+        try:
+            fallocate(f.fileno(), mode, 0, size)
+        except OSError:
+            f.truncate(0)
+            f.truncate(size)
+            if entry.get("preallocate"):
+                os.posix_fallocate(f.fileno(), 0, size)
+
+
+def prepare_image(entry):
+    image = entry["image"]
+    os.makedirs(os.path.dirname(image), exist_ok=True)
+    reusable = (
+        entry.get("pool")
+        and not entry.get("golden")
+        and os.path.exists(image)
+        and os.path.getsize(image) == parse_size(entry["size"])
+    )
+    if reusable:
+        scrub_image(entry)
+        return
+    if os.path.exists(image):
+        os.remove(image)
+    create_image(entry)
+
+
+def teardown_device(entry, mounts):
+    device = entry["device"]
+    if device in mounts:
+        run(["umount", device])
+    if os.path.exists(device):
+        subprocess.run(["losetup", "-d", device], stderr=subprocess.DEVNULL)
+        os.remove(device)
+    if os.path.exists(entry["image"]) and not entry.get("pool"):
+        os.remove(entry["image"])
+
+
+def setup_device(entry, uid, gid, mounts):
+    device = entry["device"]
+    image = entry["image"]
+    teardown_device(entry, mounts)
+    minor = int(device.removeprefix("/dev/loop"))
+    os.mknod(device, 0o700 | stat.S_IFBLK, os.makedev(LOOP_MAJOR, minor))
+    os.chmod(device, 0o700)
+    os.chown(device, uid, gid)
+    prepare_image(entry)
+    run(["losetup", device, image])
+    if shutil.which("chcon"):
+        subprocess.run(
+            ["chcon", "-t", "fixed_disk_device_t", device], stderr=subprocess.DEVNULL
+        )
+
+
+def load_manifest(arg: str):
+    if arg.lstrip().startswith("{"):
+        return json.loads(arg)
+    with open(arg) as f:
+        return json.load(f)
+
+
+def main(argv) -> int:
+    action, manifest_arg = argv
+    manifest = load_manifest(manifest_arg)
+    mounts = mounted_devices()
+    if action == "setup":
+        ensure_loop_module()
+    failed = []
+    for entry in manifest["devices"]:
+        try:
+            if action == "setup":
+                setup_device(entry, manifest["uid"], manifest["gid"], mounts)
+            elif action == "teardown":
+                teardown_device(entry, mounts)
+            else:
+                raise ValueError(f"Unknown action: {action}")
+        except (OSError, ValueError, subprocess.CalledProcessError) as e:
+            failed.append(entry["device"])
+            print(f"{entry['device']}: {e}", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
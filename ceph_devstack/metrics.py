@@ -0,0 +1,99 @@
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from ceph_devstack import logger
+from ceph_devstack.jsonfile import locked_json, read_json
+
+METRICS_FILE = "metrics.json"
+PREFIX = "ceph_devstack_"
+# Metrics which commands record as things happen, since the exporter can't
+# observe them itself
+RECORDED = {
+    "watch_restarts_total": (
+        "counter",
+        "Containers restarted or replaced by `watch`, by reason",
+    ),
+    "time_to_healthy_seconds": (
+        "gauge",
+        "How long each container last took to become healthy",
+    ),
+    "action_duration_seconds": (
+        "gauge",
+        "How long each cluster-wide action (e.g. create, start) last took",
+    ),
+}
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels: Dict[str, str]) -> str:
+    return ",".join(
+        f'{key}="{escape_label(str(value))}"' for key, value in sorted(labels.items())
+    )
+
+
+class Family:
+    # One metric and its samples, in Prometheus' text exposition format
+    def __init__(self, name: str, type: str, help: str):
+        self.name = PREFIX + name
+        self.type = type
+        self.help = help
+        self.samples: List[Tuple[str, float]] = []
+
+    def add(self, value: float, **labels: str):
+        self.samples.append((format_labels(labels), value))
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for labels, value in self.samples:
+            name = f"{self.name}{{{labels}}}" if labels else self.name
+            lines.append(f"{name} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+def render(families: List[Family]) -> str:
+    return "".join(family.render() for family in families)
+
+
+class MetricsStore:
+    # Recorded metrics, kept in the data directory so that they outlive the
+    # commands which record them. Each metric maps formatted labels to its
+    # value. Recording is best-effort; it mustn't break the command.
+    @property
+    def path(self) -> Path:
+        from ceph_devstack import config
+
+        return Path(config["data_dir"]).expanduser() / METRICS_FILE
+
+    def _update(self, name: str, labels: Dict[str, str], value: float, inc: bool):
+        try:
+            with locked_json(self.path) as data:
+                samples = data.setdefault(name, {})
+                key = format_labels(labels)
+                samples[key] = (samples.get(key, 0) if inc else 0) + value
+        except (OSError, ValueError) as e:
+            logger.debug(f"Could not record metric {name}: {e}")
+
+    def inc(self, name: str, labels: Dict[str, str], amount: float = 1):
+        self._update(name, labels, amount, inc=True)
+
+    def set(self, name: str, labels: Dict[str, str], value: float):
+        self._update(name, labels, value, inc=False)
+
+    def families(self) -> List[Family]:
+        try:
+            data = read_json(self.path)
+        except (OSError, ValueError) as e:
+            logger.debug(f"Could not read {self.path}: {e}")
+            data = {}
+        families = []
+        for name, (type, help) in RECORDED.items():
+            family = Family(name, type, help)
+            family.samples = list(data.get(name, {}).items())
+            families.append(family)
+        return families
+
+
+metrics = MetricsStore()
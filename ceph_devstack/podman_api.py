@@ -0,0 +1,357 @@
+import asyncio
+import json
+import os
+import urllib.parse
+
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from ceph_devstack import logger
+
+API_PREFIX = "/v4.0.0/libpod"
+
+
+class APIError(Exception):
+    def __init__(self, status: int, message: str):
+        self.status = status
+        self.message = message
+        super().__init__(f"{status}: {message}")
+
+
+class Response:
+    def __init__(self, status: int, headers: Dict[str, str], body: bytes):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body or b"null")
+
+    def raise_for_status(self):
+        if self.status < 400:
+            return
+        try:
+            message = self.json().get("message", "")
+        except (ValueError, AttributeError):
+            message = self.body.decode(errors="replace")
+        raise APIError(self.status, message)
+
+
+def default_socket_path() -> str:
+    if os.getuid() == 0:
+        return "/run/podman/podman.sock"
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR", f"/run/user/{os.getuid()}")
+    return os.path.join(runtime_dir, "podman", "podman.sock")
+
+
+class LibpodClient:
+    # Talks to podman's REST API over its unix socket. Connections are kept
+    # alive and pooled, so a call costs a round trip rather than a fork/exec
+    # of the podman binary.
+    def __init__(self, socket_path: str, max_connections: int = 8):
+        self.socket_path = socket_path
+        self.max_connections = max_connections
+        self._idle: List[Tuple[asyncio.StreamReader, asyncio.StreamWriter]] = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    def _limit(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop or self._semaphore is None:
+            # Connections can't outlive the loop they were opened on
+            self._loop = loop
+            self._idle = []
+            self._semaphore = asyncio.Semaphore(self.max_connections)
+        return self._semaphore
+
+    async def _connect(self):
+        return await asyncio.open_unix_connection(self.socket_path)
+
+    def _format_request(
+        self, method: str, path: str, params: Optional[Dict], body: Optional[bytes]
+    ) -> bytes:
+        url = API_PREFIX + path
+        if params:
+            url += "?" + urllib.parse.urlencode(params, doseq=True)
+        lines = [
+            f"{method} {url} HTTP/1.1",
+            "Host: d",
+            f"Content-Length: {len(body or b'')}",
+        ]
+        if body:
+            lines.append("Content-Type: application/json")
+        return ("\r\n".join(lines) + "\r\n\r\n").encode() + (body or b"")
+
+    async def _read_head(self, reader: asyncio.StreamReader):
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError("Connection closed by podman")
+        status = int(status_line.split()[1])
+        headers = {}
+        while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+            key, _, value = line.decode().partition(":")
+            headers[key.strip().lower()] = value.strip()
+        return status, headers
+
+    async def _read_chunks(self, reader: asyncio.StreamReader) -> AsyncIterator[bytes]:
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            if size == 0:
+                await reader.readline()
+                return
+            yield await reader.readexactly(size)
+            await reader.readline()
+
+    async def request(
+        self,
+        method: str,
+        path: str,
+        params: Optional[Dict] = None,
+        body: Optional[Dict] = None,
+    ) -> Response:
+        data = json.dumps(body).encode() if body is not None else None
+        async with self._limit():
+            for attempt in range(2):
+                reused = bool(self._idle)
+                reader, writer = self._idle.pop() if reused else await self._connect()
+                try:
+                    writer.write(self._format_request(method, path, params, data))
+                    await writer.drain()
+                    status, headers = await self._read_head(reader)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    writer.close()
+                    # The server may have dropped an idle connection; retry once
+                    if reused and attempt == 0:
+                        continue
+                    raise
+                keep_alive = headers.get("connection", "").lower() != "close"
+                if headers.get("transfer-encoding", "").lower() == "chunked":
+                    payload = b"".join([c async for c in self._read_chunks(reader)])
+                elif "content-length" in headers:
+                    payload = await reader.readexactly(int(headers["content-length"]))
+                elif status in (204, 304) or method == "HEAD":
+                    payload = b""
+                else:
+                    payload = await reader.read()
+                    keep_alive = False
+                if keep_alive:
+                    self._idle.append((reader, writer))
+                else:
+                    writer.close()
+                return Response(status, headers, payload)
+        raise AssertionError("unreachable")
+
+    async def stream(
+        self, path: str, params: Optional[Dict] = None
+    ) -> AsyncIterator[Dict]:
+        # Streaming responses hold their connection open, so they get their
+        # own rather than one from the pool
+        reader, writer = await self._connect()
+        try:
+            writer.write(self._format_request("GET", path, params, None))
+            await writer.drain()
+            status, headers = await self._read_head(reader)
+            if status >= 400:
+                Response(status, headers, await reader.read(2**16)).raise_for_status()
+            if headers.get("transfer-encoding", "").lower() == "chunked":
+                chunks = self._read_chunks(reader)
+            else:
+                chunks = iter_reader(reader)
+            buffer = b""
+            async for chunk in chunks:
+                buffer += chunk
+                *lines, buffer = buffer.split(b"\n")
+                for line in lines:
+                    if line.strip():
+                        yield json.loads(line)
+        finally:
+            writer.close()
+
+    async def close(self):
+        while self._idle:
+            _, writer = self._idle.pop()
+            writer.close()
+
+    async def ping(self) -> bool:
+        try:
+            return (await self.request("GET", "/_ping")).status == 200
+        except OSError:
+            return False
+
+    async def container_list(self, all: bool = True) -> List[Dict]:
+        response = await self.request(
+            "GET", "/containers/json", {"all": str(all).lower()}
+        )
+        response.raise_for_status()
+        return response.json() or []
+
+    async def container_exists(self, name: str) -> bool:
+        response = await self.request("GET", f"/containers/{name}/exists")
+        return response.status == 204
+
+    async def container_inspect(self, name: str) -> Dict:
+        response = await self.request("GET", f"/containers/{name}/json")
+        response.raise_for_status()
+        return response.json()
+
+    async def container_create(self, spec: Dict) -> str:
+        response = await self.request("POST", "/containers/create", body=spec)
+        response.raise_for_status()
+        return response.json()["Id"]
+
+    async def container_start(self, name: str):
+        response = await self.request("POST", f"/containers/{name}/start")
+        if response.status != 304:
+            response.raise_for_status()
+
+    async def container_stop(self, name: str, timeout: Optional[int] = None):
+        params = {} if timeout is None else {"timeout": timeout}
+        response = await self.request("POST", f"/containers/{name}/stop", params)
+        if response.status != 304:
+            response.raise_for_status()
+
+    async def container_remove(self, name: str, force: bool = False):
+        response = await self.request(
+            "DELETE", f"/containers/{name}", {"force": str(force).lower()}
+        )
+        response.raise_for_status()
+
+    async def container_wait(self, name: str, condition: Optional[str] = None) -> int:
+        params = {"condition": condition} if condition else {}
+        response = await self.request("POST", f"/containers/{name}/wait", params)
+        response.raise_for_status()
+        return int(response.json())
+
+    async def events(self, filters: Dict[str, List[str]]) -> AsyncIterator[Dict]:
+        params = {"stream": "true", "filters": json.dumps(filters)}
+        async for event in self.stream("/events", params):
+            # Match the shape of `podman events --format json`
+            actor = event.get("Actor", {})
+            yield {
+                "ID": actor.get("ID", event.get("id", "")),
+                "Name": actor.get("Attributes", {}).get("name", ""),
+                "Status": event.get("Action", event.get("status", "")),
+                "Type": event.get("Type", ""),
+                "HealthStatus": event.get("HealthStatus", ""),
+                "Attributes": actor.get("Attributes", {}),
+            }
+
+
+async def iter_reader(reader: asyncio.StreamReader) -> AsyncIterator[bytes]:
+    while chunk := await reader.read(2**16):
+        yield chunk
+
+
+class APIProcess:
+    # Enough of asyncio.subprocess.Process for PodmanResource and friends, so
+    # API calls can stand in for podman commands
+    def __init__(self, returncode: int, stdout: bytes = b"", stderr: bytes = b""):
+        self.returncode = returncode
+        self.stdout = asyncio.StreamReader()
+        self.stdout.feed_data(stdout)
+        self.stdout.feed_eof()
+        self.stderr = asyncio.StreamReader()
+        self.stderr.feed_data(stderr)
+        self.stderr.feed_eof()
+
+    async def wait(self) -> int:
+        return self.returncode
+
+    async def communicate(self) -> Tuple[bytes, bytes]:
+        return await self.stdout.read(), await self.stderr.read()
+
+    def kill(self):
+        pass
+
+
+def parse_event_filters(filters: List[str]) -> Dict[str, List[str]]:
+    result: Dict[str, List[str]] = {}
+    for filter in filters:
+        key, _, value = filter.partition("=")
+        result.setdefault(key, []).append(value)
+    return result
+
+
+class APIBackend:
+    # Serves the podman commands ceph-devstack runs often via the REST API.
+    # Anything not handled here (notably `container create`, whose CLI flags
+    # have no direct API equivalent) returns None so the caller falls back to
+    # running the CLI.
+    def __init__(self, client: LibpodClient):
+        self.client = client
+
+    async def run(self, args: List[str]) -> Optional[APIProcess]:
+        if args[:2] == ["podman", "container"]:
+            args = ["podman"] + args[2:]
+        if len(args) < 2:
+            return None
+        op, rest = args[1], args[2:]
+        handler = getattr(self, f"_{op}", None)
+        if handler is None:
+            return None
+        try:
+            return await handler(rest)
+        except APIError as e:
+            return APIProcess(125, stderr=f"Error: {e.message}\n".encode())
+        except OSError as e:
+            logger.debug(f"podman API unavailable ({e}); falling back to the CLI")
+            return None
+
+    async def _start(self, rest: List[str]):
+        if len(rest) != 1:
+            return None
+        await self.client.container_start(rest[0])
+        return APIProcess(0, stdout=f"{rest[0]}\n".encode())
+
+    async def _stop(self, rest: List[str]):
+        if len(rest) != 1:
+            return None
+        await self.client.container_stop(rest[0])
+        return APIProcess(0, stdout=f"{rest[0]}\n".encode())
+
+    async def _rm(self, rest: List[str]):
+        force = "-f" in rest or "--force" in rest
+        names = [arg for arg in rest if arg not in ("-f", "--force")]
+        if len(names) != 1 or len(names) + int(force) != len(rest):
+            return None
+        try:
+            await self.client.container_remove(names[0], force=force)
+        except APIError as e:
+            if not (force and e.status == 404):
+                raise
+        return APIProcess(0, stdout=f"{names[0]}\n".encode())
+
+    async def _inspect(self, rest: List[str]):
+        if not rest or any(arg.startswith("-") for arg in rest):
+            return None
+        results, errors = [], []
+        for name in rest:
+            try:
+                results.append(await self.client.container_inspect(name))
+            except APIError as e:
+                errors.append(f"Error: {e.message}\n")
+        return APIProcess(
+            125 if errors else 0,
+            stdout=json.dumps(results).encode(),
+            stderr="".join(errors).encode(),
+        )
+
+    async def _ls(self, rest: List[str]):
+        if sorted(rest) != sorted(["--all", "--format", "json"]):
+            return None
+        containers = await self.client.container_list(all=True)
+        return APIProcess(0, stdout=json.dumps(containers).encode())
+
+    async def _wait(self, rest: List[str]):
+        condition = None
+        names = []
+        for arg in rest:
+            if arg.startswith("--condition="):
+                condition = arg.split("=", 1)[1]
+            elif arg.startswith("-"):
+                return None
+            else:
+                names.append(arg)
+        if len(names) != 1:
+            return None
+        code = await self.client.container_wait(names[0], condition=condition)
+        return APIProcess(0, stdout=f"{code}\n".encode())
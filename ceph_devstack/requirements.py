@@ -1,8 +1,14 @@
+import asyncio
+import hashlib
+import json
+import os
+import shutil
 import sys
+import weakref
 
 from pathlib import Path
 from packaging.version import parse as parse_version, Version
-from typing import List
+from typing import List, Optional
 
 from ceph_devstack import config, logger
 from ceph_devstack.host import Host, host, local_host
@@ -16,10 +22,26 @@ class Requirement:
         return await self.check()
 
     async def check(self) -> bool:
+        if self.check_cmd[0] == "test" and len(self.check_cmd) == 3:
+            return await self.host.test_path(*self.check_cmd[1:])
         proc = await self.host.arun(self.check_cmd)
         return await proc.wait() == 0
 
 
+_fix_locks: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Lock]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def fix_lock() -> asyncio.Lock:
+    # Checks run concurrently, but fixes may prompt for a sudo password, so
+    # they take turns
+    loop = asyncio.get_running_loop()
+    if loop not in _fix_locks:
+        _fix_locks[loop] = asyncio.Lock()
+    return _fix_locks[loop]
+
+
 class FixableRequirement(Requirement):
     fix_cmd: List[str]
     suggest_msg: str
@@ -28,7 +50,8 @@ class FixableRequirement(Requirement):
         if await self.check() is True:
             return True
         if config["args"].get("fix", False):
-            return await self.fix()
+            async with fix_lock():
+                return await self.fix()
         else:
             await self.suggest()
             return False
@@ -195,7 +218,7 @@ class PodmanDNSPlugin(FixableRequirement):
 
     def __init__(self):
         os_type = self.host.os_type()
-        if os_type == "centos":
+        if os_type in ["centos", "fedora", "rhel", "rocky", "almalinux"]:
             dns_plugin_path = "/usr/libexec/cni/dnsname"
             self.check_cmd = ["test", "-x", dns_plugin_path]
             self.fix_cmd = ["sudo", "dnf", "install", "-y", dns_plugin_path]
@@ -210,50 +233,144 @@ class PodmanDNSPlugin(FixableRequirement):
                 "golang-github-containernetworking-plugin-dnsname",
             ]
 
+    async def check(self):
+        if not hasattr(self, "check_cmd"):
+            logger.debug(f"Don't know where {self.host.os_type()} keeps dnsname")
+            return True
+        return await super().check()
+
 
 class FuseOverlayfsPresence(FixableRequirement):
-    check_cmd = ["command", "-v", "fuse-overlayfs"]
     suggest_msg = "Could not find fuse-overlayfs"
     fix_cmd = ["sudo", "dnf", "install", "-y", "fuse-overlayfs"]
 
+    async def check(self):
+        return await self.host.which("fuse-overlayfs") is not None
 
-async def check_requirements():
-    if not await PodmanPlatform().evaluate():
-        return False
 
-    result = True
+async def check_overlay() -> bool:
     # kernel and podman versions for native overlay filesystem
-    result = result and await PodmanGraphDriver().evaluate()
     podman_overlay_version = "3.10"
-    podman_version_overlay = await PodmanVersion(
-        podman_overlay_version,
-        "Podman version is too old for rootless native overlayfs (needs {podman_overlay_version})",
-    ).evaluate()
-    needs_fuse = not (
-        await KernelVersionForOverlay().evaluate() and podman_version_overlay
+    native_overlay = await asyncio.gather(
+        KernelVersionForOverlay().evaluate(),
+        PodmanVersion(
+            podman_overlay_version,
+            "Podman version is too old for rootless native overlayfs "
+            f"(needs {podman_overlay_version})",
+        ).evaluate(),
     )
     # if not using native overlay, we need fuse-overlayfs
-    if needs_fuse:
-        result = result and await FuseOverlayfsPresence().evaluate()
+    if not all(native_overlay):
+        return await FuseOverlayfsPresence().evaluate()
+    return True
+
 
-    # cgroup v2
+async def check_cgroup() -> bool:
     if not await CgroupV2().evaluate():
-        result = result and await KernelVersionForCgroupV2().evaluate()
+        return await KernelVersionForCgroupV2().evaluate()
+    return True
 
-    # runtime
-    result = result and await PodmanRuntime().evaluate()
 
-    # SELinux
-    if await host.selinux_enforcing():
-        result = result and await SELinuxBoolean("container_manage_cgroup").evaluate()
-        result = result and await SELinuxBoolean("container_use_devices").evaluate()
+async def check_selinux() -> bool:
+    if not await host.selinux_enforcing():
+        return True
+    results = await asyncio.gather(
+        SELinuxBoolean("container_manage_cgroup").evaluate(),
+        SELinuxBoolean("container_use_devices").evaluate(),
+    )
+    return all(results)
+
 
-    # podman DNS plugin
+async def check_dns_plugin() -> bool:
     if not await PodmanVersion("5.0").evaluate():
-        result = result and await PodmanDNSPlugin().evaluate()
+        return await PodmanDNSPlugin().evaluate()
+    return True
+
+
+async def check_requirements():
+    # Everything else relies on podman info, which PodmanPlatform fetches
+    if not await PodmanPlatform().evaluate():
+        return False
+
+    # Checks which depend on one another are chained inside the helpers above;
+    # the rest are independent, so evaluate them all at once. Unlike a
+    # sequential run, every failure gets reported, not just the first.
+    results = await asyncio.gather(
+        PodmanGraphDriver().evaluate(),
+        check_overlay(),
+        check_cgroup(),
+        PodmanRuntime().evaluate(),
+        check_selinux(),
+        check_dns_plugin(),
+        # sysctl settings for OSD
+        SysctlValue("fs.aio-max-nr", 2097152).evaluate(),
+        SysctlValue("kernel.pid_max", 4194304).evaluate(),
+    )
+    return all(results)
+
+
+# Files whose modification would change the outcome of requirement checks
+FINGERPRINT_PATHS = [
+    "/dev/loop-control",
+    "/etc/containers/containers.conf",
+    "/etc/containers/storage.conf",
+    "/etc/group",
+    "/etc/os-release",
+    "/usr/share/containers/containers.conf",
+    "~/.config/containers/containers.conf",
+    "~/.config/containers/storage.conf",
+]
+
+
+def requirements_fingerprint() -> Optional[str]:
+    # Describes everything the requirement checks depend on, cheaply: nothing
+    # here forks a process. podman's version is represented by its binary's
+    # identity rather than by asking it.
+    if host.type != "local":
+        return None
+    try:
+        boot_id = Path("/proc/sys/kernel/random/boot_id").read_text().strip()
+    except OSError:
+        return None
+    files = {}
+    podman_path = shutil.which("podman")
+    for path in FINGERPRINT_PATHS + ([podman_path] if podman_path else []):
+        try:
+            st = os.stat(os.path.expanduser(path))
+            files[path] = [st.st_mtime_ns, st.st_size, st.st_ino, st.st_mode, st.st_gid]
+        except OSError:
+            files[path] = None
+    settings = {k: v for k, v in config.items() if k != "args"}
+    parts = {
+        "boot_id": boot_id,
+        "kernel": os.uname().release,
+        "uid": os.getuid(),
+        "groups": sorted(os.getgroups()),
+        "files": files,
+        "config": json.dumps(settings, sort_keys=True, default=str),
+    }
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+
+def requirements_cache_path() -> Path:
+    return Path(config["data_dir"]).expanduser() / "requirements.json"
+
+
+def requirements_cached() -> bool:
+    if not (fingerprint := requirements_fingerprint()):
+        return False
+    try:
+        cached = json.loads(requirements_cache_path().read_text())
+    except (OSError, ValueError):
+        return False
+    return cached.get("fingerprint") == fingerprint
 
-    # sysctl settings for OSD
-    result = result and await SysctlValue("fs.aio-max-nr", 2097152).evaluate()
-    result = result and await SysctlValue("kernel.pid_max", 4194304).evaluate()
 
-    return result
+def cache_requirements():
+    if not (fingerprint := requirements_fingerprint()):
+        return
+    path = requirements_cache_path()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps({"fingerprint": fingerprint}))
+    tmp_path.replace(path)
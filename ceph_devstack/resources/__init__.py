@@ -9,7 +9,12 @@ from pathlib import Path
 from subprocess import CalledProcessError
 from typing import List, Dict, Set
 
+from ceph_devstack import logger
+from ceph_devstack.cluster import cluster
+from ceph_devstack.exec import OUTPUT_TAIL_LINES
 from ceph_devstack.host import host, local_host
+from ceph_devstack.resources.snapshot import snapshot
+from ceph_devstack.trace import traced
 
 
 class DevStack:
@@ -29,8 +34,18 @@ class DevStack:
         ).decode()
 
 
+def log_command_failure(e: CalledProcessError):
+    # Called wherever a failed command is finally handled, so that the end of
+    # its output, kept by cmd(), is shown once
+    logger.error(f"{' '.join(map(str, e.cmd))} failed with status {e.returncode}")
+    for line in (e.output or e.stderr or "").splitlines():
+        logger.error(f"  {line}")
+
+
 class PodmanResource:
     cwd = "."
+    # The kind of podman object this is, for looking it up in the snapshot
+    kind: str = ""
     exists_cmd: List[str] = []
     create_cmd: List[str] = []
     remove_cmd: List[str] = []
@@ -42,13 +57,19 @@ class PodmanResource:
     def __init__(self, name: str = ""):
         if name:
             self._name = name
+        if self.kind:
+            snapshot.track(self.kind, self.name)
 
     @property
-    def name(self) -> str:
+    def base_name(self) -> str:
         if hasattr(self, "_name"):
             return self._name
         return self.__class__.__name__.lower()
 
+    @property
+    def name(self) -> str:
+        return cluster.prefix(self.base_name)
+
     async def cmd(
         self,
         args: List[str],
@@ -66,9 +87,13 @@ class PodmanResource:
         assert proc.stdout is not None
         returncode = await proc.wait()
         if check and returncode != 0:
-            # out = await proc.stderr.read()
-            # logger.error(out.decode())
-            raise CalledProcessError(cmd=args, returncode=returncode)
+            if hasattr(proc, "output_tail"):
+                output = "\n".join(proc.output_tail)
+            else:
+                err = await proc.stderr.read()
+                lines = err.decode(errors="replace").splitlines()
+                output = "\n".join(lines[-OUTPUT_TAIL_LINES:])
+            raise CalledProcessError(cmd=args, returncode=returncode, output=output)
         return proc
 
     def format_cmd(self, args: List):
@@ -88,26 +113,30 @@ class PodmanResource:
         await method()
 
     async def inspect(self):
+        if self.kind:
+            return await snapshot.inspect(self.kind, self.name)
         proc = await self.cmd(self.format_cmd(self.exists_cmd))
         out, err = await proc.communicate()
         return json.loads(out)
-        return json.loads(proc.stdout.read())
-        if proc.stdout is None:
-            return {}
-        return json.loads((await proc.stdout.read()).decode())
 
     async def exists(self):
+        if self.kind:
+            return self.name in await snapshot.get(self.kind)
         if not self.exists_cmd:
             return False
         proc = await self.cmd(self.format_cmd(self.exists_cmd), check=False)
         return await proc.wait() == 0
 
+    @traced
     async def create(self):
         if not await self.exists():
             await self.cmd(self.format_cmd(self.create_cmd), check=True)
+            snapshot.invalidate(self.kind)
 
+    @traced
     async def remove(self):
         await self.cmd(self.format_cmd(self.remove_cmd))
+        snapshot.invalidate(self.kind)
 
     def __repr__(self):
         param_str = "" if not hasattr(self, "_name") else f'name="{self._name}"'
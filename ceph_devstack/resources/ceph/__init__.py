@@ -1,13 +1,36 @@
 import asyncio
-import contextlib
+import collections
+import functools
 import os
+import sys
 import tempfile
+import time
 
+from pathlib import Path
 from subprocess import CalledProcessError
+from typing import Callable, Dict, List, Optional, Set
 
 from ceph_devstack import config, logger
-from ceph_devstack.host import host
+from ceph_devstack.cluster import LOOP_DEVICE_STRIDE, cluster
+from ceph_devstack.capacity import (
+    disk_free,
+    forget_loop_device_size,
+    format_size,
+    plan_capacity,
+    resolve_auto,
+    unallocated_bytes,
+)
+from ceph_devstack.host import host, local_host
+from ceph_devstack.metrics import metrics
+from ceph_devstack.resources import log_command_failure
+from ceph_devstack.resources.container import Container
+from ceph_devstack.resources.exceptions import (
+    HealthCheckTimeout,
+    InsufficientCapacity,
+)
 from ceph_devstack.resources.misc import Secret, Network
+from ceph_devstack.resources.snapshot import snapshot
+from ceph_devstack.trace import traced
 from ceph_devstack.resources.ceph.containers import (
     Postgres,
     Beanstalk,
@@ -23,19 +46,23 @@ from ceph_devstack.resources.ceph.requirements import (
     LoopControlDeviceWriteable,
     SELinuxModule,
 )
-from ceph_devstack.resources.ceph.utils import get_most_recent_run, get_job_id
+from ceph_devstack.resources.ceph.archive import ArchiveIndex, parse_age
+from ceph_devstack.resources.ceph.autoscale import WorkerScaler
+from ceph_devstack.resources.ceph.exporter import serve_metrics
+from ceph_devstack.resources.ceph.logs import find_log, show_log
+from ceph_devstack.resources.ceph.status import CLEAR_SCREEN, render_status
+from ceph_devstack.resources.ceph.utils import get_job_id
 from ceph_devstack.resources.ceph.exceptions import TooManyJobsFound
 
+# podman events which may mean that a watched container needs attention
+WATCH_EVENTS = ["died", "remove", "health_status"]
+
 
 class SSHKeyPair(Secret):
     _name = "id_rsa"
     cmd_vars = ["name", "privkey_path", "pubkey_path"]
     privkey_path = "id_rsa"
     pubkey_path = "id_rsa.pub"
-    exists_cmds = [
-        ["podman", "secret", "inspect", "{name}"],
-        ["podman", "secret", "inspect", "{name}.pub"],
-    ]
     create_cmds = [
         ["podman", "secret", "create", "{name}", "{privkey_path}"],
         ["podman", "secret", "create", "{name}.pub", "{pubkey_path}"],
@@ -46,11 +73,8 @@ class SSHKeyPair(Secret):
     ]
 
     async def exists(self):
-        for exists_cmd in self.exists_cmds:
-            proc = await self.cmd(self.format_cmd(exists_cmd), check=False)
-            if await proc.wait():
-                return False
-        return True
+        secrets = await snapshot.get(self.kind)
+        return self.name in secrets and f"{self.name}.pub" in secrets
 
     async def create(self):
         if await self.exists():
@@ -58,10 +82,12 @@ class SSHKeyPair(Secret):
         await self._get_ssh_keys()
         for create_cmd in self.create_cmds:
             await self.cmd(self.format_cmd(create_cmd), check=True)
+        snapshot.invalidate(self.kind)
 
     async def remove(self):
         for remove_cmd in self.remove_cmds:
             await self.cmd(self.format_cmd(remove_cmd))
+        snapshot.invalidate(self.kind)
 
     async def _get_ssh_keys(self):
         privkey_path = os.environ.get("SSH_PRIVKEY_PATH")
@@ -89,6 +115,8 @@ class CephDevStack:
     secrets = [SSHKeyPair]
 
     def __init__(self):
+        # Sizes testnodes to the host, if asked to
+        self.capacity_plan = resolve_auto(config)
         services = [
             Postgres,
             Paddles,
@@ -122,16 +150,21 @@ class CephDevStack:
             )
 
     async def check_requirements(self):
-        result = True
+        async def loop_control():
+            return (
+                await LoopControlDeviceExists().evaluate()
+                and await LoopControlDeviceWriteable().evaluate()
+            )
 
-        result = has_sudo = await HasSudo().evaluate()
-        result = result and await LoopControlDeviceExists().evaluate()
-        result = result and await LoopControlDeviceWriteable().evaluate()
+        has_sudo, result, selinux_enforcing = await asyncio.gather(
+            HasSudo().evaluate(), loop_control(), host.selinux_enforcing()
+        )
+        result = has_sudo and result
 
         # Check for SELinux being enabled and Enforcing; then check for the
         # presence of our module. If necessary, inform the user and instruct
         # them how to build and install.
-        if has_sudo and await host.selinux_enforcing():
+        if has_sudo and selinux_enforcing:
             result = result and await SELinuxModule().evaluate()
 
         for name, obj in config["containers"].items():
@@ -143,18 +176,41 @@ class CephDevStack:
     async def apply(self, action):
         return await getattr(self, action)()
 
+    @traced
     async def pull(self):
         logger.info("Pulling images...")
-        for spec in self.service_specs.values():
-            await spec["objects"][0].pull()
+        containers = [spec["objects"][0] for spec in self.service_specs.values()]
+        semaphore = asyncio.Semaphore(config["pull_concurrency"])
+        finished = 0
+
+        async def pull(container: Container):
+            nonlocal finished
+            async with semaphore:
+                start = time.monotonic()
+                pulled = await container.pull()
+                elapsed = time.monotonic() - start
+            finished += 1
+            status = f"pulled in {elapsed:.1f}s" if pulled else "up to date"
+            logger.info(f"[{finished}/{len(containers)}] {container.image}: {status}")
+
+        await asyncio.gather(*[pull(container) for container in containers])
 
+    @traced
     async def build(self):
         logger.info("Building images...")
-        for spec in self.service_specs.values():
-            await spec["objects"][0].build()
+        # Images are independent of one another, so build them all at once
+        await asyncio.gather(
+            *[spec["objects"][0].build() for spec in self.service_specs.values()]
+        )
 
+    @traced
     async def create(self):
+        if config.get("args", {}).get("build"):
+            await self.build()
         logger.info("Creating containers...")
+        started_at = time.monotonic()
+        self.check_loop_devices()
+        await self.check_disk()
         await CephDevStackNetwork().create()
         await SSHKeyPair().create()
         containers = []
@@ -162,75 +218,357 @@ class CephDevStack:
             for object in spec["objects"]:
                 containers.append(object.create())
         await asyncio.gather(*containers)
+        metrics.set(
+            "action_duration_seconds",
+            {"action": "create"},
+            time.monotonic() - started_at,
+        )
+
+    def testnodes(self) -> List[TestNode]:
+        spec = self.service_specs.get("testnode")
+        return spec["objects"] if spec else []
+
+    def disk_shortfall(self) -> int:
+        # How far short the disk is of what the loop devices' sparse images
+        # could grow to; the images live on podman's host
+        testnodes = self.testnodes()
+        if not testnodes or host is not local_host:
+            return 0
+        devices = [d for t in testnodes for d in t.loop_device_manifest()]
+        return unallocated_bytes(devices) - disk_free(testnodes[0].loop_img_dir)
+
+    def check_loop_devices(self):
+        # Each cluster's loop devices are numbered within a block of their
+        # own; any more would be another cluster's
+        testnodes = self.testnodes()
+        devices = sum(t.loop_device_count for t in testnodes)
+        if devices > LOOP_DEVICE_STRIDE:
+            msg = (
+                f"{devices} loop devices are too many; each cluster may have at "
+                f"most {LOOP_DEVICE_STRIDE}. Reduce containers.testnode.count "
+                "or loop_device_count"
+            )
+            logger.error(msg)
+            raise InsufficientCapacity(msg)
 
+    async def check_disk(self):
+        # Only worth refusing if there are testnodes left to create
+        exists = await asyncio.gather(*[t.exists() for t in self.testnodes()])
+        if all(exists):
+            return
+        if (shortfall := self.disk_shortfall()) > 0:
+            msg = (
+                "Loop device images could fill the disk; free "
+                f"{format_size(shortfall)} more, or reduce containers.testnode.count "
+                "or loop_device_size (or set either to auto)"
+            )
+            logger.error(msg)
+            raise InsufficientCapacity(msg)
+
+    def show_capacity_plan(self):
+        plan = self.capacity_plan or plan_capacity(
+            config["containers"]["testnode"], Path(config["data_dir"])
+        )
+        for line in plan.describe():
+            logger.info(line)
+        if (shortfall := self.disk_shortfall()) > 0:
+            logger.warning(
+                f"create will refuse: loop device images could exceed free disk "
+                f"by {format_size(shortfall)}"
+            )
+
+    async def scaled_workers(self) -> List[Teuthology]:
+        # Workers added by `watch` outlive it, so find them by name
+        spec = self.service_specs.get("teuthology")
+        known = {object.name for object in spec["objects"]} if spec else set()
+        prefix = cluster.prefix("teuthology_")
+        return [
+            Teuthology(name=name.removeprefix(cluster.prefix("")))
+            for name in await snapshot.get("container")
+            if name.startswith(prefix)
+            and name[len(prefix) :].isdigit()
+            and name not in known
+        ]
+
+    def dependencies(self, name: str) -> List[str]:
+        # Services disabled via count = 0 can't be waited on; skip them
+        return [
+            dep
+            for dep in self.service_specs[name]["obj"].depends_on
+            if dep in self.service_specs
+        ]
+
+    def check_dependencies(self):
+        visiting: Set[str] = set()
+        visited: Set[str] = set()
+
+        def visit(name: str):
+            if name in visited:
+                return
+            if name in visiting:
+                raise ValueError(f"Dependency cycle detected involving {name}")
+            visiting.add(name)
+            for dep in self.dependencies(name):
+                visit(dep)
+            visiting.remove(name)
+            visited.add(name)
+
+        for name in self.service_specs:
+            visit(name)
+
+    async def apply_in_dependency_order(self, action: str):
+        # Each service runs the action as soon as everything it depends on has
+        # finished doing so; independent services run concurrently.
+        self.check_dependencies()
+        done = {name: asyncio.Event() for name in self.service_specs}
+
+        async def apply_service(name: str):
+            for dep in self.dependencies(name):
+                await done[dep].wait()
+            await asyncio.gather(
+                *[
+                    getattr(object, action)()
+                    for object in self.service_specs[name]["objects"]
+                ]
+            )
+            done[name].set()
+
+        tasks = [
+            asyncio.ensure_future(apply_service(name)) for name in self.service_specs
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    @traced
     async def start(self):
+        started_at = time.monotonic()
         await self.create()
         logger.info("Starting containers...")
-        for spec in self.service_specs.values():
-            for object in spec["objects"]:
-                await object.start()
+        await self.apply_in_dependency_order("start")
+        metrics.set(
+            "action_duration_seconds",
+            {"action": "start"},
+            time.monotonic() - started_at,
+        )
+        healthy_times = sorted(
+            (
+                (object.time_to_healthy, object.name)
+                for spec in self.service_specs.values()
+                for object in spec["objects"]
+                if hasattr(object, "time_to_healthy")
+            ),
+            reverse=True,
+        )
+        if healthy_times:
+            logger.info(
+                "Time to healthy: "
+                + ", ".join(f"{name} {t:.1f}s" for t, name in healthy_times)
+            )
         logger.info(
             "All containers are running. To monitor teuthology, try running: podman "
-            "logs -f teuthology"
+            f"logs -f {Teuthology().name}"
         )
         hostname = host.hostname()
-        logger.info(f"View test results at http://{hostname}:8081/")
+        logger.info(f"View test results at http://{hostname}:{cluster.port(8081)}/")
 
+    @traced
     async def stop(self):
         logger.info("Stopping containers...")
         containers = []
         for spec in self.service_specs.values():
             for object in spec["objects"]:
                 containers.append(object.stop())
+        for worker in await self.scaled_workers():
+            containers.append(worker.stop())
         await asyncio.gather(*containers)
 
+    @traced
     async def remove(self):
         logger.info("Removing containers...")
         containers = []
         for spec in self.service_specs.values():
             for object in spec["objects"]:
                 containers.append(object.remove())
+        for worker in await self.scaled_workers():
+            containers.append(worker.remove())
         await asyncio.gather(*containers)
         await CephDevStackNetwork().remove()
         await SSHKeyPair().remove()
+        forget_loop_device_size(Path(config["data_dir"]))
+        # Let another cluster have our ports and loop devices
+        cluster.release()
+
+    def containers(self) -> List[Container]:
+        return [
+            object
+            for spec in self.service_specs.values()
+            if spec["count"] > 0
+            for object in spec["objects"]
+        ]
 
     async def watch(self):
         logger.info("Watching containers; will replace any that are stopped")
-        containers = []
-        for spec in self.service_specs.values():
-            if not spec["count"] > 0:
-                continue
-            for object in spec["objects"]:
-                containers.append(object)
+        containers = self.containers()
         logger.info(f"Watching {containers}")
+        locks: Dict[str, asyncio.Lock] = collections.defaultdict(asyncio.Lock)
+        interval = config["watch"]["reconcile_interval"]
+
+        async def reconcile(container: Container, event: Optional[Dict] = None):
+            if event:
+                snapshot.invalidate(container.kind)
+            async with locks[container.name]:
+                # Retired workers are no longer ours to replace
+                if container not in self.containers():
+                    return
+                await self.try_reconcile(container, event)
+
+        async def reconcile_all():
+            # A safety net for anything the event stream missed
+            while True:
+                snapshot.invalidate()
+                await asyncio.gather(*[reconcile(c) for c in self.containers()])
+                await asyncio.sleep(interval)
+
+        async def recreate_network(network: Network):
+            # Nothing can be replaced without it
+            logger.info(f"Network {network.name} was removed; recreating")
+            snapshot.invalidate()
+            try:
+                await network.create()
+            except CalledProcessError as e:
+                log_command_failure(e)
+            await asyncio.gather(*[reconcile(c) for c in self.containers()])
+
+        changed = asyncio.Event()
+        tasks = [
+            reconcile_all(),
+            self.watch_events(self.containers, reconcile, changed),
+            self.watch_network(recreate_network),
+        ]
+        teuthology = config["containers"]["teuthology"]
+        if "teuthology" in self.service_specs and teuthology.get(
+            "max_count", 1
+        ) > teuthology.get("count", 1):
+            tasks.append(WorkerScaler(self, locks, on_change=changed.set).run())
+        await asyncio.gather(*tasks)
+
+    async def watch_events(
+        self,
+        containers: Callable[[], List[Container]],
+        callback: Callable,
+        changed: Optional[asyncio.Event] = None,
+    ):
+        # podman only filters containers by exact name, so whenever the
+        # containers to watch change (i.e. as workers are scaled), subscribe
+        # afresh
+        changed = changed or asyncio.Event()
+        pending: Set[asyncio.Future] = set()
+
+        def handle(by_name: Dict[str, Container], event: Dict):
+            if event.get("Status") not in WATCH_EVENTS:
+                return
+            if container := by_name.get(event.get("Name", "")):
+                task = asyncio.ensure_future(callback(container, event))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+
         while True:
+            changed.clear()
+            by_name = {container.name: container for container in containers()}
+            filters = ["type=container"] + [f"container={name}" for name in by_name]
+            follow = asyncio.ensure_future(
+                self.follow_events(filters, functools.partial(handle, by_name))
+            )
+            wait_changed = asyncio.ensure_future(changed.wait())
             try:
-                for container in containers:
-                    with contextlib.suppress(CalledProcessError):
-                        if not await container.exists():
-                            logger.info(
-                                f"Container {container.name} was removed; replacing"
-                            )
-                            await container.create()
-                            await container.start()
-                        elif not await container.is_running():
-                            logger.info(
-                                f"Container {container.name} stopped; restarting"
-                            )
-                            await container.start()
-            except KeyboardInterrupt:
-                break
+                done, _ = await asyncio.wait(
+                    [follow, wait_changed], return_when=asyncio.FIRST_COMPLETED
+                )
+            finally:
+                follow.cancel()
+                wait_changed.cancel()
+            if follow in done:
+                # It only ends by raising
+                follow.result()
+
+    async def watch_network(self, callback: Callable):
+        # podman ANDs filters with different keys, and container events don't
+        # name networks, so the network needs its own subscription
+        network = CephDevStackNetwork()
+        filters = ["type=network", f"network={network.name}"]
+        pending: Set[asyncio.Future] = set()
+
+        def handle(event: Dict):
+            if event.get("Status") == "remove":
+                task = asyncio.ensure_future(callback(network))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+
+        await self.follow_events(filters, handle)
+
+    async def follow_events(self, filters: List[str], handle: Callable):
+        while True:
+            async for event in host.podman_events(filters):
+                handle(event)
+            logger.warning("podman events stream ended; reconnecting")
+            await asyncio.sleep(1)
+
+    async def try_reconcile(self, container: Container, event: Optional[Dict] = None):
+        # Failures mustn't end watch; they're logged, and the next reconcile
+        # tries again
+        try:
+            await self.reconcile(container, event)
+        except CalledProcessError as e:
+            log_command_failure(e)
+        except HealthCheckTimeout:
+            # wait_healthy has said why
+            logger.info(f"Will retry {container.name}")
+
+    async def reconcile(self, container: Container, event: Optional[Dict] = None):
+        if event and event.get("Status") == "health_status":
+            health = event.get("HealthStatus") or event.get("health_status", "")
+            if health != "unhealthy":
+                return
+            logger.info(f"Container {container.name} is unhealthy; restarting")
+            self.count_restart(container, "unhealthy")
+            await container.stop()
+            await container.start()
+            return
+        if not await container.exists():
+            logger.info(f"Container {container.name} was removed; replacing")
+            self.count_restart(container, "removed")
+            await container.create()
+            await container.start()
+        elif not await container.is_running():
+            logger.info(f"Container {container.name} stopped; restarting")
+            self.count_restart(container, "stopped")
+            await container.start()
+
+    def count_restart(self, container: Container, reason: str):
+        metrics.inc(
+            "watch_restarts_total", {"container": container.name, "reason": reason}
+        )
 
     async def wait(self, container_name: str):
         for spec in self.service_specs.values():
             for object in spec["objects"]:
-                if object.name == container_name:
+                if container_name in (object.name, object.base_name):
                     return await object.wait()
         logger.error(f"Could not find container {container_name}")
         return 1
 
     async def logs(
-        self, run_name: str = None, job_id: str = None, locate: bool = False
+        self,
+        run_name: str = None,
+        job_id: str = None,
+        locate: bool = False,
+        tail: Optional[int] = None,
+        follow: bool = False,
     ):
         try:
             log_file = self.get_log_file(run_name, job_id)
@@ -245,22 +583,90 @@ class CephDevStack:
             if locate:
                 print(log_file)
             else:
-                buffer_size = 8 * 1024
-                with open(log_file) as f:
-                    while chunk := f.read(buffer_size):
-                        print(chunk, end="")
+                await show_log(log_file, tail=tail, follow=follow)
 
-    def get_log_file(self, run_name: str = None, job_id: str = None):
-        archive_dir = Teuthology().archive_dir.expanduser()
+    async def status(self, watch: bool = False, interval: float = 5):
+        # Every refresh costs two podman calls, however many containers there
+        # are: one listing them all and one inspecting them all
+        clear = CLEAR_SCREEN if watch and sys.stdout.isatty() else ""
+        with self.archive_index() as index:
+            while True:
+                containers = self.containers() + await self.scaled_workers()
+                output = await render_status(containers, index)
+                print(clear + output, flush=True)
+                if not watch:
+                    return 0
+                await asyncio.sleep(interval)
+                snapshot.invalidate("container")
+                if not clear:
+                    print()
 
-        if not run_name:
-            run_name = get_most_recent_run(os.listdir(archive_dir))
-        run_dir = archive_dir.joinpath(run_name)
+    async def serve_metrics(self, bind: str, port: Optional[int] = None):
+        if port is None:
+            port = cluster.port(config["metrics"]["port"])
+        await serve_metrics(self, bind, port)
+
+    def archive_index(self) -> ArchiveIndex:
+        index = ArchiveIndex(
+            Path(config["data_dir"]).expanduser() / "archive.db",
+            Teuthology().archive_dir,
+        )
+        index.update()
+        return index
 
+    async def list_runs(self, limit: Optional[int] = None):
+        with self.archive_index() as index:
+            runs = index.runs(limit=limit)
+        for run in runs:
+            print(
+                f"{run['timestamp']}  {run['status']:<8} {run['jobs']:>4} jobs "
+                f"{run['size'] / 2**20:>9.1f} MiB  {run['name']}"
+            )
+
+    async def show_run(self, run_name: Optional[str] = None):
+        with self.archive_index() as index:
+            run_name = run_name or index.most_recent_run()
+            run = index.run(run_name) if run_name else None
+            jobs = index.jobs(run_name) if run else []
+        if not run:
+            logger.error("No such run found")
+            return 1
+        for key in ("name", "user", "timestamp", "status", "jobs"):
+            print(f"{key}: {run[key]}")
+        print(f"size: {run['size'] / 2**20:.1f} MiB")
+        for job in jobs:
+            print(f"  {job['job_id']:>6} {job['status']:<8} {job['log_path']}")
+
+    async def compact_archive(
+        self, older_than: str = "7d", format: str = "gz", jobs: Optional[int] = None
+    ):
+        try:
+            age = parse_age(older_than)
+        except ValueError as e:
+            logger.error(str(e))
+            return 1
+        with self.archive_index() as index:
+            compacted, reclaimed = index.compact(age, format, jobs)
+        logger.info(
+            f"Compressed {compacted} logs, reclaiming {reclaimed / 2**20:.1f} MiB"
+        )
+        return 0
+
+    def get_log_file(self, run_name: str = None, job_id: str = None):
+        with self.archive_index() as index:
+            if not run_name:
+                run_name = index.most_recent_run()
+                if not run_name:
+                    raise FileNotFoundError
+            job_ids = [job["job_id"] for job in index.jobs(run_name)]
+        archive_dir = Teuthology().archive_dir.expanduser()
         if not job_id:
-            job_id = get_job_id(os.listdir(run_dir))
+            # Only runs named like teuthology's are indexed
+            if not job_ids and archive_dir.joinpath(run_name).is_dir():
+                job_ids = os.listdir(archive_dir.joinpath(run_name))
+            job_id = get_job_id(job_ids)
 
-        log_file = run_dir.joinpath(job_id, "teuthology.log")
-        if not log_file.exists():
+        job_dir = archive_dir.joinpath(run_name, job_id)
+        if not (log_file := find_log(job_dir)):
             raise FileNotFoundError
         return log_file
@@ -0,0 +1,345 @@
+import concurrent.futures
+import gzip
+import os
+import re
+import shutil
+import sqlite3
+
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from ceph_devstack import logger
+
+from ceph_devstack.resources.ceph.logs import LOG_NAME, find_log
+from ceph_devstack.resources.ceph.utils import RUN_DIRNAME_PATTERN
+
+JOB_DIRNAME_PATTERN = re.compile(r"^\d+$")
+SUMMARY_SUCCESS_PATTERN = re.compile(rb"^success: (true|false)\s*$", re.MULTILINE)
+# Jobs (and runs) with these statuses aren't rescanned unless their
+# directories change
+FINISHED = ("pass", "fail")
+AGE_UNITS = {"m": 60, "h": 3600, "d": 86400, "w": 604800}
+COMPRESSION_FORMATS = ["gz", "zst"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS runs (
+    name TEXT PRIMARY KEY,
+    user TEXT,
+    timestamp TEXT,
+    mtime_ns INTEGER,
+    status TEXT,
+    jobs INTEGER DEFAULT 0,
+    size INTEGER DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS runs_timestamp ON runs (timestamp);
+CREATE TABLE IF NOT EXISTS jobs (
+    run TEXT REFERENCES runs (name) ON DELETE CASCADE,
+    job_id TEXT,
+    mtime_ns INTEGER,
+    status TEXT,
+    size INTEGER,
+    log_path TEXT,
+    PRIMARY KEY (run, job_id)
+);
+"""
+
+
+def job_status(job_dir: Path) -> str:
+    # teuthology writes summary.yaml when a job finishes
+    try:
+        summary = (job_dir / "summary.yaml").read_bytes()
+    except FileNotFoundError:
+        return "running"
+    except OSError:
+        return "unknown"
+    match = SUMMARY_SUCCESS_PATTERN.search(summary)
+    if not match:
+        return "unknown"
+    return "pass" if match.group(1) == b"true" else "fail"
+
+
+def run_status(statuses: List[str]) -> str:
+    if not statuses:
+        return "empty"
+    if "running" in statuses:
+        return "running"
+    if "fail" in statuses or "unknown" in statuses:
+        return "fail"
+    return "pass"
+
+
+def parse_age(age: str) -> timedelta:
+    # e.g. "30m", "12h", "7d" or "2w"
+    match = re.fullmatch(r"(\d+)([mhdw])", age.strip())
+    if not match:
+        raise ValueError(f"Invalid age '{age}'; expected e.g. 12h, 7d or 2w")
+    return timedelta(seconds=int(match.group(1)) * AGE_UNITS[match.group(2)])
+
+
+def compress_log(path: str, format: str) -> Tuple[str, int, int]:
+    # Runs in a worker process. The original is only removed once the
+    # compressed copy is complete, so an interruption loses nothing.
+    src = Path(path)
+    dst = src.with_name(f"{src.name}.{format}")
+    tmp = dst.with_name(f"{dst.name}.tmp")
+    st = src.stat()
+    with open(src, "rb") as fin:
+        if format == "gz":
+            with gzip.open(tmp, "wb", compresslevel=6) as fout:
+                shutil.copyfileobj(fin, fout, 2**20)
+        elif format == "zst":
+            import zstandard
+
+            with open(tmp, "wb") as fout:
+                zstandard.ZstdCompressor(level=10).copy_stream(fin, fout)
+        else:
+            raise ValueError(f"Unknown compression format: {format}")
+    os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+    os.replace(tmp, dst)
+    src.unlink()
+    return str(dst), st.st_size, dst.stat().st_size
+
+
+class ArchiveIndex:
+    # An index of the runs and jobs in the archive, kept in SQLite so that
+    # finding e.g. the most recent run doesn't mean listing, matching and
+    # parsing every run directory each time. update() brings it up to date
+    # incrementally: the run list is only re-read when the archive directory's
+    # mtime changes, a run's jobs only when its directory's mtime changes, and
+    # only unfinished jobs are rescanned. So a finished run which hasn't
+    # changed costs a single stat().
+    def __init__(self, db_path: Path, archive_dir: Path):
+        self.db_path = Path(db_path).expanduser()
+        self.archive_dir = Path(archive_dir).expanduser()
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(self.db_path, timeout=30)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA foreign_keys = ON")
+        with self.conn:
+            self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _get_meta(self, key: str) -> Optional[str]:
+        row = self.conn.execute(
+            "SELECT value FROM meta WHERE key = ?", (key,)
+        ).fetchone()
+        return row["value"] if row else None
+
+    def update(self):
+        try:
+            archive_mtime = str(os.stat(self.archive_dir).st_mtime_ns)
+        except FileNotFoundError:
+            with self.conn:
+                self.conn.execute("DELETE FROM runs")
+            return
+        with self.conn:
+            if archive_mtime != self._get_meta("archive_mtime"):
+                self._sync_runs()
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO meta VALUES ('archive_mtime', ?)",
+                    (archive_mtime,),
+                )
+            for row in self.conn.execute(
+                "SELECT name, mtime_ns, status FROM runs WHERE timestamp IS NOT NULL"
+            ).fetchall():
+                self._scan_run(row["name"], row["mtime_ns"], row["status"])
+
+    def _sync_runs(self):
+        names = {entry.name for entry in os.scandir(self.archive_dir) if entry.is_dir()}
+        known = {row[0] for row in self.conn.execute("SELECT name FROM runs")}
+        removed = known - names
+        self.conn.executemany(
+            "DELETE FROM runs WHERE name = ?", [(name,) for name in removed]
+        )
+        for name in names - known:
+            user = timestamp = None
+            # Names which aren't runs are still recorded, so that they aren't
+            # matched again; they have no timestamp, so are never the latest
+            if match := RUN_DIRNAME_PATTERN.search(name):
+                user = match.group("username")
+                timestamp = datetime.strptime(
+                    match.group("timestamp"), "%Y-%m-%d_%H:%M:%S"
+                ).isoformat()
+            self.conn.execute(
+                "INSERT INTO runs (name, user, timestamp) VALUES (?, ?, ?)",
+                (name, user, timestamp),
+            )
+
+    def _scan_run(self, name: str, known_mtime: Optional[int], status: Optional[str]):
+        run_dir = self.archive_dir / name
+        try:
+            mtime = os.stat(run_dir).st_mtime_ns
+        except FileNotFoundError:
+            self.conn.execute("DELETE FROM runs WHERE name = ?", (name,))
+            return
+        # A finished run whose directory hasn't changed has nothing new
+        if mtime == known_mtime and status in FINISHED:
+            return
+        if mtime != known_mtime:
+            job_ids = {
+                entry.name
+                for entry in os.scandir(run_dir)
+                if entry.is_dir() and JOB_DIRNAME_PATTERN.match(entry.name)
+            }
+            known = {
+                row[0]
+                for row in self.conn.execute(
+                    "SELECT job_id FROM jobs WHERE run = ?", (name,)
+                )
+            }
+            self.conn.executemany(
+                "DELETE FROM jobs WHERE run = ? AND job_id = ?",
+                [(name, job_id) for job_id in known - job_ids],
+            )
+            self.conn.executemany(
+                "INSERT INTO jobs (run, job_id, status) VALUES (?, ?, NULL)",
+                [(name, job_id) for job_id in job_ids - known],
+            )
+        for row in self.conn.execute(
+            "SELECT job_id FROM jobs WHERE run = ? AND "
+            "(status IS NULL OR status NOT IN (?, ?))",
+            (name, *FINISHED),
+        ).fetchall():
+            self._scan_job(name, row["job_id"])
+        self.conn.execute(
+            """
+            UPDATE runs SET
+                mtime_ns = ?,
+                jobs = (SELECT COUNT(*) FROM jobs WHERE run = ?),
+                size = (SELECT COALESCE(SUM(size), 0) FROM jobs WHERE run = ?)
+            WHERE name = ?
+            """,
+            (mtime, name, name, name),
+        )
+        statuses = [
+            row[0]
+            for row in self.conn.execute(
+                "SELECT status FROM jobs WHERE run = ?", (name,)
+            )
+        ]
+        self.conn.execute(
+            "UPDATE runs SET status = ? WHERE name = ?", (run_status(statuses), name)
+        )
+
+    def _scan_job(self, run: str, job_id: str):
+        job_dir = self.archive_dir / run / job_id
+        log_path = find_log(job_dir) or job_dir / LOG_NAME
+        try:
+            mtime = os.stat(job_dir).st_mtime_ns
+            size = os.stat(log_path).st_size
+        except FileNotFoundError:
+            mtime, size = None, 0
+        self.conn.execute(
+            "UPDATE jobs SET mtime_ns = ?, status = ?, size = ?, log_path = ? "
+            "WHERE run = ? AND job_id = ?",
+            (mtime, job_status(job_dir), size, str(log_path), run, job_id),
+        )
+
+    def most_recent_run(self) -> Optional[str]:
+        row = self.conn.execute(
+            "SELECT name FROM runs WHERE timestamp IS NOT NULL "
+            "ORDER BY timestamp DESC LIMIT 1"
+        ).fetchone()
+        return row["name"] if row else None
+
+    def runs(self, limit: Optional[int] = None) -> List[Dict]:
+        rows = self.conn.execute(
+            "SELECT * FROM runs WHERE timestamp IS NOT NULL "
+            "ORDER BY timestamp DESC LIMIT ?",
+            (-1 if limit is None else limit,),
+        )
+        return [dict(row) for row in rows]
+
+    def run(self, name: str) -> Optional[Dict]:
+        row = self.conn.execute("SELECT * FROM runs WHERE name = ?", (name,)).fetchone()
+        return dict(row) if row else None
+
+    def jobs(self, run: str) -> List[Dict]:
+        rows = self.conn.execute(
+            "SELECT * FROM jobs WHERE run = ? ORDER BY CAST(job_id AS INTEGER)",
+            (run,),
+        )
+        return [dict(row) for row in rows]
+
+    def summary(self) -> Dict:
+        # Counts of runs and jobs by status, and the total size of their logs
+        summary: Dict = {"size": 0, "runs": {}, "jobs": {}}
+        for row in self.conn.execute(
+            "SELECT status, COUNT(*), COALESCE(SUM(size), 0) FROM runs "
+            "WHERE timestamp IS NOT NULL GROUP BY status"
+        ):
+            summary["runs"][row[0]] = row[1]
+            summary["size"] += row[2]
+        for row in self.conn.execute(
+            "SELECT jobs.status, COUNT(*) FROM jobs JOIN runs ON runs.name = jobs.run "
+            "WHERE runs.timestamp IS NOT NULL GROUP BY jobs.status"
+        ):
+            summary["jobs"][row[0]] = row[1]
+        return summary
+
+    def compactable_logs(self, older_than: timedelta) -> List[Tuple[str, str, str]]:
+        # Logs of finished runs only; a run with anything still running may
+        # still be written to
+        cutoff = (datetime.now() - older_than).isoformat()
+        rows = self.conn.execute(
+            "SELECT jobs.run, jobs.job_id, jobs.log_path FROM jobs "
+            "JOIN runs ON runs.name = jobs.run "
+            "WHERE runs.status IN (?, ?) AND runs.timestamp < ? "
+            "AND jobs.log_path LIKE ?",
+            (*FINISHED, cutoff, f"%/{LOG_NAME}"),
+        )
+        return [(row["run"], row["job_id"], row["log_path"]) for row in rows]
+
+    def compact(
+        self,
+        older_than: timedelta,
+        format: str = "gz",
+        max_workers: Optional[int] = None,
+    ) -> Tuple[int, int]:
+        # Compress old logs in parallel, returning how many were compressed
+        # and how many bytes that reclaimed
+        logs = self.compactable_logs(older_than)
+        compacted = reclaimed = 0
+        if not logs:
+            return compacted, reclaimed
+        with concurrent.futures.ProcessPoolExecutor(max_workers) as pool:
+            futures = {
+                pool.submit(compress_log, log_path, format): (run, job_id)
+                for run, job_id, log_path in logs
+            }
+            for future in concurrent.futures.as_completed(futures):
+                run, job_id = futures[future]
+                try:
+                    log_path, before, after = future.result()
+                except (OSError, ValueError, ImportError) as e:
+                    logger.error(f"Could not compress the log of {run}/{job_id}: {e}")
+                    continue
+                compacted += 1
+                reclaimed += before - after
+                with self.conn:
+                    self.set_job_log(run, job_id, log_path, after)
+        return compacted, reclaimed
+
+    def set_job_log(self, run: str, job_id: str, log_path: str, size: int):
+        self.conn.execute(
+            "UPDATE jobs SET log_path = ?, size = ? WHERE run = ? AND job_id = ?",
+            (log_path, size, run, job_id),
+        )
+        self.conn.execute(
+            "UPDATE runs SET size = (SELECT COALESCE(SUM(size), 0) FROM jobs "
+            "WHERE run = ?) WHERE name = ?",
+            (run, run),
+        )
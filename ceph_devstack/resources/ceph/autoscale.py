@@ -0,0 +1,143 @@
+import asyncio
+import collections
+
+from subprocess import CalledProcessError
+from typing import Callable, Dict, List, Optional
+
+from ceph_devstack import config, logger
+from ceph_devstack.cluster import cluster
+from ceph_devstack.resources import log_command_failure
+from ceph_devstack.resources.exceptions import HealthCheckTimeout
+from ceph_devstack.resources.ceph.beanstalk import BeanstalkClient, DEFAULT_PORT
+from ceph_devstack.resources.ceph.containers import Teuthology
+from ceph_devstack.resources.ceph.exceptions import BeanstalkError
+
+
+def desired_workers(
+    stats: Dict, minimum: int, maximum: int, total_testnodes: int
+) -> int:
+    # One worker per queued or running job, but no more workers than there
+    # are testnodes. That's all of them, locked or not: a running job's
+    # worker holds its nodes' locks, so capping by the free ones would retire
+    # busy workers' share. It's a ceiling, not a check for free nodes.
+    wanted = int(stats.get("current-jobs-ready", 0)) + int(
+        stats.get("current-jobs-reserved", 0)
+    )
+    return max(minimum, min(wanted, maximum, max(total_testnodes, minimum)))
+
+
+class WorkerScaler:
+    # Adds teuthology workers while the beanstalk queue is deep, and retires
+    # the extra ones again once it drains. The configured count are always
+    # kept; extra workers are only retired while they aren't running a job.
+    def __init__(
+        self,
+        devstack,
+        locks: Optional[Dict[str, asyncio.Lock]] = None,
+        on_change: Optional[Callable[[], None]] = None,
+    ):
+        self.devstack = devstack
+        self.locks = (
+            locks if locks is not None else collections.defaultdict(asyncio.Lock)
+        )
+        # Called when workers are added or retired
+        self.on_change = on_change or (lambda: None)
+        self.client = BeanstalkClient(port=cluster.port(DEFAULT_PORT))
+
+    @property
+    def config(self) -> Dict:
+        return config["containers"]["teuthology"]
+
+    @property
+    def minimum(self) -> int:
+        return self.config.get("count", 1)
+
+    @property
+    def maximum(self) -> int:
+        return max(self.config.get("max_count", 1), self.minimum)
+
+    @property
+    def workers(self) -> List[Teuthology]:
+        return self.devstack.service_specs["teuthology"]["objects"]
+
+    @property
+    def total_testnodes(self) -> int:
+        spec = self.devstack.service_specs.get("testnode")
+        return len(spec["objects"]) if spec else 0
+
+    async def queue_stats(self) -> Optional[Dict]:
+        try:
+            return await self.client.stats_tube(self.config.get("tube", "testnode"))
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            logger.debug(f"Could not read beanstalk stats: {e!r}")
+        except BeanstalkError as e:
+            logger.debug(str(e))
+        await self.client.close()
+        return None
+
+    def next_worker_name(self) -> str:
+        names = {worker.base_name for worker in self.workers}
+        index = 1
+        while f"teuthology_{index}" in names:
+            index += 1
+        return f"teuthology_{index}"
+
+    async def scale(self):
+        stats = await self.queue_stats()
+        if stats is None:
+            return
+        current = len(self.workers)
+        wanted = desired_workers(
+            stats, self.minimum, self.maximum, self.total_testnodes
+        )
+        if wanted > current:
+            await self.add_workers(wanted - current)
+        elif wanted < current:
+            await self.retire_workers(current - wanted)
+
+    async def add_workers(self, count: int):
+        new = []
+        for _ in range(count):
+            worker = Teuthology(name=self.next_worker_name())
+            self.workers.append(worker)
+            new.append(worker)
+        self.on_change()
+        logger.info(f"Queue is deep; adding workers {[w.name for w in new]}")
+
+        async def add(worker: Teuthology):
+            async with self.locks[worker.name]:
+                # If this fails, watch will try again
+                try:
+                    await worker.create()
+                    await worker.start()
+                except CalledProcessError as e:
+                    log_command_failure(e)
+                except HealthCheckTimeout:
+                    # Already logged
+                    pass
+
+        await asyncio.gather(*[add(worker) for worker in new])
+
+    async def retire_workers(self, count: int):
+        # Newest first, and never the configured ones
+        for worker in reversed(self.workers[self.minimum :]):
+            if count == 0:
+                break
+            async with self.locks[worker.name]:
+                if not await worker.is_idle():
+                    continue
+                logger.info(f"Queue has drained; retiring worker {worker.name}")
+                # Stop watching it before it goes, so it isn't replaced
+                self.workers.remove(worker)
+                self.on_change()
+                await worker.remove()
+            count -= 1
+
+    async def run(self):
+        interval = config["watch"]["scale_interval"]
+        logger.info(
+            f"Scaling teuthology workers between {self.minimum} and {self.maximum}"
+        )
+        while True:
+            await self.scale()
+            await asyncio.sleep(interval)
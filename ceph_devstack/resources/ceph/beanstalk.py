@@ -0,0 +1,74 @@
+import asyncio
+
+from typing import Dict, Optional, Tuple, Union
+
+from ceph_devstack.resources.ceph.exceptions import BeanstalkError
+
+DEFAULT_PORT = 11300
+
+
+def parse_stats(body: bytes) -> Dict[str, Union[int, str]]:
+    # Stats come as a flat YAML mapping; there's no need for a YAML parser
+    stats: Dict[str, Union[int, str]] = {}
+    for line in body.decode().splitlines():
+        key, sep, value = line.partition(":")
+        if not sep:
+            continue
+        value = value.strip()
+        stats[key.strip()] = int(value) if value.isdigit() else value
+    return stats
+
+
+class BeanstalkClient:
+    # Just enough of the beanstalkd protocol to watch a tube's queue. See
+    # https://github.com/beanstalkd/beanstalkd/blob/master/doc/protocol.txt
+    def __init__(
+        self, host: str = "localhost", port: int = DEFAULT_PORT, timeout: float = 5
+    ):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), self.timeout
+        )
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            await self.writer.wait_closed()
+            self.reader = self.writer = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def command(self, line: str) -> Tuple[str, Optional[bytes]]:
+        if self.writer is None or self.reader is None:
+            await self.connect()
+        assert self.writer is not None and self.reader is not None
+        self.writer.write(line.encode() + b"\r\n")
+        await self.writer.drain()
+        response = await asyncio.wait_for(self.reader.readuntil(b"\r\n"), self.timeout)
+        status, *args = response.decode().split()
+        if status != "OK":
+            return status, None
+        body = await asyncio.wait_for(
+            self.reader.readexactly(int(args[0]) + 2), self.timeout
+        )
+        return status, body[:-2]
+
+    async def stats_tube(self, tube: str) -> Dict[str, Union[int, str]]:
+        status, body = await self.command(f"stats-tube {tube}")
+        # Tubes only exist while something uses them; no tube means no jobs
+        if status == "NOT_FOUND":
+            return {"name": tube, "current-jobs-ready": 0, "current-jobs-reserved": 0}
+        if status != "OK" or body is None:
+            raise BeanstalkError(f"stats-tube {tube} failed: {status}")
+        return parse_stats(body)
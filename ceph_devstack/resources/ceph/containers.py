@@ -1,15 +1,114 @@
+import asyncio
+import base64
+import json
 import os
+import shlex
 import sys
+import tempfile
 
 from pathlib import Path
-from typing import List
+from subprocess import CalledProcessError
+from typing import Dict, List, Set, Tuple
 
-from ceph_devstack import config, DEFAULT_CONFIG_PATH
-from ceph_devstack.host import host
+from ceph_devstack import config, logger, DEFAULT_CONFIG_PATH, PROJECT_ROOT
+from ceph_devstack.capacity import loop_img_dir
+from ceph_devstack.cluster import cluster
+from ceph_devstack.host import host, local_host
 from ceph_devstack.resources.container import Container
+from ceph_devstack.topology import format_cpulist, host_partition
+from ceph_devstack.trace import traced
 
 
 ARCHIVE_MOUNT_SUFFIX = "" if sys.platform == "darwin" else ":z"
+READ_ONLY_MOUNT_SUFFIX = ":ro" if sys.platform == "darwin" else ":ro,z"
+LOOP_HELPER_PATH = PROJECT_ROOT / "loop_helper.py"
+ARCHIVE_SERVER_PATH = PROJECT_ROOT / "archive_server.py"
+# With cpuset = "auto", testnodes' IO to their loop devices is weighted above
+# other containers', whose weight is the default of 100 (of 10 to 1000)
+DEFAULT_LOOP_DEVICE_WEIGHT = 500
+
+
+class LoopDeviceProvisioner:
+    # Setting up a loop device needs root. Rather than running several sudo
+    # commands per device, requests made at around the same time (e.g. by all
+    # testnodes being created concurrently) are gathered into a manifest and
+    # handled by a single privileged invocation of loop_helper.py.
+    delay = 0.1
+
+    def __init__(self):
+        self._pending: Dict[str, List[Tuple[List[Dict], asyncio.Future]]] = {}
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def run(self, action: str, devices: List[Dict]):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        batch = self._pending.setdefault(action, [])
+        batch.append((devices, future))
+        if len(batch) == 1:
+            loop.call_later(self.delay, self._schedule_flush, action)
+        await future
+
+    def _schedule_flush(self, action: str):
+        task = asyncio.ensure_future(self._flush(action))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _flush(self, action: str):
+        batch = self._pending.pop(action, [])
+        devices = [device for devices, _ in batch for device in devices]
+        try:
+            await self.run_helper(action, devices)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for _, future in batch:
+                if not future.done():
+                    future.set_result(None)
+
+    @traced
+    async def run_helper(self, action: str, devices: List[Dict]):
+        manifest = {"uid": os.getuid(), "gid": os.getgid(), "devices": devices}
+        logger.debug(f"Loop devices: {action} {[d['device'] for d in devices]}")
+        if host is not local_host:
+            args = remote_helper_args(action, manifest)
+            proc = await host.arun(args)
+            _, err = await proc.communicate()
+        else:
+            with tempfile.NamedTemporaryFile(
+                "w", prefix="ceph-devstack-loop-", suffix=".json", delete=False
+            ) as f:
+                json.dump(manifest, f)
+            args = ["sudo", sys.executable, str(LOOP_HELPER_PATH), action, f.name]
+            try:
+                proc = await host.arun(args)
+                _, err = await proc.communicate()
+            finally:
+                os.unlink(f.name)
+        if proc.returncode:
+            raise CalledProcessError(
+                cmd=args, returncode=proc.returncode, stderr=err.decode()
+            )
+
+
+def remote_helper_args(action: str, manifest: Dict) -> List[str]:
+    # When podman runs in a VM, the loop devices are the VM's, but it has
+    # neither our interpreter nor our files; so the helper and its manifest
+    # are sent on the command line. ssh hands that to a shell, so it's quoted.
+    source = base64.b64encode(LOOP_HELPER_PATH.read_bytes()).decode()
+    code = f"import base64; exec(base64.b64decode('{source}'))"
+    return [
+        "sudo",
+        "python3",
+        "-c",
+        shlex.quote(code),
+        action,
+        shlex.quote(json.dumps(manifest)),
+    ]
+
+
+loop_device_provisioner = LoopDeviceProvisioner()
 
 
 class Postgres(Container):
@@ -19,7 +118,7 @@ class Postgres(Container):
         "create",
         "-i",
         "--network",
-        "ceph-devstack",
+        "{network}",
         "-p",
         "5432:5432",
         "--health-cmd",
@@ -60,7 +159,7 @@ class Beanstalk(Container):
         "create",
         "-i",
         "--network",
-        "ceph-devstack",
+        "{network}",
         "-p",
         "11300:11300",
         "--name",
@@ -70,13 +169,14 @@ class Beanstalk(Container):
 
 
 class Paddles(Container):
+    depends_on = ["postgres"]
     create_cmd = [
         "podman",
         "container",
         "create",
         "-i",
         "--network",
-        "ceph-devstack",
+        "{network}",
         "-p",
         "8080:8080",
         "--health-cmd",
@@ -93,33 +193,46 @@ class Paddles(Container):
     ]
     env_vars = {
         "PADDLES_SERVER_HOST": "0.0.0.0",
-        "PADDLES_JOB_LOG_HREF_TEMPL": f"http://{host.hostname()}:8000"
-        "/{run_name}/{job_id}/teuthology.log",
+        # Defaults to one using our hostname; see add_env_to_args()
+        "PADDLES_JOB_LOG_HREF_TEMPL": None,
     }
 
+    def add_env_to_args(self, args: List):
+        # Looking up our hostname can be slow, so wait until it's needed
+        if not self.env_vars.get("PADDLES_JOB_LOG_HREF_TEMPL"):
+            self.env_vars["PADDLES_JOB_LOG_HREF_TEMPL"] = (
+                f"http://{host.hostname()}:{cluster.port(8000)}"
+                "/{run_name}/{job_id}/teuthology.log"
+            )
+        return super().add_env_to_args(args)
+
 
 class Archive(Container):
-    cmd_vars: List[str] = ["name", "image", "archive_dir"]
+    cmd_vars: List[str] = ["name", "image", "network", "archive_dir", "server_path"]
     create_cmd = [
         "podman",
         "container",
         "create",
         "-i",
         "--network",
-        "ceph-devstack",
+        "{network}",
         "-p",
         "8000:8000",
         "-v",
         "{archive_dir}:/archive" + ARCHIVE_MOUNT_SUFFIX,
+        "-v",
+        "{server_path}:/usr/local/bin/archive_server.py" + READ_ONLY_MOUNT_SUFFIX,
         "--name",
         "{name}",
         "{image}",
         "python3",
-        "-m",
-        "http.server",
-        "-d",
+        "/usr/local/bin/archive_server.py",
+        "--port",
+        "8000",
+        "--directory",
         "/archive",
     ]
+    server_path = ARCHIVE_SERVER_PATH
 
     @property
     def archive_dir(self):
@@ -127,13 +240,14 @@ class Archive(Container):
 
 
 class Pulpito(Container):
+    depends_on = ["paddles"]
     create_cmd = [
         "podman",
         "container",
         "create",
         "-i",
         "--network",
-        "ceph-devstack",
+        "{network}",
         "-p",
         "8081:8081",
         "--health-cmd",
@@ -154,7 +268,7 @@ class Pulpito(Container):
 
 
 class TestNode(Container):
-    cmd_vars: List[str] = ["name", "image"]
+    cmd_vars: List[str] = ["name", "image", "network"]
     capabilities = [
         "SYS_ADMIN",
         "NET_ADMIN",
@@ -178,8 +292,8 @@ class TestNode(Container):
     def __init__(self, name: str = ""):
         super().__init__(name=name)
         self.index = 0
-        if "_" in self.name:
-            self.index = int(self.name.split("_")[-1])
+        if "_" in self.base_name:
+            self.index = int(self.base_name.split("_")[-1])
         self.loop_device_count = config["containers"]["testnode"].get(
             "loop_device_count", 1
         )
@@ -187,7 +301,7 @@ class TestNode(Container):
 
     @property
     def loop_img_dir(self):
-        return (Path(config["data_dir"]) / "disk_images").expanduser()
+        return loop_img_dir(config["data_dir"])
 
     @property
     def create_cmd(self):
@@ -198,11 +312,11 @@ class TestNode(Container):
             "--rm",
             "-i",
             "--network",
-            "ceph-devstack",
+            "{network}",
             "--systemd=always",
             "--cgroupns=host",
             "--secret",
-            "id_rsa.pub",
+            cluster.secret_arg("id_rsa.pub"),
             "-p",
             "22",
             "--cap-add",
@@ -239,6 +353,27 @@ class TestNode(Container):
             "{image}",
         ]
 
+    def resource_args(self) -> List[str]:
+        args = super().resource_args()
+        if self.config.get("cpuset") != "auto":
+            return args
+        # Each testnode gets its own CPUs and NUMA node, and the same share
+        # of IO on its loop devices
+        if host is not local_host:
+            logger.warning(f"{self.name}: cpuset = auto needs a local podman")
+            return args
+        partition = host_partition(config["containers"]["testnode"]["count"])
+        cpus, node = partition[self.index % len(partition)]
+        # The node chosen here replaces any configured cpuset_mems
+        if "--cpuset-mems" in args:
+            i = args.index("--cpuset-mems")
+            del args[i : i + 2]
+        args += ["--cpuset-cpus", format_cpulist(cpus), "--cpuset-mems", str(node)]
+        weight = self.config.get("blkio_weight") or DEFAULT_LOOP_DEVICE_WEIGHT
+        for device in self.devices:
+            args += ["--blkio-weight-device", f"{device}:{weight}"]
+        return args
+
     @property
     def additional_volumes(self):
         volumes = []
@@ -264,79 +399,58 @@ class TestNode(Container):
         await super().remove()
         await self.remove_loop_devices()
 
+    def loop_device_manifest(self) -> List[Dict]:
+        testnode_config = config["containers"]["testnode"]
+        options = {
+            "size": testnode_config["loop_device_size"],
+            "pool": testnode_config.get("loop_image_pool", False),
+            "preallocate": testnode_config.get("loop_image_preallocate", False),
+        }
+        if golden := testnode_config.get("loop_image_golden"):
+            options["golden"] = os.path.expanduser(golden)
+        return [
+            {
+                "device": device,
+                "image": os.path.join(self.loop_img_dir, self.device_image(device)),
+                **options,
+            }
+            for device in self.devices
+        ]
+
+    @traced
     async def create_loop_devices(self):
-        for device in self.devices:
-            await self.create_loop_device(device)
+        os.makedirs(self.loop_img_dir, exist_ok=True)
+        await loop_device_provisioner.run("setup", self.loop_device_manifest())
 
+    @traced
     async def remove_loop_devices(self):
-        for device in self.devices:
-            await self.remove_loop_device(device)
-
-    async def create_loop_device(self, device: str):
-        size = config["containers"]["testnode"]["loop_device_size"]
-        os.makedirs(self.loop_img_dir, exist_ok=True)
-        proc = await self.cmd(["lsmod", "|", "grep", "loop"])
-        if proc and await proc.wait() != 0:
-            await self.cmd(["sudo", "modprobe", "loop"])
-        loop_img_name = os.path.join(self.loop_img_dir, self.device_image(device))
-        await self.remove_loop_device(device)
-        device_pos = device.removeprefix("/dev/loop")
-        await self.cmd(
-            [
-                "sudo",
-                "mknod",
-                "-m700",
-                device,
-                "b",
-                "7",
-                device_pos,
-            ],
-            check=True,
-        )
-        await self.cmd(
-            ["sudo", "chown", f"{os.getuid()}:{os.getgid()}", device],
-            check=True,
-        )
-        await self.cmd(
-            [
-                "sudo",
-                "dd",
-                "if=/dev/null",
-                f"of={loop_img_name}",
-                "bs=1",
-                "count=0",
-                f"seek={size}",
-            ],
-            check=True,
-        )
-        await self.cmd(["sudo", "losetup", device, loop_img_name], check=True)
-        await self.cmd(["chcon", "-t", "fixed_disk_device_t", device])
-
-    async def remove_loop_device(self, device: str):
-        loop_img_name = os.path.join(self.loop_img_dir, self.device_image(device))
-        if os.path.ismount(device):
-            await self.cmd(["umount", device], check=True)
-        if host.path_exists(device):
-            await self.cmd(["sudo", "losetup", "-d", device])
-            await self.cmd(["sudo", "rm", "-f", device], check=True)
-        if host.path_exists(loop_img_name):
-            os.remove(loop_img_name)
+        await loop_device_provisioner.run("teardown", self.loop_device_manifest())
 
     def device_name(self, index: int):
-        return f"/dev/loop{self.loop_device_count * self.index + index}"
+        offset = cluster.loop_device_offset
+        return f"/dev/loop{offset + self.loop_device_count * self.index + index}"
 
     def device_image(self, device: str):
         return f"{self.name}-{device.removeprefix('/dev/loop')}"
 
 
 class Teuthology(Container):
-    cmd_vars: List[str] = ["name", "image", "image_tag", "archive_dir"]
+    cmd_vars: List[str] = [
+        "name",
+        "service_name",
+        "base_name",
+        "image",
+        "image_tag",
+        "network",
+        "archive_dir",
+    ]
+    depends_on = ["paddles", "beanstalk", "testnode"]
 
     build_cmd: List[str] = [
         "podman",
         "build",
         "-t",
-        "{name}:{image_tag}",
+        "{service_name}:{image_tag}",
         "-f",
         "./containers/teuthology-dev/Dockerfile",
         ".",
@@ -352,9 +466,9 @@ class Teuthology(Container):
             "--label",
             f"testnode_count={config['containers']['testnode']['count']}",
             "--network",
-            "ceph-devstack",
+            "{network}",
             "--secret",
-            "id_rsa",
+            cluster.secret_arg("id_rsa"),
             "-v",
             "{archive_dir}:/archive_dir" + ARCHIVE_MOUNT_SUFFIX,
         ]
@@ -409,6 +523,15 @@ class Teuthology(Container):
         "TEUTHOLOGY_SUITE_EXTRA_ARGS": "",
     }
 
+    # Processes which mean a worker is running a job
+    job_process_names = ["teuthology-supervisor"]
+
+    def __init__(self, name: str = ""):
+        super().__init__(name)
+        # Only the first worker schedules the suite; the rest just run jobs
+        if "_" in self.base_name and int(self.base_name.split("_")[-1]) > 0:
+            self.env_vars["TEUTHOLOGY_SUITE"] = "none"
+
     @property
     def archive_dir(self):
         return Path(config["data_dir"]) / "archive"
@@ -416,3 +539,11 @@ class Teuthology(Container):
     async def create(self):
         self.archive_dir.expanduser().resolve().mkdir(parents=True, exist_ok=True)
         await super().create()
+
+    async def is_idle(self) -> bool:
+        proc = await self.cmd(["podman", "top", self.name, "args"])
+        out, _ = await proc.communicate()
+        if proc.returncode:
+            # Not running, so not running anything
+            return True
+        return not any(name.encode() in out for name in self.job_process_names)
@@ -1,3 +1,7 @@
 class TooManyJobsFound(Exception):
     def __init__(self, jobs: list[str]):
         self.jobs = jobs
+
+
+class BeanstalkError(Exception):
+    pass
@@ -0,0 +1,165 @@
+import asyncio
+import os
+import time
+
+from typing import List, Optional, Tuple
+
+from ceph_devstack import config, logger
+from ceph_devstack.host import host, local_host
+from ceph_devstack.metrics import Family, metrics, render
+from ceph_devstack.resources.ceph.containers import TestNode
+from ceph_devstack.resources.ceph.status import health_status, loop_backing_file
+from ceph_devstack.resources.snapshot import snapshot
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+MAX_REQUEST_BYTES = 16 * 1024
+
+
+class Exporter:
+    # Serves the devstack's metrics for Prometheus to scrape. Collecting them
+    # costs two podman calls (one listing every container, one inspecting
+    # them all) plus some stat()s, whatever the number of containers; the
+    # result is cached for cache_seconds, and concurrent scrapes share one
+    # collection. Updating the archive index is done in a thread, so as not
+    # to hold up other requests.
+    def __init__(self, devstack, cache_seconds: float = 15):
+        self.devstack = devstack
+        self.cache_seconds = cache_seconds
+        self._body: Optional[bytes] = None
+        self._collected_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def body(self) -> bytes:
+        async with self._lock:
+            if (
+                self._body is None
+                or time.monotonic() - self._collected_at >= self.cache_seconds
+            ):
+                snapshot.invalidate("container")
+                started_at = time.monotonic()
+                families = await self.collect()
+                scrape = Family(
+                    "collect_duration_seconds",
+                    "gauge",
+                    "How long collecting these metrics took",
+                )
+                scrape.add(time.monotonic() - started_at)
+                self._body = render(families + [scrape]).encode()
+                self._collected_at = time.monotonic()
+            return self._body
+
+    async def collect(self) -> List[Family]:
+        containers = self.devstack.containers() + await self.devstack.scaled_workers()
+        return (
+            await self.container_families(containers)
+            + self.loop_device_families(containers)
+            + await asyncio.to_thread(self.archive_families)
+            + metrics.families()
+        )
+
+    async def container_families(self, containers) -> List[Family]:
+        state = Family(
+            "container_state", "gauge", "The state of each container, as a label"
+        )
+        healthy = Family(
+            "container_healthy",
+            "gauge",
+            "Whether each container with a healthcheck is healthy",
+        )
+        restarts = Family(
+            "container_restarts", "gauge", "How many times podman restarted each"
+        )
+        listing = await snapshot.get("container")
+        details = await asyncio.gather(*[c.inspect() for c in containers])
+        for container, detail in zip(containers, details, strict=True):
+            entry = listing.get(container.name)
+            status = entry.get("State", "unknown").lower() if entry else "missing"
+            state.add(1, container=container.name, state=status)
+            if not detail:
+                continue
+            restarts.add(detail[0].get("RestartCount", 0), container=container.name)
+            if (health := health_status(detail[0])) != "-":
+                healthy.add(int(health == "healthy"), container=container.name)
+        return [state, healthy, restarts]
+
+    def loop_device_families(self, containers) -> List[Family]:
+        attached = Family(
+            "loop_device_attached", "gauge", "Whether each loop device is attached"
+        )
+        image_bytes = Family(
+            "loop_image_bytes",
+            "gauge",
+            "Size of each loop device's backing image: apparent, and allocated",
+        )
+        for container in containers:
+            if not isinstance(container, TestNode):
+                continue
+            for device in container.loop_device_manifest():
+                labels = {"container": container.name, "device": device["device"]}
+                # sysfs is only ours to read when podman runs on this machine
+                if host is local_host:
+                    backing_file = loop_backing_file(device["device"])
+                    attached.add(int(bool(backing_file)), **labels)
+                try:
+                    st = os.stat(device["image"])
+                except OSError:
+                    continue
+                image_bytes.add(st.st_size, kind="apparent", **labels)
+                image_bytes.add(st.st_blocks * 512, kind="allocated", **labels)
+        return [attached, image_bytes]
+
+    def archive_families(self) -> List[Family]:
+        size = Family("archive_log_bytes", "gauge", "Size of the archived logs")
+        runs = Family("archive_runs", "gauge", "Archived runs, by status")
+        jobs = Family("archive_jobs", "gauge", "Archived jobs, by status")
+        with self.devstack.archive_index() as index:
+            summary = index.summary()
+        size.add(summary["size"])
+        for status, count in sorted(summary["runs"].items()):
+            runs.add(count, status=str(status))
+        for status, count in sorted(summary["jobs"].items()):
+            jobs.add(count, status=str(status))
+        return [size, runs, jobs]
+
+    async def response(self) -> Tuple[str, bytes, str]:
+        try:
+            return "200 OK", await self.body(), CONTENT_TYPE
+        except Exception as e:
+            # e.g. podman or the archive index failing; the scrape fails,
+            # rather than the connection
+            logger.error(f"Could not collect metrics: {e!r}")
+            return "500 Internal Server Error", b"", "text/plain"
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await reader.readuntil(b"\r\n\r\n")
+            method, target, _ = request.decode("latin-1").split(" ", 2)
+            if method != "GET" or target.split("?")[0] not in ("/", "/metrics"):
+                status, body, content_type = "404 Not Found", b"", "text/plain"
+            else:
+                status, body, content_type = await self.response()
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode()
+                + body
+            )
+            await writer.drain()
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.LimitOverrunError:
+            writer.write(b"HTTP/1.1 400 Bad Request\r\nConnection: close\r\n\r\n")
+        finally:
+            writer.close()
+
+    async def serve(self, bind: str, port: int):
+        server = await asyncio.start_server(
+            self.handle, bind, port, limit=MAX_REQUEST_BYTES
+        )
+        logger.info(f"Serving metrics at http://{bind}:{port}/metrics")
+        async with server:
+            await server.serve_forever()
+
+
+async def serve_metrics(devstack, bind: str, port: int):
+    exporter = Exporter(devstack, config["metrics"]["cache_seconds"])
+    await exporter.serve(bind, port)
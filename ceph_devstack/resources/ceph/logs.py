@@ -0,0 +1,251 @@
+import asyncio
+import codecs
+import collections
+import contextlib
+import ctypes
+import ctypes.util
+import gzip
+import io
+import os
+import struct
+import sys
+
+from pathlib import Path
+from typing import BinaryIO, Optional
+
+from ceph_devstack import logger
+
+BLOCK_SIZE = 64 * 1024
+IN_MODIFY = 0x00000002
+IN_MOVE_SELF = 0x00000800
+IN_DELETE_SELF = 0x00000400
+IN_NONBLOCK = 0o4000
+# wd, mask, cookie, len; followed by len bytes of name
+INOTIFY_EVENT = struct.Struct("iIII")
+IN_CLOEXEC = 0o2000000
+POLL_INTERVAL = 1.0
+LOG_NAME = "teuthology.log"
+# Old logs may have been compressed by `archive compact`
+COMPRESSED_SUFFIXES = [".gz", ".zst"]
+
+
+def find_log(job_dir: Path) -> Optional[Path]:
+    for suffix in [""] + COMPRESSED_SUFFIXES:
+        path = job_dir / (LOG_NAME + suffix)
+        if path.exists():
+            return path
+    return None
+
+
+def open_log(path: Path) -> BinaryIO:
+    # Decompresses as it's read, so nothing is held in memory or on disk
+    if path.suffix == ".gz":
+        return gzip.open(path, "rb")  # type: ignore[return-value]
+    if path.suffix == ".zst":
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError(
+                f"Reading {path} requires zstandard. Try: pip install zstandard"
+            ) from None
+        f = open(path, "rb")  # noqa: SIM115 - closed along with the reader
+        reader = zstandard.ZstdDecompressor().stream_reader(f)
+        # For readline(), which tailing needs
+        return io.BufferedReader(reader, BLOCK_SIZE)  # type: ignore[arg-type]
+    return open(path, "rb")
+
+
+def tail_offset(path: Path, lines: int) -> int:
+    # Where the last `lines` lines of the file start, found by reading
+    # backwards from the end rather than through the whole file
+    with open(path, "rb") as f:
+        end = f.seek(0, os.SEEK_END)
+        if lines <= 0:
+            return end
+        pos = end
+        # A trailing newline ends the last line; it doesn't start a new one
+        f.seek(max(end - 1, 0))
+        newlines = -1 if f.read(1) == b"\n" else 0
+        while pos > 0:
+            size = min(BLOCK_SIZE, pos)
+            pos -= size
+            f.seek(pos)
+            block = f.read(size)
+            newlines += block.count(b"\n")
+            if newlines >= lines:
+                # Newlines are numbered from the end; find the one which
+                # precedes the lines we want, counting from the block's start
+                index = -1
+                for _ in range(newlines - lines + 1):
+                    index = block.index(b"\n", index + 1)
+                return pos + index + 1
+        return 0
+
+
+def stdout_fd() -> Optional[int]:
+    try:
+        return sys.stdout.fileno()
+    except (AttributeError, ValueError, io.UnsupportedOperation):
+        return None
+
+
+class LogWriter:
+    # Copies ranges of a log file to stdout. When stdout is a real file, pipe
+    # or terminal, the kernel does the copying via sendfile(); otherwise (e.g.
+    # when stdout has been redirected within Python) the data is decoded and
+    # written, taking care not to split multi-byte characters.
+    def __init__(self):
+        self.fd = stdout_fd()
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def write(self, path: Path, offset: int = 0) -> int:
+        with open(path, "rb") as f:
+            end = os.fstat(f.fileno()).st_size
+            if self.fd is not None and hasattr(os, "sendfile"):
+                sys.stdout.flush()
+                try:
+                    return self._sendfile(f.fileno(), offset, end)
+                except OSError as e:
+                    logger.debug(f"sendfile() failed ({e}); copying instead")
+                    self.fd = None
+            f.seek(offset)
+            while offset < end:
+                chunk = f.read(min(BLOCK_SIZE, end - offset))
+                if not chunk:
+                    break
+                offset += len(chunk)
+                sys.stdout.write(self.decoder.decode(chunk))
+            sys.stdout.flush()
+            return offset
+
+    def _sendfile(self, in_fd: int, offset: int, end: int) -> int:
+        assert self.fd is not None
+        while offset < end:
+            sent = os.sendfile(self.fd, in_fd, offset, end - offset)
+            if sent == 0:
+                break
+            offset += sent
+        return offset
+
+
+class FileWatcher:
+    # Waits for a file to change, via inotify where available and polling
+    # otherwise. A watch follows the file rather than its path, so once the
+    # file is moved or deleted (e.g. rotated), the path is polled until it
+    # can be watched again.
+    def __init__(self, path: Path):
+        self.path = path
+        self.fd: Optional[int] = None
+        self.wd = -1
+        self.changed = asyncio.Event()
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+            self.fd = fd
+            if not self._add_watch():
+                self.fd = None
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+            asyncio.get_running_loop().add_reader(fd, self._read_events)
+        except (OSError, AttributeError, TypeError) as e:
+            logger.debug(f"inotify unavailable ({e}); polling {path}")
+
+    def _add_watch(self) -> bool:
+        mask = IN_MODIFY | IN_MOVE_SELF | IN_DELETE_SELF
+        self.wd = self.libc.inotify_add_watch(self.fd, str(self.path).encode(), mask)
+        return self.wd >= 0
+
+    def _read_events(self):
+        assert self.fd is not None
+        try:
+            data = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return
+        # Every event we watch for means there may be something to do
+        if data:
+            self.changed.set()
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size + length
+            if wd == self.wd and mask & (IN_MOVE_SELF | IN_DELETE_SELF):
+                # A deleted file's watch goes with it; a moved one's doesn't
+                if mask & IN_MOVE_SELF:
+                    self.libc.inotify_rm_watch(self.fd, wd)
+                self.wd = -1
+
+    async def wait(self):
+        if self.fd is None:
+            await asyncio.sleep(POLL_INTERVAL)
+            return
+        if self.wd < 0:
+            await asyncio.sleep(POLL_INTERVAL)
+            self._add_watch()
+            return
+        await self.changed.wait()
+        self.changed.clear()
+
+    def close(self):
+        if self.fd is not None:
+            asyncio.get_running_loop().remove_reader(self.fd)
+            os.close(self.fd)
+            self.fd = None
+
+
+def show_compressed_log(path: Path, tail: Optional[int] = None):
+    # Compressed streams can't be read backwards, so tailing means reading
+    # through, keeping only the last lines
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    with open_log(path) as f:
+        if tail is not None:
+            lines = collections.deque(f, maxlen=max(tail, 0))
+            sys.stdout.write(decoder.decode(b"".join(lines), final=True))
+        else:
+            while chunk := f.read(BLOCK_SIZE):
+                sys.stdout.write(decoder.decode(chunk))
+            sys.stdout.write(decoder.decode(b"", final=True))
+    sys.stdout.flush()
+
+
+async def show_log(path: Path, tail: Optional[int] = None, follow: bool = False):
+    if path.suffix in COMPRESSED_SUFFIXES:
+        if follow:
+            logger.info(f"{path} is compressed, so is complete; not following")
+        show_compressed_log(path, tail)
+        return
+    offset = tail_offset(path, tail) if tail is not None else 0
+    writer = LogWriter()
+    if not follow:
+        writer.write(path, offset)
+        return
+    await follow_log(path, offset, writer)
+
+
+async def follow_log(path: Path, offset: int, writer: LogWriter):
+    watcher = FileWatcher(path)
+    inode: Optional[int] = os.stat(path).st_ino
+    try:
+        while True:
+            try:
+                st: Optional[os.stat_result] = os.stat(path)
+            except FileNotFoundError:
+                st = None
+            if st is None:
+                if inode is not None:
+                    logger.info(f"{path} was moved or removed; waiting for it")
+                    inode = None
+            else:
+                if st.st_ino != inode:
+                    if inode is not None:
+                        logger.info(f"{path} was replaced")
+                    inode, offset = st.st_ino, 0
+                elif st.st_size < offset:
+                    logger.info(f"{path} was truncated")
+                    offset = 0
+                with contextlib.suppress(FileNotFoundError):
+                    offset = writer.write(path, offset)
+            await watcher.wait()
+    finally:
+        watcher.close()
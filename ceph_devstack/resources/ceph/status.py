@@ -0,0 +1,115 @@
+import asyncio
+import os
+import time
+
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from ceph_devstack.host import host, local_host
+from ceph_devstack.resources.container import Container
+from ceph_devstack.resources.snapshot import snapshot
+
+COLUMNS = ["NAME", "STATE", "HEALTH", "UPTIME", "RESTARTS", "LOOP DEVICES"]
+# Clears the screen and moves to its top-left corner
+CLEAR_SCREEN = "\x1b[H\x1b[2J"
+
+
+def format_duration(seconds: float) -> str:
+    seconds = int(max(seconds, 0))
+    days, seconds = divmod(seconds, 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if days:
+        return f"{days}d{hours:02d}h"
+    if hours:
+        return f"{hours}h{minutes:02d}m"
+    if minutes:
+        return f"{minutes}m{seconds:02d}s"
+    return f"{seconds}s"
+
+
+def loop_backing_file(device: str) -> Optional[str]:
+    # Attached loop devices say what they're backed by in sysfs
+    path = Path("/sys/block", os.path.basename(device), "loop", "backing_file")
+    try:
+        return path.read_text().strip()
+    except OSError:
+        return None
+
+
+def health_status(details: Dict) -> str:
+    state = details.get("State", {})
+    health = state.get("Health") or state.get("Healthcheck") or {}
+    return health.get("Status") or "-"
+
+
+def loop_devices(container: Container) -> str:
+    devices = getattr(container, "devices", None)
+    # sysfs is only ours to read when podman runs on this machine
+    if not devices or host is not local_host:
+        return ""
+    return " ".join(
+        f"{os.path.basename(device)}{'' if loop_backing_file(device) else '(detached)'}"
+        for device in devices
+    )
+
+
+async def container_status(container: Container, now: float) -> Dict[str, str]:
+    entry = (await snapshot.get(container.kind)).get(container.name)
+    row = {
+        "NAME": container.name,
+        "STATE": "missing",
+        "HEALTH": "-",
+        "UPTIME": "-",
+        "RESTARTS": "-",
+        "LOOP DEVICES": loop_devices(container),
+    }
+    if entry is None:
+        return row
+    row["STATE"] = entry.get("State", "unknown").lower()
+    if row["STATE"] == "running" and entry.get("StartedAt"):
+        row["UPTIME"] = format_duration(now - entry["StartedAt"])
+    # Served from a single inspect of every container we know of
+    details = await container.inspect()
+    if details:
+        row["HEALTH"] = health_status(details[0])
+        row["RESTARTS"] = str(details[0].get("RestartCount", 0))
+    return row
+
+
+def render_table(rows: List[Dict[str, str]]) -> str:
+    widths = {
+        column: max([len(column)] + [len(row[column]) for row in rows])
+        for column in COLUMNS
+    }
+    lines = [
+        "  ".join(values[column].ljust(widths[column]) for column in COLUMNS).rstrip()
+        for values in [{column: column for column in COLUMNS}] + rows
+    ]
+    return "\n".join(lines)
+
+
+def render_run(run: Optional[Dict], jobs: List[Dict]) -> str:
+    if not run:
+        return "Latest run: none"
+    counts: Dict[str, int] = {}
+    for job in jobs:
+        counts[job["status"]] = counts.get(job["status"], 0) + 1
+    summary = ", ".join(f"{count} {status}" for status, count in sorted(counts.items()))
+    lines = [f"Latest run: {run['name']}", f"  {run['status']}: {summary or 'no jobs'}"]
+    if jobs:
+        job = jobs[-1]
+        lines.append(f"  Latest job: {job['job_id']} ({job['status']})")
+    return "\n".join(lines)
+
+
+async def render_status(containers: List[Container], index) -> str:
+    now = time.time()
+    rows = await asyncio.gather(
+        *[container_status(container, now) for container in containers]
+    )
+    index.update()
+    run_name = index.most_recent_run()
+    run = index.run(run_name) if run_name else None
+    jobs = index.jobs(run_name) if run_name else []
+    return render_table(list(rows)) + "\n\n" + render_run(run, jobs)
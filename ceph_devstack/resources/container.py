@@ -1,22 +1,60 @@
 import asyncio
+import contextlib
+import hashlib
 import json
 import os
+import re
+import time
 
+from pathlib import Path
+from subprocess import CalledProcessError
 from typing import Dict, List, Optional
 
 from ceph_devstack import config, logger
+from ceph_devstack.cluster import cluster
+from ceph_devstack.host import host
+from ceph_devstack.metrics import metrics
 from ceph_devstack.resources import PodmanResource
+from ceph_devstack.resources.exceptions import HealthCheckTimeout
+from ceph_devstack.resources.snapshot import snapshot
+from ceph_devstack.trace import traced
+
+BUILD_KEY_LABEL = "ceph-devstack.build-key"
+
+
+def status_paths(status: bytes) -> List[bytes]:
+    # Parses `git status --porcelain -z`: each entry is "XY path", except
+    # that a rename or copy (X or Y is R or C) is followed by its source
+    # path as a field of its own, with no status
+    paths = []
+    fields = iter(status.split(b"\0"))
+    for entry in fields:
+        if not entry:
+            continue
+        paths.append(entry[3:])
+        if b"R" in entry[:2] or b"C" in entry[:2]:
+            paths.append(next(fields, b""))
+    return [path for path in paths if path]
 
 
 class Container(PodmanResource):
-    network: str
+    kind = "container"
+    # The network to join; like other names, it's prefixed per cluster
+    network_name = "ceph-devstack"
     secret: List[str]
-    cmd_vars: List[str] = ["name", "image", "image_tag"]
+    cmd_vars: List[str] = [
+        "name",
+        "service_name",
+        "base_name",
+        "image",
+        "image_tag",
+        "network",
+    ]
     build_cmd: List[str] = [
         "podman",
         "build",
         "-t",
-        "{name}:{image_tag}",
+        "{service_name}:{image_tag}",
         ".",
     ]
     create_cmd: List[str] = ["podman", "container", "create", "{name}"]
@@ -24,9 +62,13 @@ class Container(PodmanResource):
     start_cmd: List[str] = ["podman", "container", "start", "{name}"]
     stop_cmd: List[str] = ["podman", "container", "stop", "{name}"]
     exists_cmd: List[str] = ["podman", "container", "inspect", "{name}"]
-    pull_cmd: List[str] = ["podman", "pull", "{image}"]
+    pull_cmd: List[str] = ["podman", "pull", "--quiet", "{image}"]
     wait_cmd: List[str] = ["podman", "wait", "{name}"]
+    wait_healthy_cmd: List[str] = ["podman", "wait", "--condition=healthy", "{name}"]
+    healthcheck_cmd: List[str] = ["podman", "healthcheck", "run", "{name}"]
     env_vars: Dict[str, Optional[str]] = {}
+    # Names of the services which must be started before this one
+    depends_on: List[str] = []
 
     def __init__(self, name: str = ""):
         super().__init__(name)
@@ -44,14 +86,61 @@ class Container(PodmanResource):
             args.insert(-1, f"{key}={value}")
         return args
 
+    def add_cluster_to_args(self, args: List) -> List:
+        # Other clusters publish the same ports and use the same names, so
+        # offset host ports by our slot, and let the rest of our cluster find
+        # us by our unprefixed name
+        args = list(args)
+        for i, arg in enumerate(args[:-1]):
+            if arg == "-p" and ":" in args[i + 1]:
+                host_port, _, container_port = args[i + 1].rpartition(":")
+                args[i + 1] = f"{cluster.port(int(host_port))}:{container_port}"
+        if cluster.name and "--network" in args:
+            i = args.index("--network") + 2
+            args[i:i] = ["--network-alias", self.base_name]
+        return args
+
+    def resource_args(self) -> List[str]:
+        limits = self.config
+        args = []
+        if cpus := limits.get("cpus"):
+            args += ["--cpus", str(cpus)]
+        if (cpuset := limits.get("cpuset")) and cpuset != "auto":
+            args += ["--cpuset-cpus", str(cpuset)]
+        if mems := limits.get("cpuset_mems"):
+            args += ["--cpuset-mems", str(mems)]
+        if memory := limits.get("memory"):
+            args += ["--memory", str(memory)]
+        if weight := limits.get("blkio_weight"):
+            args += ["--blkio-weight", str(weight)]
+        return args
+
+    def add_resources_to_args(self, args: List) -> List:
+        # Options must precede the container's name and image
+        extra = self.resource_args()
+        if not extra or "--name" not in args:
+            return args
+        i = args.index("--name")
+        return args[:i] + extra + args[i:]
+
+    @property
+    def network(self) -> str:
+        return cluster.prefix(self.network_name)
+
+    @property
+    def service_name(self) -> str:
+        return self.__class__.__name__.lower()
+
     @property
     def config(self):
-        return config["containers"].get(self.__class__.__name__.lower(), {})
+        return config["containers"].get(self.service_name, {})
 
     @property
     def image(self):
         if self.repo:
-            return f"localhost/{self.name}"
+            # Images are shared by all of a service's containers, in every
+            # cluster; only the first container's is built
+            return f"localhost/{self.service_name}"
         return self.config["image"]
 
     @property
@@ -60,6 +149,39 @@ class Container(PodmanResource):
             return "latest"
         return self.image.split(":")[-1]
 
+    @property
+    def image_ref(self):
+        # The fully-tagged form of the image, as `podman image ls` reports it
+        if ":" in self.image.rsplit("/", 1)[-1] or "@" in self.image:
+            return self.image
+        return f"{self.image}:latest"
+
+    async def local_image(self) -> Optional[Dict]:
+        images = await snapshot.get("image")
+        ref = self.image_ref
+        for name, image in images.items():
+            # Short names like python:alpine are stored fully-qualified
+            if name == ref or name.endswith(f"/{ref}"):
+                return image
+        return None
+
+    @property
+    def pull_policy(self) -> str:
+        return self.config.get("pull_policy") or config.get("pull_policy", "always")
+
+    async def needs_pull(self) -> bool:
+        policy = self.pull_policy
+        if policy == "always":
+            return True
+        if (image := await self.local_image()) is None:
+            return True
+        if policy == "missing":
+            return False
+        if match := re.fullmatch(r"older-than-(\d+)h", policy):
+            max_age = int(match.group(1)) * 3600
+            return time.time() - image.get("Created", 0) > max_age
+        raise ValueError(f"{self.name}: unknown pull_policy '{policy}'")
+
     @property
     def repo(self):
         repo = self.config.get("repo", "")
@@ -72,62 +194,169 @@ class Container(PodmanResource):
     def cwd(self):
         return self.repo or "."
 
-    async def pull(self):
+    @traced
+    async def pull(self) -> bool:
         if not getattr(self, "pull_cmd", None):
-            return
+            return False
         if self.image.startswith("localhost/"):
-            return
+            return False
+        if not await self.needs_pull():
+            logger.debug(f"{self.name}: {self.image} is up to date")
+            return False
         logger.debug(f"{self.name}: pulling from: {self.image}")
-        await self.cmd(
-            self.format_cmd(self.pull_cmd),
-            check=True,
-            stream_output=True,
-        )
+        try:
+            await self.cmd(self.format_cmd(self.pull_cmd), check=True)
+        finally:
+            snapshot.invalidate("image")
+        return True
 
+    @property
+    def dockerfile(self) -> Path:
+        build_cmd = self.format_cmd(self.build_cmd)
+        for i, arg in enumerate(build_cmd[:-1]):
+            if arg in ("-f", "--file"):
+                return Path(self.repo, build_cmd[i + 1])
+        return Path(self.repo, "Dockerfile")
+
+    async def git(self, args: List[str]) -> Optional[bytes]:
+        proc = await self.cmd(["git", *args], force_local=True)
+        out, _ = await proc.communicate()
+        return out if proc.returncode == 0 else None
+
+    async def build_key(self) -> Optional[str]:
+        # Identifies the inputs to a build: the committed tree, the contents of
+        # any uncommitted changes, the Dockerfile and the build arguments. If
+        # any of these can't be determined, there is no key.
+        tree = await self.git(["rev-parse", "HEAD^{tree}"])
+        status = await self.git(["status", "--porcelain", "-z", "--untracked-files"])
+        if tree is None or status is None:
+            return None
+        digest = hashlib.sha256(tree)
+        digest.update(json.dumps(self.format_cmd(self.build_cmd)).encode())
+        digest.update(status)
+        paths = [self.dockerfile]
+        paths.extend(Path(self.repo, os.fsdecode(p)) for p in status_paths(status))
+        for path in paths:
+            digest.update(str(path).encode())
+            if path.is_file():
+                with open(path, "rb") as f:
+                    while chunk := f.read(2**20):
+                        digest.update(chunk)
+        return digest.hexdigest()
+
+    @traced
     async def build(self):
         if not getattr(self, "repo", None):
             return
+        build_cmd = self.format_cmd(self.build_cmd)
+        key = await self.build_key()
+        if key and not config.get("args", {}).get("force"):
+            image = await self.local_image()
+            if image and (image.get("Labels") or {}).get(BUILD_KEY_LABEL) == key:
+                logger.info(f"{self.name}: image is up to date with {self.repo}")
+                return
+        if key:
+            build_cmd[2:2] = ["--label", f"{BUILD_KEY_LABEL}={key}"]
         logger.debug(f"{self.name}: building from repo: {self.repo}")
-        await self.cmd(
-            self.format_cmd(self.build_cmd),
-            check=True,
-            stream_output=True,
-        )
+        try:
+            await self.cmd(build_cmd, check=True, stream_output=True)
+        finally:
+            snapshot.invalidate("image")
         logger.debug(f"{self.name}: built")
 
+    @traced
     async def create(self):
         if not getattr(self, "create_cmd", None):
             return
         if await self.exists():
             return
         args = self.add_env_to_args(self.format_cmd(self.create_cmd))
+        args = self.add_cluster_to_args(args)
+        args = self.add_resources_to_args(args)
         logger.debug(f"{self.name}: creating")
-        await self.cmd(
-            args,
-            check=True,
-            stream_output=True,
-        )
+        try:
+            await self.cmd(
+                args,
+                check=True,
+                stream_output=True,
+            )
+        finally:
+            snapshot.invalidate(self.kind)
         logger.debug(f"{self.name}: created")
 
+    @traced
     async def start(self):
         if not getattr(self, "start_cmd", None):
             return
         logger.debug(f"{self.name}: starting")
-        await self.cmd(
-            self.format_cmd(self.start_cmd),
-            check=True,
-            stream_output=True,
-        )
-        if "--health-cmd" in self.create_cmd or "--healthcheck-cmd" in self.create_cmd:
-            rc = None
-            while rc != 0:
-                proc = await self.cmd(
-                    self.format_cmd(["podman", "healthcheck", "run", "{name}"]),
-                )
-                rc = await proc.wait()
-                await asyncio.sleep(1)
+        started_at = time.monotonic()
+        try:
+            await self.cmd(
+                self.format_cmd(self.start_cmd),
+                check=True,
+                stream_output=True,
+            )
+        finally:
+            snapshot.invalidate(self.kind)
+        if self.has_healthcheck:
+            await self.wait_healthy(started_at)
         logger.debug(f"{self.name}: started")
 
+    @property
+    def has_healthcheck(self) -> bool:
+        return (
+            "--health-cmd" in self.create_cmd or "--healthcheck-cmd" in self.create_cmd
+        )
+
+    @traced
+    async def wait_healthy(self, started_at: Optional[float] = None):
+        timeout = self.config.get("health_timeout", config["health_timeout"])
+        start = started_at or time.monotonic()
+        try:
+            await asyncio.wait_for(self._wait_healthy(), timeout)
+        except asyncio.TimeoutError:
+            output = await self.last_health_log()
+            logger.error(f"{self.name}: not healthy after {timeout}s: {output}")
+            raise HealthCheckTimeout(self.name, timeout, output) from None
+        self.time_to_healthy = time.monotonic() - start
+        metrics.set(
+            "time_to_healthy_seconds", {"container": self.name}, self.time_to_healthy
+        )
+        logger.debug(f"{self.name}: healthy after {self.time_to_healthy:.1f}s")
+
+    async def _wait_healthy(self):
+        if await self.exit_status(self.format_cmd(self.wait_healthy_cmd)) == 0:
+            return
+        # Older versions of podman can't wait for health; poll instead
+        delay = 1.0
+        max_delay = self.config.get("health_backoff_max", config["health_backoff_max"])
+        while True:
+            if await self.exit_status(self.format_cmd(self.healthcheck_cmd)) == 0:
+                return
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, max_delay)
+
+    async def exit_status(self, args: List[str]) -> int:
+        # Unlike cmd(), which waits for the process itself, this can kill it
+        # if cancelled (i.e. on timing out), rather than leave it running
+        proc = await host.arun(args, cwd=Path(self.cwd))
+        try:
+            return await proc.wait()
+        finally:
+            if proc.returncode is None:
+                proc.kill()
+
+    async def last_health_log(self) -> str:
+        snapshot.invalidate(self.kind)
+        with contextlib.suppress(CalledProcessError):
+            for result in await self.inspect():
+                state = result.get("State", {})
+                health = state.get("Health") or state.get("Healthcheck") or {}
+                if log := health.get("Log"):
+                    return log[-1].get("Output", "").strip()
+        return ""
+
+    @traced
     async def stop(self):
         if not getattr(self, "stop_cmd", None):
             return
@@ -136,8 +365,10 @@ class Container(PodmanResource):
             self.format_cmd(self.stop_cmd),
             stream_output=True,
         )
+        snapshot.invalidate(self.kind)
         logger.debug(f"{self.name}: stopping")
 
+    @traced
     async def remove(self):
         if not getattr(self, "remove_cmd", None):
             return
@@ -146,14 +377,10 @@ class Container(PodmanResource):
         logger.debug(f"{self.name}: removed")
 
     async def is_running(self):
-        proc = await self.cmd(self.format_cmd(self.exists_cmd))
-        assert proc.stdout is not None
-        if not await self.exists():
-            return False
-        result = json.loads(await proc.stdout.read())
-        if not result:
+        state = (await snapshot.get(self.kind)).get(self.name)
+        if not state:
             return False
-        return result[0]["State"]["Status"].lower() == "running"
+        return state["State"].lower() == "running"
 
     async def wait(self) -> Optional[int]:
         proc = await self.cmd(self.format_cmd(self.wait_cmd))
@@ -0,0 +1,10 @@
+class HealthCheckTimeout(Exception):
+    def __init__(self, name: str, timeout: float, output: str = ""):
+        self.name = name
+        self.timeout = timeout
+        self.output = output
+        super().__init__(f"{name} did not become healthy within {timeout}s")
+
+
+class InsufficientCapacity(Exception):
+    pass
@@ -0,0 +1,104 @@
+import asyncio
+import json
+
+from subprocess import CalledProcessError
+from typing import Dict, List, Optional, Set
+
+from ceph_devstack.host import host
+
+LIST_CMDS = {
+    "container": ["podman", "container", "ls", "--all", "--format", "json"],
+    "network": ["podman", "network", "ls", "--format", "json"],
+    "secret": ["podman", "secret", "ls", "--format", "json"],
+    "image": ["podman", "image", "ls", "--format", "json"],
+}
+INSPECT_CMDS = {
+    "container": ["podman", "container", "inspect"],
+    "network": ["podman", "network", "inspect"],
+    "secret": ["podman", "secret", "inspect"],
+    "image": ["podman", "image", "inspect"],
+}
+
+
+def entry_names(entry: Dict) -> List[str]:
+    # The various podman subcommands don't agree on where names live
+    if names := entry.get("Names"):
+        return names
+    for key in ("Name", "name"):
+        if name := entry.get(key):
+            return [name.lstrip("/")]
+    if name := entry.get("Spec", {}).get("Name"):
+        return [name]
+    return []
+
+
+class Snapshot:
+    # A cache of the state of all of a kind of podman object (e.g. every
+    # container), fetched with a single podman call and shared by every
+    # resource. Anything that mutates a kind of object must invalidate it.
+    def __init__(self):
+        self.tracked: Dict[str, Set[str]] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._state: Dict[str, Dict[str, Dict]] = {}
+        self._details: Dict[str, Dict[str, Dict]] = {}
+
+    def track(self, kind: str, name: str):
+        self.tracked.setdefault(kind, set()).add(name)
+
+    def invalidate(self, kind: Optional[str] = None):
+        if kind is None:
+            self._state.clear()
+            self._details.clear()
+            return
+        self._state.pop(kind, None)
+        self._details.pop(kind, None)
+
+    def _lock(self, kind: str) -> asyncio.Lock:
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # A new event loop means a new command; nothing cached is valid
+            self._loop = loop
+            self._locks = {}
+            self.invalidate()
+        return self._locks.setdefault(kind, asyncio.Lock())
+
+    async def get(self, kind: str) -> Dict[str, Dict]:
+        async with self._lock(kind):
+            if kind not in self._state:
+                state = {}
+                for entry in await self._run_json(LIST_CMDS[kind]):
+                    for name in entry_names(entry):
+                        state[name] = entry
+                self._state[kind] = state
+            return self._state[kind]
+
+    async def inspect(self, kind: str, name: str) -> List[Dict]:
+        existing = await self.get(kind)
+        if name not in existing:
+            return []
+        async with self._lock(kind):
+            details = self._details.setdefault(kind, {})
+            if name not in details:
+                # Inspect everything we know we'll want in one go
+                names = {name} | {
+                    n
+                    for n in self.tracked.get(kind, set())
+                    if n in existing and n not in details
+                }
+                for entry in await self._run_json(INSPECT_CMDS[kind] + sorted(names)):
+                    for entry_name in entry_names(entry):
+                        details[entry_name] = entry
+            return [details[name]] if name in details else []
+
+    async def _run_json(self, args: List[str]) -> List[Dict]:
+        proc = await host.arun(args)
+        out, err = await proc.communicate()
+        if proc.returncode:
+            raise CalledProcessError(
+                cmd=args, returncode=proc.returncode, stderr=err.decode()
+            )
+        return json.loads(out or "[]") or []
+
+
+snapshot = Snapshot()
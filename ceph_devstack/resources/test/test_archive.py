@@ -0,0 +1,139 @@
+import gzip
+import os
+
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+import pytest
+
+from ceph_devstack.resources.ceph.archive import ArchiveIndex, parse_age
+
+RUN = "root-2025-03-20_18:34:43-orch:cephadm:smoke-small-main-distro-default-testnode"
+OLD_RUN = (
+    "root-2024-02-07_12:23:43-orch:cephadm:smoke-small-main-distro-default-testnode"
+)
+
+
+def make_job(archive_dir, run, job_id, log="log data", success=None):
+    job_dir = archive_dir / run / job_id
+    job_dir.mkdir(parents=True, exist_ok=True)
+    (job_dir / "teuthology.log").write_text(log)
+    if success is not None:
+        (job_dir / "summary.yaml").write_text(
+            f"description: a job\nsuccess: {str(success).lower()}\n"
+        )
+    return job_dir
+
+
+@pytest.fixture
+def archive(tmp_path):
+    archive_dir = tmp_path / "archive"
+    archive_dir.mkdir()
+    index = ArchiveIndex(tmp_path / "archive.db", archive_dir)
+    yield archive_dir, index
+    index.close()
+
+
+class TestArchiveIndex:
+    def test_most_recent_run(self, archive):
+        archive_dir, index = archive
+        make_job(archive_dir, OLD_RUN, "1")
+        make_job(archive_dir, RUN, "2")
+        (archive_dir / "not-a-run").mkdir()
+        index.update()
+        assert index.most_recent_run() == RUN
+        assert [run["name"] for run in index.runs()] == [RUN, OLD_RUN]
+        assert index.run(RUN)["user"] == "root"
+
+    def test_statuses_and_sizes(self, archive):
+        archive_dir, index = archive
+        make_job(archive_dir, RUN, "1", log="x" * 10, success=True)
+        make_job(archive_dir, RUN, "2", log="x" * 20)
+        index.update()
+        jobs = {job["job_id"]: job for job in index.jobs(RUN)}
+        assert jobs["1"]["status"] == "pass"
+        assert jobs["2"]["status"] == "running"
+        assert jobs["2"]["log_path"].endswith("/2/teuthology.log")
+        run = index.run(RUN)
+        assert (run["status"], run["jobs"], run["size"]) == ("running", 2, 30)
+        # Unfinished jobs are rescanned even if nothing else has changed
+        make_job(archive_dir, RUN, "2", log="x" * 20, success=False)
+        index.update()
+        assert index.run(RUN)["status"] == "fail"
+
+    def test_incremental(self, archive):
+        archive_dir, index = archive
+        make_job(archive_dir, RUN, "1", success=True)
+        index.update()
+        with patch("os.scandir", wraps=os.scandir) as m_scandir:
+            index.update()
+            m_scandir.assert_not_called()
+            make_job(archive_dir, OLD_RUN, "1", success=True)
+            index.update()
+            scanned = [call.args[0] for call in m_scandir.call_args_list]
+        assert scanned == [archive_dir, archive_dir / OLD_RUN]
+
+    def test_jobs_added_to_finished_runs(self, archive):
+        archive_dir, index = archive
+        make_job(archive_dir, RUN, "1", success=True)
+        index.update()
+        assert index.run(RUN)["status"] == "pass"
+        make_job(archive_dir, RUN, "2")
+        # Make sure the run directory's mtime changes
+        os.utime(archive_dir / RUN, ns=(0, 1))
+        index.update()
+        assert [job["job_id"] for job in index.jobs(RUN)] == ["1", "2"]
+        run = index.run(RUN)
+        assert (run["status"], run["jobs"]) == ("running", 2)
+
+    def test_removed_runs(self, archive):
+        archive_dir, index = archive
+        job_dir = make_job(archive_dir, RUN, "1", success=True)
+        index.update()
+        (job_dir / "teuthology.log").unlink()
+        (job_dir / "summary.yaml").unlink()
+        job_dir.rmdir()
+        (archive_dir / RUN).rmdir()
+        index.update()
+        assert index.most_recent_run() is None
+        assert index.jobs(RUN) == []
+
+
+class TestCompact:
+    def test_parse_age(self):
+        assert parse_age("12h") == timedelta(hours=12)
+        assert parse_age("2w") == timedelta(days=14)
+        with pytest.raises(ValueError):
+            parse_age("7 days")
+
+    def test_compact(self, archive):
+        archive_dir, index = archive
+        old_job = make_job(archive_dir, OLD_RUN, "1", log="x" * 100000, success=True)
+        make_job(archive_dir, OLD_RUN, "2", log="y" * 100000, success=False)
+        # Recent, and in flight, respectively
+        now = datetime.now().strftime("%Y-%m-%d_%H:%M:%S")
+        make_job(
+            archive_dir,
+            f"root-{now}-orch-main-distro-default-testnode",
+            "3",
+            success=True,
+        )
+        in_flight = "root-2024-01-01_00:00:00-orch-main-distro-default-testnode"
+        running_job = make_job(archive_dir, in_flight, "4")
+        index.update()
+        compacted, reclaimed = index.compact(timedelta(days=30), max_workers=2)
+        assert compacted == 2
+        assert reclaimed > 190000
+        assert not (old_job / "teuthology.log").exists()
+        with gzip.open(old_job / "teuthology.log.gz") as f:
+            assert f.read() == b"x" * 100000
+        assert (running_job / "teuthology.log").exists()
+        jobs = {job["job_id"]: job for job in index.jobs(OLD_RUN)}
+        assert jobs["1"]["log_path"].endswith("teuthology.log.gz")
+        assert index.run(OLD_RUN)["size"] == sum(job["size"] for job in jobs.values())
+        # Already compressed logs are left alone, and survive a rescan
+        assert index.compact(timedelta(days=30)) == (0, 0)
+        (archive_dir / OLD_RUN / "5").mkdir()
+        index.update()
+        jobs = {job["job_id"]: job for job in index.jobs(OLD_RUN)}
+        assert jobs["1"]["log_path"].endswith("teuthology.log.gz")
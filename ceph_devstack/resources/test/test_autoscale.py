@@ -0,0 +1,163 @@
+import asyncio
+
+from unittest.mock import AsyncMock, patch
+
+import pytest
+
+from ceph_devstack import config
+from ceph_devstack.resources.ceph import CephDevStack
+from ceph_devstack.resources.ceph.autoscale import WorkerScaler, desired_workers
+from ceph_devstack.resources.ceph.beanstalk import BeanstalkClient, parse_stats
+from ceph_devstack.resources.ceph.containers import Teuthology
+
+
+class FakeBeanstalkd:
+    # Answers stats-tube for the tubes it's given, like beanstalkd would
+    def __init__(self, tubes):
+        self.tubes = tubes
+        self.commands = []
+
+    async def handle(self, reader, writer):
+        while line := await reader.readline():
+            command = line.decode().strip()
+            self.commands.append(command)
+            _, _, tube = command.partition(" ")
+            if tube not in self.tubes:
+                writer.write(b"NOT_FOUND\r\n")
+            else:
+                body = "---\n" + "".join(
+                    f"{key}: {value}\n" for key, value in self.tubes[tube].items()
+                )
+                writer.write(f"OK {len(body)}\r\n{body}\r\n".encode())
+            await writer.drain()
+        writer.close()
+
+    async def __aenter__(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def __aexit__(self, *exc):
+        self.server.close()
+        await self.server.wait_closed()
+
+
+@pytest.fixture
+def teuthology_config():
+    saved = dict(config["containers"]["teuthology"])
+    config["containers"]["teuthology"]["max_count"] = 3
+    yield config["containers"]["teuthology"]
+    config["containers"]["teuthology"].clear()
+    config["containers"]["teuthology"].update(saved)
+
+
+class TestBeanstalkClient:
+    def test_parse_stats(self):
+        body = b"---\nname: testnode\ncurrent-jobs-ready: 4\npause: 0\n"
+        assert parse_stats(body) == {
+            "name": "testnode",
+            "current-jobs-ready": 4,
+            "pause": 0,
+        }
+
+    async def test_stats_tube(self):
+        tubes = {"testnode": {"name": "testnode", "current-jobs-ready": 7}}
+        async with FakeBeanstalkd(tubes) as server:
+            client = BeanstalkClient("127.0.0.1", server.port)
+            assert (await client.stats_tube("testnode"))["current-jobs-ready"] == 7
+            # The connection is reused
+            stats = await client.stats_tube("missing")
+            await client.close()
+        assert stats["current-jobs-ready"] == 0
+        assert server.commands == ["stats-tube testnode", "stats-tube missing"]
+
+
+class TestDesiredWorkers:
+    @pytest.mark.parametrize(
+        "ready,reserved,testnodes,expected",
+        [
+            (0, 0, 3, 1),
+            (1, 1, 3, 2),
+            (10, 0, 3, 3),
+            (10, 0, 2, 2),
+            (10, 0, 8, 4),
+            (0, 0, 0, 1),
+        ],
+    )
+    def test_desired_workers(self, ready, reserved, testnodes, expected):
+        stats = {"current-jobs-ready": ready, "current-jobs-reserved": reserved}
+        assert desired_workers(stats, 1, 4, testnodes) == expected
+
+
+class TestWorkerScaler:
+    def test_extra_workers_do_not_schedule(self):
+        assert Teuthology("teuthology_1").env_vars["TEUTHOLOGY_SUITE"] == "none"
+        assert Teuthology("teuthology_0").env_vars["TEUTHOLOGY_SUITE"] != "none"
+
+    async def test_workers_share_the_built_image(self, teuthology_config, tmp_path):
+        teuthology_config["repo"] = str(tmp_path)
+        first, worker = Teuthology(), Teuthology("teuthology_1")
+        assert worker.image == first.image == "localhost/teuthology"
+        assert "teuthology:latest" in first.format_cmd(first.build_cmd)
+        with (
+            patch.object(Teuthology, "exists", AsyncMock(return_value=False)),
+            patch.object(Teuthology, "cmd", AsyncMock()) as m_cmd,
+        ):
+            await worker.create()
+        args = m_cmd.await_args.args[0]
+        assert args[-1] == "localhost/teuthology"
+        assert "teuthology_1" in args
+
+    async def test_scale_up_and_down(self, teuthology_config):
+        devstack = CephDevStack()
+        changes = []
+        scaler = WorkerScaler(devstack, on_change=lambda: changes.append(1))
+        tubes = {"testnode": {"current-jobs-ready": 5, "current-jobs-reserved": 0}}
+        async with FakeBeanstalkd(tubes) as server:
+            scaler.client = BeanstalkClient("127.0.0.1", server.port)
+            with (
+                patch.object(Teuthology, "create", AsyncMock()),
+                patch.object(Teuthology, "start", AsyncMock()) as m_start,
+                patch.object(Teuthology, "remove", AsyncMock()) as m_remove,
+                patch.object(Teuthology, "is_idle", AsyncMock(return_value=True)),
+            ):
+                await scaler.scale()
+                assert [w.name for w in scaler.workers] == [
+                    "teuthology",
+                    "teuthology_1",
+                    "teuthology_2",
+                ]
+                assert m_start.await_count == 2
+                tubes["testnode"]["current-jobs-ready"] = 0
+                await scaler.scale()
+                assert [w.name for w in scaler.workers] == ["teuthology"]
+                assert m_remove.await_count == 2
+                # Once for the workers added, and once for each retired
+                assert len(changes) == 3
+            await scaler.client.close()
+
+    async def test_busy_workers_are_kept(self, teuthology_config):
+        devstack = CephDevStack()
+        scaler = WorkerScaler(devstack)
+        busy, idle = Teuthology("teuthology_1"), Teuthology("teuthology_2")
+        scaler.workers.extend([busy, idle])
+
+        async def is_idle(self):
+            return self is idle
+
+        tubes = {"testnode": {"current-jobs-ready": 0, "current-jobs-reserved": 1}}
+        async with FakeBeanstalkd(tubes) as server:
+            scaler.client = BeanstalkClient("127.0.0.1", server.port)
+            with (
+                patch.object(Teuthology, "is_idle", is_idle),
+                patch.object(Teuthology, "remove", AsyncMock()),
+            ):
+                await scaler.scale()
+            await scaler.client.close()
+        assert [w.name for w in scaler.workers] == ["teuthology", "teuthology_1"]
+
+    async def test_unreachable_queue(self, teuthology_config):
+        scaler = WorkerScaler(CephDevStack())
+        scaler.client = BeanstalkClient("127.0.0.1", 1, timeout=1)
+        await scaler.scale()
+        assert len(scaler.workers) == 1
@@ -1,10 +1,19 @@
-import json
+import asyncio
+import subprocess
+import time
+
 import pytest
 
-from unittest.mock import patch, AsyncMock
+from unittest.mock import patch, AsyncMock, Mock
 
 from ceph_devstack import config
-from ceph_devstack.resources.container import Container
+from ceph_devstack.resources.container import (
+    BUILD_KEY_LABEL,
+    Container,
+    status_paths,
+)
+from ceph_devstack.resources.exceptions import HealthCheckTimeout
+from ceph_devstack.resources.snapshot import snapshot
 from ceph_devstack.resources.test.test_podmanresource import (
     TestPodmanResource as _TestPodmanResource,
 )
@@ -24,44 +33,29 @@ class TestContainer(_TestPodmanResource):
     def setup_method(self):
         config["containers"]["container"] = {"image": "example.com/image:latest"}
 
-    @pytest.mark.parametrize("rc,res", ([0, True], [1, False]))
-    async def test_exists_yes(self, cls, rc, res):
-        with patch.object(cls, "cmd"):
-            obj = cls()
-            obj.cmd.return_value = AsyncMock()
-            obj.cmd.return_value.wait.return_value = rc
+    @pytest.mark.parametrize("present,res", ([True, True], [False, False]))
+    async def test_exists_yes(self, cls, present, res):
+        obj = cls()
+        state = {obj.name: {"State": "running"}} if present else {}
+        with patch.object(snapshot, "get", AsyncMock(return_value=state)):
             assert await obj.exists() == res
+            snapshot.get.assert_awaited_once_with("container")
 
     async def test_is_running_yes(self, cls):
-        with patch.object(cls, "cmd"):
-            obj = cls()
-            output_obj = [{"State": {"Status": "running"}}]
-            m_read = AsyncMock(return_value=json.dumps(output_obj))
-            m_stdout = AsyncMock(read=m_read)
-            obj.cmd.return_value = AsyncMock(
-                stdout=m_stdout,
-                returncode=0,
-            )
-            obj.cmd.return_value.wait.return_value = 0
+        obj = cls()
+        state = {obj.name: {"Names": [obj.name], "State": "running"}}
+        with patch.object(snapshot, "get", AsyncMock(return_value=state)):
             assert await obj.is_running() is True
 
     async def test_is_running_no_bc_status(self, cls):
-        with patch.object(cls, "cmd"):
-            obj = cls()
-            output_obj = [{"State": {"Status": "crashed"}}]
-            m_read = AsyncMock(return_value=json.dumps(output_obj))
-            m_stdout = AsyncMock(read=m_read)
-            obj.cmd.return_value = AsyncMock(
-                stdout=m_stdout,
-                returncode=0,
-            )
-            obj.cmd.return_value.wait.return_value = 0
+        obj = cls()
+        state = {obj.name: {"Names": [obj.name], "State": "exited"}}
+        with patch.object(snapshot, "get", AsyncMock(return_value=state)):
             assert await obj.is_running() is False
 
     async def test_is_running_no_bc_dne(self, cls):
-        with patch.object(cls, "cmd"):
-            obj = cls()
-            obj.cmd.return_value = AsyncMock(returncode=1)
+        obj = cls()
+        with patch.object(snapshot, "get", AsyncMock(return_value={})):
             assert await obj.is_running() is False
 
     async def test_empty_cmd_skips_action(self, cls, action):
@@ -70,3 +64,156 @@ class TestContainer(_TestPodmanResource):
             setattr(obj, f"{action}_cmd", [])
             await getattr(obj, action)()
             obj.cmd.assert_not_awaited()
+
+    @pytest.mark.parametrize(
+        "policy,images,res",
+        [
+            ("always", {"example.com/image:latest": {"Created": 0}}, True),
+            ("missing", {}, True),
+            ("missing", {"example.com/image:latest": {"Created": 0}}, False),
+            ("older-than-2h", {"example.com/image:latest": {"Created": 0}}, True),
+            (
+                "older-than-2h",
+                {"example.com/image:latest": {"Created": time.time()}},
+                False,
+            ),
+        ],
+    )
+    async def test_needs_pull(self, cls, policy, images, res):
+        config["containers"]["container"]["pull_policy"] = policy
+        obj = cls()
+        with patch.object(snapshot, "get", AsyncMock(return_value=images)):
+            assert await obj.needs_pull() is res
+
+    async def test_local_image_short_name(self, cls):
+        config["containers"]["container"] = {"image": "python:alpine"}
+        obj = cls()
+        images = {"docker.io/library/python:alpine": {"Created": 0}}
+        with patch.object(snapshot, "get", AsyncMock(return_value=images)):
+            assert await obj.local_image() == {"Created": 0}
+
+    async def test_pull_skipped_when_up_to_date(self, cls):
+        config["containers"]["container"]["pull_policy"] = "missing"
+        images = {"example.com/image:latest": {"Created": 0}}
+        with (
+            patch.object(cls, "cmd") as m_cmd,
+            patch.object(snapshot, "get", AsyncMock(return_value=images)),
+        ):
+            assert await cls().pull() is False
+            m_cmd.assert_not_called()
+
+    @pytest.fixture
+    def git_repo(self, tmp_path):
+        repo = tmp_path / "repo"
+        repo.mkdir()
+        (repo / "Dockerfile").write_text("FROM scratch\n")
+        for args in (
+            ["init", "-q"],
+            ["add", "Dockerfile"],
+            ["-c", "user.name=x", "-c", "user.email=x@x", "commit", "-qm", "x"],
+        ):
+            subprocess.check_call(["git", *args], cwd=repo)
+        config["containers"]["container"] = {"repo": str(repo)}
+        return repo
+
+    async def test_build_key_tracks_changes(self, cls, git_repo):
+        obj = cls()
+        key = await obj.build_key()
+        assert key and key == await obj.build_key()
+        (git_repo / "new_file").write_text("x")
+        dirty_key = await obj.build_key()
+        assert dirty_key != key
+        (git_repo / "new_file").write_text("y")
+        assert await obj.build_key() != dirty_key
+        (git_repo / "new_file").unlink()
+        assert await obj.build_key() == key
+
+    def test_status_paths(self):
+        status = b"R  new_name\0old_name\0 M Dockerfile\0?? untracked\0"
+        assert status_paths(status) == [
+            b"new_name",
+            b"old_name",
+            b"Dockerfile",
+            b"untracked",
+        ]
+
+    async def test_build_key_tracks_renames(self, cls, git_repo):
+        obj = cls()
+        key = await obj.build_key()
+        subprocess.check_call(
+            ["git", "mv", "Dockerfile", "Containerfile"], cwd=git_repo
+        )
+        status = await obj.git(["status", "--porcelain", "-z"])
+        assert status_paths(status) == [b"Containerfile", b"Dockerfile"]
+        assert await obj.build_key() != key
+
+    async def test_build_skipped_when_key_matches(self, cls, git_repo):
+        obj = cls()
+        key = await obj.build_key()
+        images = {"localhost/container:latest": {"Labels": {BUILD_KEY_LABEL: key}}}
+        with (
+            patch.object(snapshot, "get", AsyncMock(return_value=images)),
+            patch.object(cls, "cmd", wraps=obj.cmd) as m_cmd,
+        ):
+            await obj.build()
+        assert not [c for c in m_cmd.call_args_list if c.args[0][0] == "podman"]
+
+    def fake_cmd(self, returncodes):
+        calls = []
+
+        async def cmd(args, **kwargs):
+            calls.append(args)
+            proc = AsyncMock()
+            proc.returncode = returncodes.get(args[1], 0)
+            proc.wait.return_value = proc.returncode
+            return proc
+
+        return cmd, calls
+
+    async def test_wait_healthy(self, cls):
+        obj = cls()
+        cmd, calls = self.fake_cmd({})
+        with patch("ceph_devstack.resources.container.host.arun", cmd):
+            await obj.wait_healthy()
+        assert calls == [["podman", "wait", "--condition=healthy", obj.name]]
+        assert obj.time_to_healthy >= 0
+
+    async def test_wait_healthy_falls_back_to_polling(self, cls):
+        obj = cls()
+        cmd, calls = self.fake_cmd({"wait": 125})
+        with patch("ceph_devstack.resources.container.host.arun", cmd):
+            await obj.wait_healthy()
+        assert calls[-1] == ["podman", "healthcheck", "run", obj.name]
+
+    async def test_wait_healthy_times_out(self, cls):
+        config["containers"]["container"]["health_timeout"] = 0.1
+        obj = cls()
+        cmd, _ = self.fake_cmd({"wait": 125, "healthcheck": 1})
+        inspect = [{"State": {"Health": {"Log": [{"Output": "connection refused"}]}}}]
+        with (
+            patch("ceph_devstack.resources.container.host.arun", cmd),
+            patch.object(obj, "inspect", AsyncMock(return_value=inspect)),
+            pytest.raises(HealthCheckTimeout) as exc,
+        ):
+            await obj.wait_healthy()
+        assert exc.value.output == "connection refused"
+
+    async def test_wait_healthy_timeout_kills_podman_wait(self, cls):
+        config["containers"]["container"]["health_timeout"] = 0.1
+        obj = cls()
+        proc = Mock(returncode=None)
+
+        async def wait():
+            await asyncio.sleep(10)
+
+        proc.wait = wait
+        with (
+            patch(
+                "ceph_devstack.resources.container.host.arun",
+                AsyncMock(return_value=proc),
+            ),
+            patch.object(obj, "inspect", AsyncMock(return_value=[])),
+            pytest.raises(HealthCheckTimeout),
+        ):
+            await obj.wait_healthy()
+        proc.kill.assert_called_once()
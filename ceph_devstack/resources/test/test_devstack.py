@@ -1,3 +1,4 @@
+import asyncio
 import os
 import io
 import contextlib
@@ -8,6 +9,8 @@ import string
 
 import pytest
 
+from unittest.mock import AsyncMock, patch
+
 from ceph_devstack import config
 from ceph_devstack.resources.ceph.utils import (
     get_logtimestamp,
@@ -16,6 +19,7 @@ from ceph_devstack.resources.ceph.utils import (
 )
 from ceph_devstack.resources.ceph.exceptions import TooManyJobsFound
 from ceph_devstack.resources.ceph import CephDevStack
+from ceph_devstack.resources.container import Container
 
 
 class TestDevStack:
@@ -50,6 +54,164 @@ class TestDevStack:
             get_job_id(jobs)
         assert exc.value.jobs == jobs
 
+    async def test_start_respects_dependencies(self):
+        started = []
+        running = set()
+        max_running = 0
+
+        async def fake_start(obj):
+            nonlocal max_running
+            running.add(obj.name)
+            max_running = max(max_running, len(running))
+            await asyncio.sleep(0.01)
+            running.remove(obj.name)
+            started.append(obj.name)
+
+        devstack = CephDevStack()
+        with (
+            patch.object(CephDevStack, "create"),
+            patch.object(Container, "start", fake_start),
+            patch("ceph_devstack.resources.ceph.host.hostname"),
+        ):
+            await devstack.start()
+        all_names = [
+            obj.name
+            for spec in devstack.service_specs.values()
+            for obj in spec["objects"]
+        ]
+        assert sorted(started) == sorted(all_names)
+        assert started.index("postgres") < started.index("paddles")
+        assert started.index("paddles") < started.index("pulpito")
+        testnodes = [name for name in started if name.startswith("testnode")]
+        for name in ["paddles", "beanstalk", *testnodes]:
+            assert started.index(name) < started.index("teuthology")
+        assert max_running > 1
+
+    async def test_start_dependency_cycle(self):
+        devstack = CephDevStack()
+        with (
+            patch.object(CephDevStack, "create"),
+            patch.object(
+                devstack.service_specs["postgres"]["obj"], "depends_on", ["pulpito"]
+            ),
+            pytest.raises(ValueError),
+        ):
+            await devstack.start()
+
+    async def test_watch_events_dispatches_relevant_events(self):
+        devstack = CephDevStack()
+        containers = devstack.service_specs["paddles"]["objects"]
+        events = [
+            {"Name": "paddles", "Status": "died"},
+            {"Name": "paddles", "Status": "exec_died"},
+            {"Name": "somebody-else", "Status": "died"},
+        ]
+
+        async def fake_events(filters):
+            assert "container=paddles" in filters
+            for event in events:
+                yield event
+            raise asyncio.CancelledError
+
+        callback = AsyncMock()
+        with (
+            patch("ceph_devstack.resources.ceph.host.podman_events", fake_events),
+            pytest.raises(asyncio.CancelledError),
+        ):
+            await devstack.watch_events(lambda: containers, callback)
+        await asyncio.sleep(0)
+        callback.assert_awaited_once_with(containers[0], events[0])
+
+    async def test_watch_events_resubscribes_when_containers_change(self):
+        devstack = CephDevStack()
+        containers = list(devstack.service_specs["teuthology"]["objects"])
+        changed = asyncio.Event()
+        subscriptions = []
+
+        async def fake_events(filters):
+            subscriptions.append(filters)
+            if len(subscriptions) == 1:
+                containers.append(Container(name="teuthology_1"))
+                changed.set()
+                await asyncio.sleep(10)
+            raise asyncio.CancelledError
+            yield
+
+        with (
+            patch("ceph_devstack.resources.ceph.host.podman_events", fake_events),
+            pytest.raises(asyncio.CancelledError),
+        ):
+            await devstack.watch_events(lambda: containers, AsyncMock(), changed)
+        assert "container=teuthology_1" not in subscriptions[0]
+        assert "container=teuthology_1" in subscriptions[1]
+
+    async def test_watch_survives_unhealthy_containers(self):
+        from ceph_devstack.resources.exceptions import HealthCheckTimeout
+
+        devstack = CephDevStack()
+
+        async def forever(*args):
+            await asyncio.sleep(10)
+
+        unhealthy = AsyncMock(side_effect=HealthCheckTimeout("postgres", 1))
+        with (
+            patch.dict(config["watch"], {"reconcile_interval": 0.01}),
+            patch.object(CephDevStack, "reconcile", unhealthy),
+            patch.object(CephDevStack, "watch_events", forever),
+            patch.object(CephDevStack, "watch_network", forever),
+            pytest.raises(asyncio.TimeoutError),
+        ):
+            await asyncio.wait_for(devstack.watch(), 0.1)
+        # Retried, rather than ending watch
+        assert unhealthy.await_count > len(devstack.containers())
+
+    async def test_watch_network_reports_its_removal(self):
+        devstack = CephDevStack()
+        events = [
+            {"Name": "ceph-devstack", "Status": "create"},
+            {"Name": "ceph-devstack", "Status": "remove"},
+        ]
+
+        async def fake_events(filters):
+            assert filters == ["type=network", "network=ceph-devstack"]
+            for event in events:
+                yield event
+            raise asyncio.CancelledError
+
+        callback = AsyncMock()
+        with (
+            patch("ceph_devstack.resources.ceph.host.podman_events", fake_events),
+            pytest.raises(asyncio.CancelledError),
+        ):
+            await devstack.watch_network(callback)
+        await asyncio.sleep(0)
+        callback.assert_awaited_once()
+        assert callback.await_args.args[0].name == "ceph-devstack"
+
+    @pytest.mark.parametrize(
+        "exists,running,event,expected",
+        [
+            (False, False, None, ["create", "start"]),
+            (True, False, {"Status": "died"}, ["start"]),
+            (True, True, None, []),
+            (True, True, {"Status": "health_status", "HealthStatus": "healthy"}, []),
+            (
+                True,
+                True,
+                {"Status": "health_status", "HealthStatus": "unhealthy"},
+                ["stop", "start"],
+            ),
+        ],
+    )
+    async def test_reconcile(self, exists, running, event, expected):
+        devstack = CephDevStack()
+        container = AsyncMock()
+        container.exists.return_value = exists
+        container.is_running.return_value = running
+        await devstack.reconcile(container, event)
+        called = [call[0] for call in container.method_calls if call[0] in expected]
+        assert called == expected
+
     async def test_logs_command_display_log_file_of_latest_run(
         self, tmp_path, create_log_file
     ):
@@ -153,6 +315,50 @@ class TestDevStack:
             await devstack.logs(locate=True)
         assert log_file in f.getvalue()
 
+    async def test_logs_tail(self, tmp_path, create_log_file):
+        config["data_dir"] = str(tmp_path)
+        f = io.StringIO()
+        content = "".join(f"line {i}\n" for i in range(100000))
+        create_log_file(str(tmp_path), content=content)
+        with contextlib.redirect_stdout(f):
+            devstack = CephDevStack()
+            await devstack.logs(tail=3)
+        assert f.getvalue() == "line 99997\nline 99998\nline 99999\n"
+
+    async def test_logs_follow(self, tmp_path, create_log_file):
+        config["data_dir"] = str(tmp_path)
+        f = io.StringIO()
+        log_file = create_log_file(str(tmp_path), content="first\n")
+        with contextlib.redirect_stdout(f):
+            devstack = CephDevStack()
+            task = asyncio.ensure_future(devstack.logs(follow=True))
+            await asyncio.sleep(0.1)
+            with open(log_file, "a") as log:
+                log.write("second\n")
+            for _ in range(50):
+                await asyncio.sleep(0.05)
+                if "second" in f.getvalue():
+                    break
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+        assert f.getvalue() == "first\nsecond\n"
+
+    async def test_runs_list_and_show(self, tmp_path, create_log_file):
+        config["data_dir"] = str(tmp_path)
+        now = datetime.now().strftime("%Y-%m-%d_%H:%M:%S")
+        log_file = create_log_file(str(tmp_path), timestamp=now, job_id="7")
+        run_name = log_file.split("/")[-3]
+        f = io.StringIO()
+        with contextlib.redirect_stdout(f):
+            devstack = CephDevStack()
+            await devstack.list_runs()
+            await devstack.show_run()
+        out = f.getvalue()
+        assert f"running     1 jobs       0.0 MiB  {run_name}" in out
+        assert f"name: {run_name}" in out
+        assert f"      7 running  {log_file}" in out
+
     @pytest.fixture(scope="class")
     def create_log_file(self):
         def _create_log_file(data_dir: str, **kwargs):
@@ -180,3 +386,53 @@ class TestDevStack:
             return log_file
 
         return _create_log_file
+
+
+class TestDiskCheck:
+    async def test_create_refuses_overcommit(self, tmp_path):
+        from ceph_devstack.resources.exceptions import InsufficientCapacity
+
+        config["data_dir"] = str(tmp_path)
+        devstack = CephDevStack()
+        with (
+            patch("ceph_devstack.resources.ceph.disk_free", return_value=2**30),
+            patch.object(Container, "exists", AsyncMock(return_value=False)),
+            patch.object(Container, "create", AsyncMock()) as m_create,
+            patch("ceph_devstack.resources.ceph.CephDevStackNetwork"),
+            patch("ceph_devstack.resources.ceph.SSHKeyPair"),
+            pytest.raises(InsufficientCapacity),
+        ):
+            await devstack.create()
+        m_create.assert_not_called()
+
+    async def test_existing_testnodes_are_not_refused(self, tmp_path):
+        config["data_dir"] = str(tmp_path)
+        devstack = CephDevStack()
+        with (
+            patch("ceph_devstack.resources.ceph.disk_free", return_value=0),
+            patch.object(Container, "exists", AsyncMock(return_value=True)),
+        ):
+            await devstack.check_disk()
+
+    def test_too_many_loop_devices_are_refused(self):
+        from ceph_devstack.resources.exceptions import InsufficientCapacity
+
+        testnode_config = config["containers"]["testnode"]
+        saved = dict(testnode_config)
+        testnode_config.update({"count": 51, "loop_device_count": 2})
+        try:
+            devstack = CephDevStack()
+        finally:
+            testnode_config.clear()
+            testnode_config.update(saved)
+        with pytest.raises(InsufficientCapacity):
+            devstack.check_loop_devices()
+
+
+class TestGetLogFile:
+    def test_unindexed_run_lists_its_jobs(self, tmp_path):
+        config["data_dir"] = str(tmp_path)
+        job_dir = tmp_path / "archive" / "my-own-run" / "7"
+        job_dir.mkdir(parents=True)
+        (job_dir / "teuthology.log").write_text("x")
+        assert CephDevStack().get_log_file("my-own-run") == job_dir / "teuthology.log"
@@ -0,0 +1,99 @@
+import asyncio
+import json
+
+from subprocess import CalledProcessError
+from unittest.mock import AsyncMock, patch
+
+from ceph_devstack import config
+from ceph_devstack.metrics import metrics
+from ceph_devstack.resources.ceph import CephDevStack
+from ceph_devstack.resources.ceph.exporter import Exporter
+
+
+OUTPUTS = {
+    "ls": [{"Names": ["paddles"], "State": "running"}],
+    "inspect": [
+        {
+            "Name": "paddles",
+            "RestartCount": 3,
+            "State": {"Health": {"Status": "unhealthy"}},
+        }
+    ],
+}
+
+
+class TestExporter:
+    async def test_collect(self, tmp_path, fake_arun):
+        config["data_dir"] = str(tmp_path)
+        metrics.inc("watch_restarts_total", {"container": "paddles", "reason": "x"})
+        arun, calls = fake_arun(OUTPUTS)
+        exporter = Exporter(CephDevStack())
+        with patch("ceph_devstack.resources.snapshot.host.arun", arun):
+            text = (await exporter.body()).decode()
+            # Cached; no more podman calls
+            await exporter.body()
+        assert 'container_state{container="paddles",state="running"} 1' in text
+        assert 'container_state{container="postgres",state="missing"} 1' in text
+        assert 'container_restarts{container="paddles"} 3' in text
+        assert 'container_healthy{container="paddles"} 0' in text
+        assert "ceph_devstack_archive_log_bytes 0" in text
+        assert 'watch_restarts_total{container="paddles",reason="x"} 1' in text
+        assert [args[2] for args in calls] == ["ls", "inspect"]
+
+    async def test_cache_expires(self, tmp_path, fake_arun):
+        config["data_dir"] = str(tmp_path)
+        arun, calls = fake_arun(OUTPUTS)
+        exporter = Exporter(CephDevStack(), cache_seconds=0)
+        with patch("ceph_devstack.resources.snapshot.host.arun", arun):
+            await asyncio.gather(exporter.body(), exporter.body())
+        assert [args[2] for args in calls] == ["ls", "inspect", "ls", "inspect"]
+
+    async def test_serve(self, tmp_path, fake_arun):
+        config["data_dir"] = str(tmp_path)
+        arun, _ = fake_arun(OUTPUTS)
+        exporter = Exporter(CephDevStack())
+        server = await asyncio.start_server(exporter.handle, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+
+        async def get(path):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(f"GET {path} HTTP/1.1\r\nHost: x\r\n\r\n".encode())
+            response = await reader.read()
+            writer.close()
+            return response
+
+        with patch("ceph_devstack.resources.snapshot.host.arun", arun):
+            async with server:
+                metrics_response = await get("/metrics")
+                missing = await get("/nope")
+        assert metrics_response.startswith(b"HTTP/1.1 200 OK\r\n")
+        assert b"text/plain; version=0.0.4" in metrics_response
+        assert b"ceph_devstack_container_state" in metrics_response
+        assert missing.startswith(b"HTTP/1.1 404")
+
+    async def test_collect_failure_is_a_500(self, tmp_path):
+        config["data_dir"] = str(tmp_path)
+        exporter = Exporter(CephDevStack())
+        server = await asyncio.start_server(exporter.handle, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        failure = AsyncMock(side_effect=CalledProcessError(125, ["podman"]))
+        with patch.object(exporter, "collect", failure):
+            async with server:
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                writer.write(b"GET /metrics HTTP/1.1\r\nHost: x\r\n\r\n")
+                response = await reader.read()
+                writer.close()
+        assert response.startswith(b"HTTP/1.1 500 Internal Server Error\r\n")
+
+    async def test_watch_restarts_are_counted(self, metrics_path):
+        devstack = CephDevStack()
+        container = devstack.service_specs["paddles"]["objects"][0]
+        with (
+            patch.object(container, "exists", AsyncMock(return_value=True)),
+            patch.object(container, "is_running", AsyncMock(return_value=False)),
+            patch.object(container, "start", AsyncMock()),
+        ):
+            await devstack.reconcile(container)
+        assert json.loads(metrics_path.read_text())["watch_restarts_total"] == {
+            'container="paddles",reason="stopped"': 1
+        }
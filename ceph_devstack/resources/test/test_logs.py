@@ -0,0 +1,92 @@
+import asyncio
+import gzip
+import io
+import os
+import sys
+
+from unittest.mock import patch
+
+from ceph_devstack.resources.ceph import logs
+from ceph_devstack.resources.ceph.logs import LogWriter, find_log, show_log
+from ceph_devstack.resources.ceph.logs import tail_offset
+
+
+class TestLogs:
+    def test_tail_offset(self, tmp_path):
+        path = tmp_path / "teuthology.log"
+        path.write_bytes(b"a\nbb\nccc\n")
+        assert tail_offset(path, 0) == 9
+        assert tail_offset(path, 1) == 5
+        assert tail_offset(path, 2) == 2
+        assert tail_offset(path, 10) == 0
+        path.write_bytes(b"a\nbb\nccc")
+        assert tail_offset(path, 1) == 5
+
+    def test_sendfile_to_real_stdout(self, tmp_path):
+        path = tmp_path / "teuthology.log"
+        path.write_bytes(b"x" * 200000)
+        out_path = tmp_path / "out"
+        with open(out_path, "w") as out, patch.object(sys, "stdout", out):
+            with patch("os.sendfile", wraps=os.sendfile) as m_sendfile:
+                assert LogWriter().write(path, 100) == 200000
+            m_sendfile.assert_called()
+        assert out_path.read_bytes() == b"x" * 199900
+
+    def test_split_characters(self, tmp_path, capsys):
+        path = tmp_path / "teuthology.log"
+        data = "héllo".encode()
+        writer = LogWriter()
+        writer.fd = None
+        path.write_bytes(data[:2])
+        offset = writer.write(path)
+        path.write_bytes(data)
+        writer.write(path, offset)
+        assert capsys.readouterr().out == "héllo"
+
+    async def test_compressed(self, tmp_path):
+        content = "".join(f"line {i}\n" for i in range(10000))
+        with gzip.open(tmp_path / "teuthology.log.gz", "wt") as f:
+            f.write(content)
+        path = find_log(tmp_path)
+        assert path == tmp_path / "teuthology.log.gz"
+        out = io.StringIO()
+        with patch.object(sys, "stdout", out):
+            await show_log(path)
+        assert out.getvalue() == content
+        out = io.StringIO()
+        with patch.object(sys, "stdout", out):
+            await show_log(path, tail=2, follow=True)
+        assert out.getvalue() == "line 9998\nline 9999\n"
+
+    async def test_follow_across_rotation(self, tmp_path):
+        path = tmp_path / "teuthology.log"
+        path.write_bytes(b"one\n")
+        out = io.StringIO()
+
+        async def wait_for(text):
+            for _ in range(100):
+                if out.getvalue().endswith(text):
+                    return
+                await asyncio.sleep(0.01)
+            raise AssertionError(f"{text!r} not in {out.getvalue()!r}")
+
+        with (
+            patch.object(sys, "stdout", out),
+            patch.object(logs, "POLL_INTERVAL", 0.01),
+        ):
+            task = asyncio.ensure_future(show_log(path, follow=True))
+            try:
+                await wait_for("one\n")
+                with open(path, "ab") as f:
+                    f.write(b"two\n")
+                await wait_for("two\n")
+                path.rename(tmp_path / "teuthology.log.1")
+                await asyncio.sleep(0.05)
+                path.write_bytes(b"three\n")
+                await wait_for("three\n")
+                with open(path, "ab") as f:
+                    f.write(b"four\n")
+                await wait_for("four\n")
+            finally:
+                task.cancel()
+        assert out.getvalue() == "one\ntwo\nthree\nfour\n"
@@ -4,7 +4,7 @@ from pathlib import Path
 from subprocess import CalledProcessError
 from unittest.mock import patch
 
-from ceph_devstack.resources import PodmanResource
+from ceph_devstack.resources import PodmanResource, log_command_failure
 
 
 class TestPodmanResource:
@@ -57,3 +57,11 @@ class TestPodmanResource:
         obj = cls()
         with pytest.raises(CalledProcessError):
             await obj.cmd(["false"], check=True)
+
+    async def test_cmd_failure_output_is_logged(self, cls, caplog):
+        obj = cls()
+        with pytest.raises(CalledProcessError) as exc:
+            await obj.cmd(["sh", "-c", "echo oops >&2; exit 3"], check=True)
+        log_command_failure(exc.value)
+        assert "failed with status 3" in caplog.text
+        assert "  oops" in caplog.text
@@ -0,0 +1,47 @@
+from unittest.mock import patch
+
+from ceph_devstack.resources.snapshot import Snapshot, entry_names
+
+
+class TestSnapshot:
+    def test_entry_names(self):
+        assert entry_names({"Names": ["paddles"]}) == ["paddles"]
+        assert entry_names({"Name": "paddles"}) == ["paddles"]
+        assert entry_names({"name": "ceph-devstack"}) == ["ceph-devstack"]
+        assert entry_names({"Spec": {"Name": "id_rsa"}}) == ["id_rsa"]
+        assert entry_names({}) == []
+
+    async def test_get_is_cached_until_invalidated(self, fake_arun):
+        snapshot = Snapshot()
+        arun, calls = fake_arun(
+            {"ls": [{"Names": ["postgres"], "State": "running"}, {"Names": ["x"]}]}
+        )
+        with patch("ceph_devstack.resources.snapshot.host.arun", arun):
+            state = await snapshot.get("container")
+            assert set(state) == {"postgres", "x"}
+            await snapshot.get("container")
+            assert len(calls) == 1
+            snapshot.invalidate("container")
+            await snapshot.get("container")
+            assert len(calls) == 2
+
+    async def test_inspect_batches_tracked_names(self, fake_arun):
+        snapshot = Snapshot()
+        for name in ["postgres", "paddles", "absent"]:
+            snapshot.track("container", name)
+        arun, calls = fake_arun(
+            {
+                "ls": [{"Names": ["postgres"]}, {"Names": ["paddles"]}],
+                "inspect": [{"Name": "postgres"}, {"Name": "paddles"}],
+            }
+        )
+        with patch("ceph_devstack.resources.snapshot.host.arun", arun):
+            assert await snapshot.inspect("container", "paddles") == [
+                {"Name": "paddles"}
+            ]
+            assert await snapshot.inspect("container", "postgres") == [
+                {"Name": "postgres"}
+            ]
+            assert await snapshot.inspect("container", "absent") == []
+        assert calls[1] == ["podman", "container", "inspect", "paddles", "postgres"]
+        assert len(calls) == 2
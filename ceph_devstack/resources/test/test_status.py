@@ -0,0 +1,61 @@
+import time
+
+from unittest.mock import patch
+
+import pytest
+
+from ceph_devstack import config
+from ceph_devstack.resources.ceph import CephDevStack
+from ceph_devstack.resources.ceph.status import format_duration, render_run
+
+
+class TestStatus:
+    @pytest.mark.parametrize(
+        "seconds,expected",
+        [(5, "5s"), (65, "1m05s"), (3720, "1h02m"), (90000, "1d01h"), (-3, "0s")],
+    )
+    def test_format_duration(self, seconds, expected):
+        assert format_duration(seconds) == expected
+
+    def test_render_run(self):
+        run = {"name": "root-run", "status": "running"}
+        jobs = [
+            {"job_id": "1", "status": "pass"},
+            {"job_id": "2", "status": "pass"},
+            {"job_id": "3", "status": "running"},
+        ]
+        assert render_run(run, jobs) == (
+            "Latest run: root-run\n  running: 2 pass, 1 running\n"
+            "  Latest job: 3 (running)"
+        )
+        assert render_run(None, []) == "Latest run: none"
+
+    async def test_status_uses_batched_queries(self, tmp_path, capsys, fake_arun):
+        config["data_dir"] = str(tmp_path)
+        started = int(time.time()) - 125
+        outputs = {
+            "ls": [
+                {"Names": ["postgres"], "State": "running", "StartedAt": started},
+                {"Names": ["paddles"], "State": "exited", "StartedAt": started},
+            ],
+            "inspect": [
+                {
+                    "Name": "postgres",
+                    "RestartCount": 2,
+                    "State": {"Health": {"Status": "healthy"}},
+                },
+                {"Name": "paddles", "RestartCount": 0, "State": {}},
+            ],
+        }
+        arun, calls = fake_arun(outputs)
+        devstack = CephDevStack()
+        with patch("ceph_devstack.resources.snapshot.host.arun", arun):
+            assert await devstack.status() == 0
+        lines = capsys.readouterr().out.splitlines()
+        assert lines[0].split()[:3] == ["NAME", "STATE", "HEALTH"]
+        rows = {line.split()[0]: line.split() for line in lines[1:] if line}
+        assert rows["postgres"][1:5] == ["running", "healthy", "2m05s", "2"]
+        assert rows["paddles"][1:5] == ["exited", "-", "-", "0"]
+        assert rows["pulpito"][1] == "missing"
+        assert "Latest run: none" in lines
+        assert [args[2] for args in calls] == ["ls", "inspect"]
@@ -1,8 +1,18 @@
+import asyncio
+import shlex
+import subprocess
+import sys
+
 from pathlib import Path
+from unittest.mock import AsyncMock, patch
 
 import pytest
 
 from ceph_devstack.resources.ceph import TestNode
+from ceph_devstack.resources.ceph.containers import (
+    loop_device_provisioner,
+    remote_helper_args,
+)
 from ceph_devstack import config
 
 
@@ -33,3 +43,97 @@ class TestTestnode:
             "/dev/loop6",
             "/dev/loop7",
         ]
+
+    async def test_loop_devices_are_provisioned_in_one_batch(self, cls, tmp_path):
+        config.load(Path(__file__).parent.joinpath("fixtures", "testnode-config.toml"))
+        config["data_dir"] = str(tmp_path)
+        testnodes = [cls(f"testnode_{i}") for i in range(3)]
+        with patch.object(loop_device_provisioner, "run_helper", AsyncMock()) as m:
+            await asyncio.gather(*[t.create_loop_devices() for t in testnodes])
+        m.assert_awaited_once()
+        action, devices = m.await_args.args
+        assert action == "setup"
+        assert [d["device"] for d in devices] == [f"/dev/loop{i}" for i in range(12)]
+        assert devices[5]["image"] == str(tmp_path / "disk_images" / "testnode_1-5")
+
+    async def test_loop_device_helper_failure_propagates(self, cls, tmp_path):
+        config["data_dir"] = str(tmp_path)
+        testnode = cls("testnode_0")
+        with (
+            patch.object(
+                loop_device_provisioner,
+                "run_helper",
+                AsyncMock(side_effect=RuntimeError("nope")),
+            ),
+            pytest.raises(RuntimeError),
+        ):
+            await testnode.remove_loop_devices()
+
+    def test_resource_limits(self, cls):
+        testnode_config = config["containers"]["testnode"]
+        saved = dict(testnode_config)
+        testnode_config.update({"cpus": 2, "memory": "4g"})
+        try:
+            testnode = cls("testnode_0")
+            args = testnode.add_resources_to_args(testnode.create_cmd)
+        finally:
+            testnode_config.clear()
+            testnode_config.update(saved)
+        name = args.index("--name")
+        assert args[name - 4 : name] == ["--cpus", "2", "--memory", "4g"]
+
+    def test_auto_cpuset(self, cls):
+        testnode_config = config["containers"]["testnode"]
+        saved = dict(testnode_config)
+        testnode_config.update(
+            {"cpuset": "auto", "cpuset_mems": "0", "count": 2, "loop_device_count": 1}
+        )
+        partition = [([0, 1, 2, 3], 0), ([4, 5, 6, 7], 1)]
+        try:
+            with patch(
+                "ceph_devstack.resources.ceph.containers.host_partition",
+                return_value=partition,
+            ):
+                args = cls("testnode_1").resource_args()
+        finally:
+            testnode_config.clear()
+            testnode_config.update(saved)
+        assert args == [
+            "--cpuset-cpus",
+            "4-7",
+            "--cpuset-mems",
+            "1",
+            "--blkio-weight-device",
+            "/dev/loop1:500",
+        ]
+
+    def test_remote_helper_args_survive_a_shell(self, cls, tmp_path):
+        image = tmp_path / "testnode_0-0"
+        image.write_bytes(b"x")
+        manifest = {
+            "uid": 0,
+            "gid": 0,
+            "devices": [
+                {"device": str(tmp_path / "loop0"), "image": str(image), "size": "1M"}
+            ],
+        }
+        args = remote_helper_args("teardown", manifest)
+        assert args[:2] == ["sudo", "python3"]
+        # As ssh would: joined with spaces, for the remote shell to split
+        command = " ".join([shlex.quote(sys.executable), *args[2:]])
+        subprocess.run(["sh", "-c", command], check=True)
+        assert not image.exists()
+
+    async def test_helper_runs_in_the_vm_when_podman_is_remote(self, cls):
+        proc = AsyncMock(returncode=0)
+        proc.communicate.return_value = (b"", b"")
+        with (
+            patch("ceph_devstack.resources.ceph.containers.host") as m_host,
+            patch("ceph_devstack.resources.ceph.containers.tempfile") as m_tempfile,
+        ):
+            m_host.arun = AsyncMock(return_value=proc)
+            await loop_device_provisioner.run_helper("setup", [])
+        args = m_host.arun.await_args.args[0]
+        assert args[:3] == ["sudo", "python3", "-c"]
+        assert sys.executable not in args
+        m_tempfile.NamedTemporaryFile.assert_not_called()
@@ -0,0 +1,133 @@
+import asyncio
+import gzip
+import os
+
+from typing import Dict, Tuple
+from unittest.mock import patch
+
+import pytest
+
+from ceph_devstack.archive_server import ArchiveServer, parse_range, HTTPError
+
+
+@pytest.fixture
+async def server(tmp_path):
+    (tmp_path / "run" / "1").mkdir(parents=True)
+    (tmp_path / "run" / "1" / "teuthology.log").write_bytes(b"0123456789" * 1000)
+    with gzip.open(tmp_path / "run" / "1" / "old.log.gz", "wb") as f:
+        f.write(b"compressed contents\n")
+    (tmp_path.parent / "secret").write_text("secret")
+    archive_server = ArchiveServer(str(tmp_path))
+    srv = await asyncio.start_server(archive_server.handle, "127.0.0.1", 0)
+    port = srv.sockets[0].getsockname()[1]
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    yield archive_server, reader, writer, tmp_path
+    writer.close()
+    srv.close()
+    await srv.wait_closed()
+
+
+async def request(
+    reader, writer, path: str, method: str = "GET", **headers
+) -> Tuple[int, Dict[str, str], bytes]:
+    lines = [f"{method} {path} HTTP/1.1", "Host: localhost"]
+    lines += [f"{key.replace('_', '-')}: {value}" for key, value in headers.items()]
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode())
+    await writer.drain()
+    head = await reader.readuntil(b"\r\n\r\n")
+    status_line, *header_lines = head.decode().strip().split("\r\n")
+    response_headers = {}
+    for line in header_lines:
+        key, _, value = line.partition(":")
+        response_headers[key.lower()] = value.strip()
+    if method == "HEAD":
+        body = b""
+    elif "content-length" in response_headers:
+        body = await reader.readexactly(int(response_headers["content-length"]))
+    else:
+        body = await reader.read()
+    return int(status_line.split()[1]), response_headers, body
+
+
+class TestArchiveServer:
+    def test_parse_range(self):
+        assert parse_range("bytes=0-9", 100) == (0, 10)
+        assert parse_range("bytes=90-", 100) == (90, 100)
+        assert parse_range("bytes=-5", 100) == (95, 100)
+        assert parse_range("bytes=0-1,5-6", 100) == (0, 100)
+        with pytest.raises(HTTPError):
+            parse_range("bytes=100-", 100)
+
+    async def test_file_and_keep_alive(self, server):
+        _, reader, writer, _ = server
+        status, headers, body = await request(reader, writer, "/run/1/teuthology.log")
+        assert status == 200
+        assert headers["content-type"].startswith("text/plain")
+        assert body == b"0123456789" * 1000
+        # The same connection serves another request
+        status, _, body = await request(
+            reader, writer, "/run/1/teuthology.log", range="bytes=5-14"
+        )
+        assert status == 206
+        assert body == b"5678901234"
+
+    async def test_compressed(self, server):
+        _, reader, writer, _ = server
+        status, headers, body = await request(
+            reader, writer, "/run/1/old.log", accept_encoding="gzip, deflate"
+        )
+        assert status == 200
+        assert headers["content-encoding"] == "gzip"
+        assert gzip.decompress(body) == b"compressed contents\n"
+        # Clients which can't decompress get it done for them
+        status, headers, body = await request(reader, writer, "/run/1/old.log")
+        assert "content-encoding" not in headers
+        assert body == b"compressed contents\n"
+
+    async def test_listing_cached(self, server):
+        archive_server, reader, writer, tmp_path = server
+        status, headers, _ = await request(reader, writer, "/run")
+        assert status == 301
+        assert headers["location"] == "/run/"
+        with patch("os.scandir", wraps=os.scandir) as m_scandir:
+            status, _, body = await request(reader, writer, "/run/1/")
+            await request(reader, writer, "/run/1/")
+            assert m_scandir.call_count == 1
+            assert b'href="teuthology.log"' in body
+            # Only logs compacted by us are linked by their original names
+            assert b'href="old.log.gz"' in body
+            (tmp_path / "run" / "1" / "new.log").write_text("")
+            os.utime(tmp_path / "run" / "1", ns=(0, 1))
+            _, _, body = await request(reader, writer, "/run/1/")
+            assert m_scandir.call_count == 2
+            assert b"new.log" in body
+
+    def test_listing_links_compacted_logs(self, tmp_path):
+        job_dir = tmp_path / "1"
+        (job_dir / "remote").mkdir(parents=True)
+        for name in ["teuthology.log.zst", "console.tar.gz", "remote/x.log.gz"]:
+            (job_dir / name).write_bytes(b"")
+        body = ArchiveServer(str(tmp_path)).render_listing(str(job_dir), "/1/")
+        assert b'href="teuthology.log"' in body
+        assert b'href="console.tar.gz"' in body
+        assert b'href="remote/"' in body
+        # Part way through compaction, both exist; only one is linked
+        (job_dir / "teuthology.log").write_bytes(b"")
+        body = ArchiveServer(str(tmp_path)).render_listing(str(job_dir), "/1/")
+        assert body.count(b'href="teuthology.log"') == 1
+        assert b'href="teuthology.log.zst"' in body
+
+    async def test_errors(self, server):
+        _, reader, writer, _ = server
+        assert (await request(reader, writer, "/missing"))[0] == 404
+        assert (await request(reader, writer, "/../secret"))[0] == 403
+        assert (await request(reader, writer, "/%2e%2e/secret"))[0] == 403
+        status, headers, _ = await request(
+            reader, writer, "/run/1/teuthology.log", range="bytes=20000-"
+        )
+        assert status == 416
+        assert headers["content-range"] == "bytes */10000"
+        status, _, body = await request(
+            reader, writer, "/run/1/teuthology.log", method="HEAD"
+        )
+        assert status == 200
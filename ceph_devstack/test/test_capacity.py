@@ -0,0 +1,101 @@
+import os
+
+from unittest.mock import patch
+
+from ceph_devstack.capacity import (
+    GiB,
+    CapacityPlan,
+    forget_loop_device_size,
+    memory_total,
+    resolve_auto,
+    unallocated_bytes,
+)
+
+
+class TestCapacity:
+    def test_memory_total(self, tmp_path):
+        meminfo = tmp_path / "meminfo"
+        meminfo.write_text("MemTotal:       16384000 kB\nMemFree:  1 kB\n")
+        assert memory_total(meminfo) == 16384000 * 1024
+        assert memory_total(tmp_path / "missing") is None
+
+    def test_explicit_settings_are_kept(self):
+        plan = CapacityPlan(
+            {"count": 3, "loop_device_size": "5G"}, 64, 256 * GiB, 10 * GiB
+        )
+        assert (plan.count, plan.loop_device_size) == (3, 5 * GiB)
+        assert plan.notes == []
+
+    def test_auto_count(self):
+        testnode_config = {
+            "count": "auto",
+            "loop_device_size": "5G",
+            "cpus_per_testnode": 2,
+            "memory_per_testnode": "4G",
+        }
+        # Limited by CPUs
+        assert CapacityPlan(testnode_config, 8, 128 * GiB, 0).count == 4
+        # Limited by memory
+        assert CapacityPlan(testnode_config, 32, 16 * GiB, 0).count == 4
+        # Always at least one
+        assert CapacityPlan(testnode_config, 1, GiB, 0).count == 1
+        # No more loop devices than a cluster has
+        assert CapacityPlan(testnode_config, 1024, 4096 * GiB, 0).count == 100
+
+    def test_auto_loop_device_size(self):
+        testnode_config = {
+            "count": 4,
+            "loop_device_count": 2,
+            "loop_device_size": "auto",
+            "disk_reserve": "20G",
+            "max_loop_device_size": "50G",
+        }
+        plan = CapacityPlan(testnode_config, 8, None, 100 * GiB)
+        assert plan.loop_device_size == 10 * GiB
+        assert plan.total_loop_device_size == 80 * GiB
+        assert CapacityPlan(testnode_config, 8, None, 2000 * GiB).loop_device_size == (
+            50 * GiB
+        )
+        assert CapacityPlan(testnode_config, 8, None, 10 * GiB).loop_device_size == GiB
+
+    def test_resolve_auto(self, tmp_path):
+        config = {
+            "data_dir": str(tmp_path),
+            "containers": {"testnode": {"count": "auto", "loop_device_size": "1G"}},
+        }
+        plan = resolve_auto(config)
+        assert plan is not None
+        assert config["containers"]["testnode"]["count"] == plan.count >= 1
+        assert resolve_auto(config) is None
+
+    def test_auto_loop_device_size_is_kept(self, tmp_path):
+        def resolve(free):
+            config = {
+                "data_dir": str(tmp_path),
+                "containers": {"testnode": {"count": 2, "loop_device_size": "auto"}},
+            }
+            with patch("ceph_devstack.capacity.disk_free", return_value=free) as m:
+                resolve_auto(config)
+            m.assert_called_once_with(tmp_path / "disk_images")
+            return config["containers"]["testnode"]["loop_device_size"]
+
+        assert resolve(100 * GiB) == str(40 * GiB)
+        # The images have since used some of the disk
+        assert resolve(30 * GiB) == str(40 * GiB)
+        forget_loop_device_size(tmp_path)
+        assert resolve(30 * GiB) == str(5 * GiB)
+
+    def test_unallocated_bytes(self, tmp_path):
+        sparse = tmp_path / "sparse"
+        with open(sparse, "wb") as f:
+            f.truncate(GiB)
+        written = tmp_path / "written"
+        written.write_bytes(b"x" * 2**20)
+        allocated = os.stat(written).st_blocks * 512
+        devices = [
+            {"image": str(sparse), "size": "1G"},
+            {"image": str(written), "size": "1G"},
+            {"image": str(tmp_path / "missing"), "size": "1G"},
+        ]
+        needed = unallocated_bytes(devices)
+        assert needed == 3 * GiB - allocated - os.stat(sparse).st_blocks * 512
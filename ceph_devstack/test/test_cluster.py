@@ -0,0 +1,116 @@
+import json
+import threading
+
+import pytest
+
+from ceph_devstack.cluster import (
+    Cluster,
+    MAX_SLOTS,
+    SlotRegistry,
+    cluster,
+    validate_name,
+)
+
+
+@pytest.fixture
+def named_cluster(tmp_path):
+    cluster.select("blue", tmp_path)
+    yield cluster
+    cluster.release()
+    cluster.__init__()
+
+
+class TestSlotRegistry:
+    def test_allocate(self, tmp_path):
+        registry = SlotRegistry(tmp_path / "clusters.json")
+        assert registry.allocate("a") == 1
+        assert registry.allocate("b") == 2
+        assert registry.allocate("a") == 1
+        assert json.loads((tmp_path / "clusters.json").read_text()) == {"a": 1, "b": 2}
+
+    def test_release_frees_slot(self, tmp_path):
+        registry = SlotRegistry(tmp_path / "clusters.json")
+        registry.allocate("a")
+        registry.allocate("b")
+        registry.release("a")
+        assert registry.allocate("c") == 1
+
+    def test_full(self, tmp_path):
+        registry = SlotRegistry(tmp_path / "clusters.json")
+        for i in range(1, MAX_SLOTS):
+            registry.allocate(f"c{i}")
+        with pytest.raises(RuntimeError):
+            registry.allocate("one-too-many")
+
+    def test_concurrent(self, tmp_path):
+        slots = []
+
+        def allocate(name):
+            slots.append(SlotRegistry(tmp_path / "clusters.json").allocate(name))
+
+        threads = [threading.Thread(target=allocate, args=(f"c{i}",)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert sorted(slots) == list(range(1, 9))
+
+
+class TestCluster:
+    def test_default(self, tmp_path):
+        default = Cluster()
+        assert default.prefix("postgres") == "postgres"
+        assert default.port(5432) == 5432
+        assert default.loop_device_offset == 0
+        assert default.data_dir(tmp_path) == tmp_path
+        assert default.secret_arg("id_rsa") == "id_rsa"
+
+    def test_named(self, tmp_path, named_cluster):
+        assert named_cluster.slot == 1
+        assert named_cluster.prefix("postgres") == "blue-postgres"
+        assert named_cluster.port(5432) == 6432
+        assert named_cluster.loop_device_offset == 100
+        assert named_cluster.data_dir(tmp_path) == tmp_path / "clusters" / "blue"
+        assert named_cluster.secret_arg("id_rsa") == "blue-id_rsa,target=id_rsa"
+
+    @pytest.mark.parametrize("name", ["", "-x", "a b", "a/b"])
+    def test_invalid_name(self, name):
+        with pytest.raises(ValueError):
+            validate_name(name)
+
+
+class TestClusterResources:
+    def test_container_args(self, named_cluster):
+        from ceph_devstack.resources.ceph.containers import Postgres
+
+        postgres = Postgres()
+        assert postgres.name == "blue-postgres"
+        args = postgres.add_cluster_to_args(postgres.format_cmd(postgres.create_cmd))
+        assert args[args.index("--network") + 1] == "blue-ceph-devstack"
+        assert args[args.index("--network-alias") + 1] == "postgres"
+        assert args[args.index("-p") + 1] == "6432:5432"
+        assert args[args.index("--name") + 1] == "blue-postgres"
+
+    def test_default_container_args(self):
+        from ceph_devstack.resources.ceph.containers import Postgres
+
+        postgres = Postgres()
+        args = postgres.add_cluster_to_args(postgres.format_cmd(postgres.create_cmd))
+        assert "--network-alias" not in args
+        assert args[args.index("-p") + 1] == "5432:5432"
+
+    def test_testnode(self, named_cluster):
+        from ceph_devstack.resources.ceph.containers import TestNode
+
+        testnode = TestNode("testnode_1")
+        assert testnode.name == "blue-testnode_1"
+        assert testnode.index == 1
+        assert testnode.devices[0] == f"/dev/loop{100 + testnode.loop_device_count}"
+        assert "blue-id_rsa.pub,target=id_rsa.pub" in testnode.create_cmd
+
+    def test_images_are_shared(self, named_cluster):
+        from ceph_devstack.resources.ceph.containers import Teuthology
+
+        teuthology = Teuthology()
+        build_cmd = teuthology.format_cmd(teuthology.build_cmd)
+        assert build_cmd[build_cmd.index("-t") + 1].startswith("teuthology:")
@@ -0,0 +1,82 @@
+import logging
+import sys
+
+from subprocess import CalledProcessError
+
+import pytest
+
+from ceph_devstack import VERBOSE
+from ceph_devstack.exec import Command, LineBuffer, OUTPUT_TAIL_LINES
+from ceph_devstack.resources import PodmanResource
+
+
+class TestLineBuffer:
+    def test_split_character(self):
+        buf = LineBuffer()
+        data = "héllo\n".encode()
+        assert buf.feed(data[:2]) == []
+        assert buf.feed(data[2:]) == ["héllo"]
+
+    def test_partial_lines(self):
+        buf = LineBuffer()
+        assert buf.feed(b"a\nb") == ["a"]
+        assert buf.feed(b"c\r\nd\re") == ["bc", "d"]
+        assert buf.flush() == ["e"]
+        assert buf.flush() == []
+
+    def test_long_line(self):
+        buf = LineBuffer(max_line=10)
+        assert buf.feed(b"x" * 4) == []
+        assert buf.feed(b"x" * 8) == ["x" * 12]
+        assert buf.partial == ""
+
+
+class TestStreamOutput:
+    async def test_logs_lines(self, caplog):
+        script = "import sys; sys.stdout.write('one\\ntwo'); sys.stderr.write('err\\n')"
+        with caplog.at_level(VERBOSE, logger="ceph-devstack"):
+            proc = await Command(
+                [sys.executable, "-c", script], stream_output=True
+            ).arun()
+            assert await proc.wait() == 0
+        messages = [r.getMessage() for r in caplog.records if r.levelno == VERBOSE]
+        assert "one" in messages and "two" in messages and "err" in messages
+        assert sorted(proc.output_tail) == ["err", "one", "two"]
+        # Output goes to the log, not to the readers
+        assert await proc.stdout.read() == b""
+
+    async def test_tail_is_bounded(self):
+        count = 10 * OUTPUT_TAIL_LINES
+        script = f"for i in range({count}): print(i)"
+        proc = await Command([sys.executable, "-c", script], stream_output=True).arun()
+        assert await proc.wait() == 0
+        assert list(proc.output_tail) == [
+            str(i) for i in range(count - OUTPUT_TAIL_LINES, count)
+        ]
+
+    async def test_no_formatting_when_disabled(self, monkeypatch):
+        logger = logging.getLogger("ceph-devstack")
+        monkeypatch.setattr(logger, "isEnabledFor", lambda level: False)
+        calls = []
+        monkeypatch.setattr(logger, "log", lambda *args: calls.append(args))
+        proc = await Command(["echo", "hi"], stream_output=True).arun()
+        assert await proc.wait() == 0
+        # Only the command itself was logged
+        assert calls == [(VERBOSE, "> echo hi")]
+        assert list(proc.output_tail) == ["hi"]
+
+
+class TestCmdError:
+    @pytest.mark.parametrize("stream_output", [True, False])
+    async def test_output_attached(self, stream_output):
+        resource = PodmanResource("test")
+        script = "import sys; print('starting'); sys.exit('it broke')"
+        with pytest.raises(CalledProcessError) as excinfo:
+            await resource.cmd(
+                [sys.executable, "-c", script],
+                check=True,
+                force_local=True,
+                stream_output=stream_output,
+            )
+        assert excinfo.value.returncode == 1
+        assert "it broke" in excinfo.value.output
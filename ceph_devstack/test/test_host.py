@@ -0,0 +1,108 @@
+import asyncio
+import json
+
+from unittest.mock import Mock, patch
+
+from ceph_devstack.host import LocalHost, RemoteHost
+
+MACHINE = [
+    {
+        "Name": "podman-machine-default",
+        "SSHConfig": {
+            "IdentityPath": "/home/u/.ssh/podman-machine-default",
+            "Port": 50321,
+            "RemoteUsername": "core",
+        },
+    }
+]
+
+
+def fake_run(inspect_output, check_rc=0):
+    calls = []
+
+    def run(args):
+        calls.append(args)
+        proc = Mock(returncode=0)
+        if args[:3] == ["podman", "machine", "inspect"]:
+            proc.stdout.read.return_value = inspect_output
+        elif "-O" in args:
+            proc.returncode = check_rc
+        return proc
+
+    return run, calls
+
+
+class TestRemoteHost:
+    def test_cmd_uses_multiplexed_ssh(self):
+        run, calls = fake_run(json.dumps(MACHINE).encode())
+        with patch("ceph_devstack.host.local_host.run", run):
+            remote = RemoteHost()
+            cmd = remote.cmd(["hostname"])
+            remote.cmd(["ls", "/"])
+        assert cmd.args[0] == "ssh"
+        assert cmd.args[-3:] == ["core@localhost", "--", "hostname"]
+        assert "ControlMaster=auto" in cmd.args
+        assert cmd.args[3:5] == ["-p", "50321"]
+        # inspect and the master check happen only once
+        assert len(calls) == 2
+
+    def test_master_started_when_missing(self):
+        run, calls = fake_run(json.dumps(MACHINE).encode(), check_rc=255)
+        with patch("ceph_devstack.host.local_host.run", run):
+            RemoteHost().cmd(["hostname"])
+        assert "-M" in calls[-1]
+
+    def test_podman_args_not_prefixed(self):
+        remote = RemoteHost()
+        assert remote.cmd(["podman", "ps"]).args == ["podman", "ps"]
+
+    def test_falls_back_to_podman_machine_ssh(self):
+        run, _ = fake_run(b"not json")
+        with patch("ceph_devstack.host.local_host.run", run):
+            cmd = RemoteHost().cmd(["hostname"])
+        assert cmd.args == ["podman", "machine", "ssh", "--", "hostname"]
+
+
+class TestLocalHost:
+    async def test_probes_do_not_fork(self, tmp_path):
+        host = LocalHost()
+        with patch.object(host, "arun") as m_arun:
+            await host.get_sysctl_value("kernel.pid_max")
+            await host.selinux_enforcing()
+            await host.check_selinux_bool("container_use_devices")
+            assert await host.test_path("-e", str(tmp_path))
+            assert not await host.test_path("-e", str(tmp_path / "missing"))
+            assert await host.which("sh")
+            host.kernel_version()
+        m_arun.assert_not_called()
+
+    async def test_get_sysctl_value(self):
+        with open("/proc/sys/kernel/pid_max") as f:
+            expected = int(f.read())
+        assert await LocalHost().get_sysctl_value("kernel.pid_max") == expected
+
+    def test_os_type(self, tmp_path):
+        os_release = tmp_path / "os-release"
+        os_release.write_text('NAME="Fedora Linux"\nID=fedora\nVERSION_ID=40\n')
+        real_open = open
+        with patch(
+            "builtins.open",
+            lambda path, *a, **kw: real_open(
+                os_release if path == "/etc/os-release" else path, *a, **kw
+            ),
+        ):
+            assert LocalHost().os_type() == "fedora"
+
+    async def test_podman_info_runs_once(self):
+        host = LocalHost()
+        calls = []
+
+        async def get_podman_info():
+            calls.append(1)
+            await asyncio.sleep(0)
+            return {"host": {}}
+
+        with patch.object(host, "_get_podman_info", get_podman_info):
+            results = await asyncio.gather(*[host.podman_info() for _ in range(3)])
+        assert results == [{"host": {}}] * 3
+        assert len(calls) == 1
@@ -0,0 +1,100 @@
+import errno
+import json
+
+import pytest
+
+from unittest.mock import patch
+
+from ceph_devstack import loop_helper
+
+
+class TestLoopHelper:
+    @pytest.mark.parametrize(
+        "size,res",
+        [("5G", 5 * 2**30), ("512M", 512 * 2**20), ("10gb", 10 * 2**30), (4096, 4096)],
+    )
+    def test_parse_size(self, size, res):
+        assert loop_helper.parse_size(size) == res
+
+    def test_teardown_removes_images(self, tmp_path):
+        image = tmp_path / "testnode_0-0"
+        image.write_bytes(b"x")
+        manifest = tmp_path / "manifest.json"
+        manifest.write_text(
+            json.dumps(
+                {
+                    "uid": 0,
+                    "gid": 0,
+                    "devices": [
+                        {
+                            "device": str(tmp_path / "no-such-loop"),
+                            "image": str(image),
+                            "size": "1G",
+                        }
+                    ],
+                }
+            )
+        )
+        assert loop_helper.main(["teardown", str(manifest)]) == 0
+        assert not image.exists()
+
+    def test_unknown_action_fails(self, tmp_path):
+        manifest = tmp_path / "manifest.json"
+        manifest.write_text(
+            json.dumps({"uid": 0, "gid": 0, "devices": [{"device": "x", "image": "y"}]})
+        )
+        assert loop_helper.main(["frobnicate", str(manifest)]) == 1
+
+    def entry(self, tmp_path, **kwargs):
+        return {"device": "x", "image": str(tmp_path / "img"), "size": "1M", **kwargs}
+
+    def test_prepare_creates_sparse_image(self, tmp_path):
+        entry = self.entry(tmp_path)
+        loop_helper.prepare_image(entry)
+        stat = (tmp_path / "img").stat()
+        assert stat.st_size == 2**20
+        assert stat.st_blocks * 512 < 2**20
+
+    def test_prepare_preallocates(self, tmp_path):
+        entry = self.entry(tmp_path, preallocate=True)
+        loop_helper.prepare_image(entry)
+        assert (tmp_path / "img").stat().st_blocks * 512 >= 2**20
+
+    def test_pooled_image_is_reused_and_scrubbed(self, tmp_path):
+        entry = self.entry(tmp_path, pool=True)
+        loop_helper.prepare_image(entry)
+        image = tmp_path / "img"
+        inode = image.stat().st_ino
+        with open(image, "r+b") as f:
+            f.write(b"osd data")
+        loop_helper.teardown_device(entry, set())
+        assert image.exists()
+        loop_helper.prepare_image(entry)
+        assert image.stat().st_ino == inode
+        assert image.read_bytes() == b"\0" * 2**20
+
+    def test_unpooled_image_is_removed(self, tmp_path):
+        entry = self.entry(tmp_path)
+        loop_helper.prepare_image(entry)
+        loop_helper.teardown_device(entry, set())
+        assert not (tmp_path / "img").exists()
+
+    def test_golden_image_falls_back_without_reflink(self, tmp_path):
+        golden = tmp_path / "golden"
+        golden.write_bytes(b"golden")
+        entry = self.entry(tmp_path, golden=str(golden))
+        unsupported = OSError(errno.EOPNOTSUPP, "Operation not supported")
+        with patch("fcntl.ioctl", side_effect=unsupported):
+            loop_helper.prepare_image(entry)
+        content = (tmp_path / "img").read_bytes()
+        assert content == b"golden" + b"\0" * (2**20 - len(b"golden"))
+
+    def test_golden_image_clone_errors_are_raised(self, tmp_path):
+        golden = tmp_path / "golden"
+        golden.write_bytes(b"golden")
+        entry = self.entry(tmp_path, golden=str(golden))
+        with (
+            patch("fcntl.ioctl", side_effect=OSError(errno.EIO, "I/O error")),
+            pytest.raises(OSError),
+        ):
+            loop_helper.prepare_image(entry)
@@ -0,0 +1,37 @@
+from ceph_devstack.metrics import Family, metrics, render
+
+
+class TestMetrics:
+    def test_render(self):
+        family = Family("things", "gauge", "Some things")
+        family.add(1, name='a "quoted"\\name')
+        family.add(2.5)
+        assert render([family]) == (
+            "# HELP ceph_devstack_things Some things\n"
+            "# TYPE ceph_devstack_things gauge\n"
+            'ceph_devstack_things{name="a \\"quoted\\"\\\\name"} 1\n'
+            "ceph_devstack_things 2.5\n"
+        )
+
+    def test_store(self, metrics_path):
+        metrics.inc("watch_restarts_total", {"container": "paddles", "reason": "x"})
+        metrics.inc("watch_restarts_total", {"reason": "x", "container": "paddles"})
+        metrics.set("time_to_healthy_seconds", {"container": "paddles"}, 3)
+        metrics.set("time_to_healthy_seconds", {"container": "paddles"}, 4)
+        assert metrics_path.exists()
+        text = render(metrics.families())
+        assert (
+            'ceph_devstack_watch_restarts_total{container="paddles",reason="x"} 2'
+            in text
+        )
+        assert 'ceph_devstack_time_to_healthy_seconds{container="paddles"} 4' in text
+        assert "# TYPE ceph_devstack_watch_restarts_total counter" in text
+
+    def test_store_failure_is_harmless(self, metrics_path):
+        metrics_path.mkdir()
+        metrics.inc("watch_restarts_total", {"container": "paddles"})
+
+    def test_corrupt_store_is_harmless(self, metrics_path):
+        metrics_path.write_text("{not json")
+        metrics.set("time_to_healthy_seconds", {"container": "paddles"}, 1)
+        assert all(family.samples == [] for family in metrics.families())
@@ -0,0 +1,131 @@
+import asyncio
+import json
+
+import pytest
+
+from ceph_devstack.podman_api import APIBackend, APIError, LibpodClient
+
+
+class FakePodman:
+    # A stand-in for podman's API socket which serves canned responses
+    def __init__(self, routes):
+        self.routes = routes
+        self.requests = []
+        self.connections = 0
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        while request_line := await reader.readline():
+            method, path, _ = request_line.decode().split(" ", 2)
+            headers = {}
+            while (line := await reader.readline()) != b"\r\n":
+                key, _, value = line.decode().partition(":")
+                headers[key.strip().lower()] = value.strip()
+            if length := int(headers.get("content-length", 0)):
+                await reader.readexactly(length)
+            self.requests.append((method, path))
+            status, body, chunked = self.routes.get(
+                (method, path.split("?")[0]), (404, {"message": "no such thing"}, False)
+            )
+            head = f"HTTP/1.1 {status} X\r\nContent-Type: application/json\r\n"
+            if chunked:
+                writer.write(f"{head}Transfer-Encoding: chunked\r\n\r\n".encode())
+                for item in body:
+                    data = json.dumps(item).encode() + b"\n"
+                    writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                writer.write(b"0\r\n\r\n")
+            else:
+                data = json.dumps(body).encode() if body is not None else b""
+                writer.write(f"{head}Content-Length: {len(data)}\r\n\r\n".encode())
+                writer.write(data)
+            await writer.drain()
+        writer.close()
+
+
+@pytest.fixture
+async def podman(tmp_path):
+    routes = {
+        ("POST", "/v4.0.0/libpod/containers/paddles/start"): (204, None, False),
+        ("POST", "/v4.0.0/libpod/containers/pulpito/start"): (304, None, False),
+        ("GET", "/v4.0.0/libpod/containers/paddles/json"): (
+            200,
+            {"Name": "paddles", "State": {"Status": "running"}},
+            False,
+        ),
+        ("POST", "/v4.0.0/libpod/containers/paddles/wait"): (200, 3, False),
+        ("GET", "/v4.0.0/libpod/events"): (
+            200,
+            [
+                {
+                    "Type": "container",
+                    "Action": "died",
+                    "Actor": {"ID": "abc", "Attributes": {"name": "paddles"}},
+                }
+            ],
+            True,
+        ),
+    }
+    fake = FakePodman(routes)
+    socket_path = str(tmp_path / "podman.sock")
+    server = await asyncio.start_unix_server(fake.handle, socket_path)
+    fake.client = LibpodClient(socket_path)
+    yield fake
+    await fake.client.close()
+    server.close()
+
+
+class TestLibpodClient:
+    async def test_connection_is_reused(self, podman):
+        await podman.client.container_start("paddles")
+        await podman.client.container_start("pulpito")
+        inspect = await podman.client.container_inspect("paddles")
+        assert inspect["State"]["Status"] == "running"
+        assert podman.connections == 1
+        assert len(podman.requests) == 3
+
+    async def test_error(self, podman):
+        with pytest.raises(APIError) as exc:
+            await podman.client.container_inspect("nope")
+        assert exc.value.status == 404
+        assert exc.value.message == "no such thing"
+
+    async def test_wait_condition(self, podman):
+        assert await podman.client.container_wait("paddles", "healthy") == 3
+        assert podman.requests[-1][1].endswith("wait?condition=healthy")
+
+    async def test_events(self, podman):
+        events = [
+            event
+            async for event in podman.client.events(
+                {"type": ["container"], "container": ["paddles"]}
+            )
+        ]
+        assert events[0]["Name"] == "paddles"
+        assert events[0]["Status"] == "died"
+
+
+class TestAPIBackend:
+    async def test_translates_cli_args(self, podman):
+        backend = APIBackend(podman.client)
+        proc = await backend.run(["podman", "container", "start", "paddles"])
+        assert await proc.wait() == 0
+        proc = await backend.run(["podman", "container", "inspect", "paddles"])
+        out, _ = await proc.communicate()
+        assert json.loads(out)[0]["Name"] == "paddles"
+        proc = await backend.run(["podman", "wait", "paddles"])
+        out, _ = await proc.communicate()
+        assert out == b"3\n"
+
+    async def test_failure_sets_returncode(self, podman):
+        backend = APIBackend(podman.client)
+        proc = await backend.run(["podman", "container", "inspect", "nope"])
+        out, err = await proc.communicate()
+        assert proc.returncode == 125
+        assert json.loads(out) == []
+        assert b"no such thing" in err
+
+    async def test_unsupported_falls_back(self, podman):
+        backend = APIBackend(podman.client)
+        assert await backend.run(["podman", "container", "create", "x"]) is None
+        assert await backend.run(["podman", "pull", "x"]) is None
+        assert podman.requests == []
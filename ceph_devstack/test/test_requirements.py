@@ -0,0 +1,120 @@
+import asyncio
+
+from unittest.mock import patch
+
+from ceph_devstack import config
+from ceph_devstack import requirements
+from ceph_devstack.requirements import (
+    cache_requirements,
+    check_requirements,
+    requirements_cached,
+    requirements_fingerprint,
+)
+
+
+class TestRequirementsCache:
+    def setup_method(self):
+        self.data_dir = config["data_dir"]
+
+    def teardown_method(self):
+        config["data_dir"] = self.data_dir
+
+    def test_fingerprint_is_stable(self):
+        assert requirements_fingerprint() == requirements_fingerprint()
+
+    def test_fingerprint_tracks_config(self):
+        before = requirements_fingerprint()
+        with patch.dict(config["containers"]["postgres"], {"count": 0}):
+            assert requirements_fingerprint() != before
+        assert requirements_fingerprint() == before
+
+    def test_cache_roundtrip(self, tmp_path):
+        config["data_dir"] = str(tmp_path)
+        assert not requirements_cached()
+        cache_requirements()
+        assert requirements_cached()
+        with patch("ceph_devstack.requirements.os.uname") as m_uname:
+            m_uname.return_value.release = "0.0.1"
+            assert not requirements_cached()
+
+    def test_no_cache_for_remote_hosts(self, tmp_path):
+        config["data_dir"] = str(tmp_path)
+        with patch("ceph_devstack.requirements.host.type", "remote"):
+            cache_requirements()
+            assert not requirements_cached()
+
+
+class TestCheckRequirements:
+    def patch_checks(self, results):
+        calls = []
+        active = {"now": 0, "max": 0}
+
+        def fake(name):
+            async def evaluate(*args):
+                calls.append(name)
+                active["now"] += 1
+                active["max"] = max(active["max"], active["now"])
+                await asyncio.sleep(0.01)
+                active["now"] -= 1
+                return results.get(name, True)
+
+            return evaluate
+
+        names = [
+            "PodmanPlatform",
+            "PodmanGraphDriver",
+            "KernelVersionForOverlay",
+            "PodmanVersion",
+            "FuseOverlayfsPresence",
+            "CgroupV2",
+            "KernelVersionForCgroupV2",
+            "PodmanRuntime",
+            "SELinuxBoolean",
+            "PodmanDNSPlugin",
+            "SysctlValue",
+        ]
+        patches = [
+            patch.object(getattr(requirements, name), "evaluate", fake(name))
+            for name in names
+        ]
+        patches.append(
+            patch.object(requirements.PodmanDNSPlugin, "__init__", lambda self: None)
+        )
+        patches.append(
+            patch.object(requirements.host, "selinux_enforcing", fake("enforcing"))
+        )
+        for p in patches:
+            p.start()
+        return calls, active, patches
+
+    async def run(self, results):
+        calls, active, patches = self.patch_checks(results)
+        try:
+            result = await check_requirements()
+        finally:
+            for p in patches:
+                p.stop()
+        return result, calls, active
+
+    async def test_all_pass_concurrently(self):
+        result, calls, active = await self.run({"enforcing": False})
+        assert result is True
+        assert active["max"] > 1
+        assert "FuseOverlayfsPresence" not in calls
+        assert "KernelVersionForCgroupV2" not in calls
+        assert "SELinuxBoolean" not in calls
+
+    async def test_dependent_checks(self):
+        result, calls, _ = await self.run(
+            {"KernelVersionForOverlay": False, "FuseOverlayfsPresence": False}
+        )
+        assert result is False
+        assert "FuseOverlayfsPresence" in calls
+        assert calls.count("SELinuxBoolean") == 2
+        # Independent checks still run, so their failures are reported too
+        assert calls.count("SysctlValue") == 2
+
+    async def test_platform_gates_everything(self):
+        result, calls, _ = await self.run({"PodmanPlatform": False})
+        assert result is False
+        assert calls == ["PodmanPlatform"]
@@ -0,0 +1,58 @@
+import subprocess
+import sys
+
+from unittest.mock import patch
+
+# Modules which the CLI shouldn't need until it knows what it's been asked to do
+DEFERRED_MODULES = [
+    "ceph_devstack.podman_api",
+    "ceph_devstack.requirements",
+    "ceph_devstack.resources",
+    "logging.config",
+    "tomlkit",
+]
+# Generous, so as not to be flaky; a regression like an import-time DNS lookup
+# or an eagerly-imported heavy dependency will still blow through it
+IMPORT_BUDGET_US = 500_000
+
+
+def import_times(module: str):
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+class TestStartup:
+    def test_cli_defers_imports(self):
+        times = import_times("ceph_devstack.cli")
+        assert "ceph_devstack.cli" in times
+        for module in DEFERRED_MODULES:
+            assert not [name for name in times if name.startswith(module)]
+
+    def test_cli_import_budget(self):
+        times = import_times("ceph_devstack.cli")
+        assert times["ceph_devstack.cli"] < IMPORT_BUDGET_US
+
+    def test_hostname_is_lazy(self):
+        from ceph_devstack.resources.ceph.containers import Paddles
+
+        with patch("ceph_devstack.resources.ceph.containers.host") as m_host:
+            m_host.hostname.return_value = "myhost"
+            paddles = Paddles()
+            m_host.hostname.assert_not_called()
+            args = paddles.add_env_to_args(paddles.create_cmd)
+        assert (
+            "PADDLES_JOB_LOG_HREF_TEMPL="
+            "http://myhost:8000/{run_name}/{job_id}/teuthology.log" in args
+        )
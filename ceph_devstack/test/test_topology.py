@@ -0,0 +1,53 @@
+import pytest
+
+from ceph_devstack.topology import (
+    format_cpulist,
+    numa_nodes,
+    parse_cpulist,
+    partition,
+)
+
+
+class TestTopology:
+    @pytest.mark.parametrize(
+        "text,cpus",
+        [("0-3", [0, 1, 2, 3]), ("0,2,4-5\n", [0, 2, 4, 5]), ("", []), ("7", [7])],
+    )
+    def test_cpulist(self, text, cpus):
+        assert parse_cpulist(text) == cpus
+        assert format_cpulist(cpus) == text.strip()
+
+    def test_numa_nodes(self, tmp_path, monkeypatch):
+        monkeypatch.setattr("os.sched_getaffinity", lambda pid: set(range(8)))
+        for node, cpulist in [(0, "0-3"), (1, "4-7,8-11"), (2, "")]:
+            (tmp_path / f"node{node}").mkdir()
+            (tmp_path / f"node{node}" / "cpulist").write_text(cpulist + "\n")
+        (tmp_path / "has_cpu").write_text("0-11\n")
+        assert numa_nodes(tmp_path) == {0: [0, 1, 2, 3], 1: [4, 5, 6, 7]}
+
+    def test_numa_nodes_without_numa(self, tmp_path, monkeypatch):
+        monkeypatch.setattr("os.sched_getaffinity", lambda pid: {0, 1})
+        assert numa_nodes(tmp_path) == {0: [0, 1]}
+
+    def test_partition_is_disjoint_and_node_local(self):
+        nodes = {0: list(range(8)), 1: list(range(8, 16))}
+        result = partition(nodes, 3)
+        assert result == [
+            ([0, 1, 2, 3], 0),
+            ([4, 5, 6, 7], 0),
+            (list(range(8, 16)), 1),
+        ]
+        cpus = [cpu for cpuset, _ in result for cpu in cpuset]
+        assert len(cpus) == len(set(cpus))
+
+    def test_partition_uneven_nodes(self):
+        nodes = {0: list(range(12)), 1: list(range(12, 16))}
+        assert [node for _, node in partition(nodes, 4)] == [0, 0, 0, 1]
+
+    def test_partition_more_than_cpus(self):
+        result = partition({0: [0, 1]}, 3)
+        assert len(result) == 3
+        assert all(cpuset for cpuset, _ in result)
+
+    def test_partition_none(self):
+        assert partition({0: [0, 1]}, 0) == []
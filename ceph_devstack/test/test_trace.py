@@ -0,0 +1,78 @@
+import asyncio
+import json
+
+import pytest
+
+from ceph_devstack.exec import Command
+from ceph_devstack.trace import Tracer, traced, tracer
+
+
+@pytest.fixture
+def enabled_tracer():
+    tracer.enable()
+    yield tracer
+    tracer.enabled = False
+    tracer.spans = []
+
+
+class Resource:
+    def __init__(self, name):
+        self.name = name
+
+    @traced
+    async def create(self):
+        proc = await Command(["echo", self.name]).arun()
+        await proc.communicate()
+        proc = await Command(["sh", "-c", "exit 3"]).arun()
+        await proc.wait()
+
+
+class SubResource(Resource):
+    @traced
+    async def create(self):
+        await super().create()
+
+
+class TestTracer:
+    def test_disabled(self):
+        t = Tracer()
+        with t.span("x") as span:
+            assert span is None
+        assert t.start("y") is None
+        assert t.spans == []
+
+    async def test_commands_are_children_of_actions(self, enabled_tracer):
+        await asyncio.gather(Resource("a").create(), Resource("b").create())
+        spans = {span.name: span for span in enabled_tracer.spans}
+        assert spans["echo a"].parent is spans["a.create"]
+        assert spans["echo b"].parent is spans["b.create"]
+        assert spans["echo a"].args == {"returncode": 0, "output_bytes": 2}
+        assert spans["sh -c exit 3"].args["returncode"] == 3
+        assert spans["sh -c exit 3"].category == "command"
+
+    async def test_overrides_recorded_once(self, enabled_tracer):
+        await SubResource("c").create()
+        names = [span.name for span in enabled_tracer.spans]
+        assert names.count("c.create") == 1
+
+    def test_chrome_trace_lanes(self, enabled_tracer):
+        # Two overlapping siblings under one parent, and a child of the first
+        parent = enabled_tracer.start("parent")
+        first = enabled_tracer.start("first")
+        second = enabled_tracer.start("second")
+        first.parent = second.parent = parent
+        child = enabled_tracer.start("child")
+        child.parent = first
+        parent.start, parent.end = 0, 100
+        first.start, first.end = 10, 50
+        second.start, second.end = 20, 60
+        child.start, child.end = 15, 40
+        enabled_tracer.spans = [parent, first, second, child]
+        lanes = enabled_tracer.lanes()
+        assert lanes[first.id] == lanes[parent.id] == lanes[child.id]
+        assert lanes[second.id] != lanes[first.id]
+        trace = json.loads(json.dumps(enabled_tracer.chrome_trace()))
+        events = {event["name"]: event for event in trace["traceEvents"]}
+        assert events["second"]["ph"] == "X"
+        assert events["second"]["dur"] == 40
+        assert events["child"]["args"]["parent"] == "first"
@@ -0,0 +1,80 @@
+import functools
+import os
+
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+SYS_NODE_PATH = Path("/sys/devices/system/node")
+
+
+def parse_cpulist(text: str) -> List[int]:
+    # e.g. "0-3,8,10-11", as found in sysfs
+    cpus: List[int] = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def format_cpulist(cpus: List[int]) -> str:
+    ranges: List[str] = []
+    cpus = sorted(cpus)
+    start = prev = None
+    for cpu in cpus + [None]:
+        if start is not None and (cpu is None or cpu != prev + 1):
+            ranges.append(str(start) if start == prev else f"{start}-{prev}")
+            start = None
+        if start is None:
+            start = cpu
+        prev = cpu
+    return ",".join(ranges)
+
+
+def numa_nodes(root: Path = SYS_NODE_PATH) -> Dict[int, List[int]]:
+    # The CPUs of each NUMA node that we're allowed to use. Without NUMA
+    # information, every CPU is treated as being on node 0.
+    usable = set(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else None
+    nodes: Dict[int, List[int]] = {}
+    for path in sorted(Path(root).glob("node[0-9]*")):
+        try:
+            cpus = parse_cpulist((path / "cpulist").read_text())
+        except (OSError, ValueError):
+            continue
+        if usable is not None:
+            cpus = [cpu for cpu in cpus if cpu in usable]
+        if cpus:
+            nodes[int(path.name[4:])] = cpus
+    if not nodes:
+        nodes[0] = sorted(usable) if usable else list(range(os.cpu_count() or 1))
+    return nodes
+
+
+def partition(nodes: Dict[int, List[int]], count: int) -> List[Tuple[List[int], int]]:
+    # Divides the CPUs between `count` consumers, returning a cpuset and a
+    # memory node for each. Consumers are spread across nodes in proportion
+    # to their CPUs, so that none spans two nodes, and each node's CPUs are
+    # split evenly between its consumers. Only with more consumers than
+    # CPUs do cpusets overlap.
+    if count <= 0 or not nodes:
+        return []
+    order = sorted(nodes)
+    total = sum(len(nodes[node]) for node in order)
+    exact = {node: count * len(nodes[node]) / total for node in order}
+    shares = {node: int(exact[node]) for node in order}
+    by_remainder = sorted(order, key=lambda n: exact[n] - shares[n], reverse=True)
+    for node in by_remainder[: count - sum(shares.values())]:
+        shares[node] += 1
+    result = []
+    for node in order:
+        cpus, share = nodes[node], shares[node]
+        for i in range(share):
+            chunk = cpus[i * len(cpus) // share : (i + 1) * len(cpus) // share]
+            result.append((chunk or [cpus[i % len(cpus)]], node))
+    return result
+
+
+@functools.lru_cache
+def host_partition(count: int) -> List[Tuple[List[int], int]]:
+    return partition(numa_nodes(), count)
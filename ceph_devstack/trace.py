@@ -0,0 +1,172 @@
+import contextlib
+import contextvars
+import functools
+import itertools
+import json
+import os
+import threading
+import time
+
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+
+class Span:
+    # One timed operation: a command, or a resource-level action. Times are in
+    # microseconds since the tracer was enabled.
+    def __init__(
+        self,
+        tracer: "Tracer",
+        name: str,
+        category: str,
+        parent: Optional["Span"],
+        args: Dict,
+    ):
+        self.tracer = tracer
+        self.id = next(tracer._ids)
+        self.name = name
+        self.category = category
+        self.parent = parent
+        self.args = args
+        self.start = tracer.now()
+        self.end: Optional[float] = None
+
+    def finish(self, **args):
+        if self.end is not None:
+            return
+        self.args.update(args)
+        self.end = self.tracer.now()
+        self.tracer._finished(self)
+
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else self.tracer.now()) - self.start
+
+
+class Tracer:
+    # Records spans when enabled, and costs next to nothing when not. The
+    # current span is kept in a context variable, so that it follows asyncio
+    # tasks and each span knows which action it was run on behalf of.
+    def __init__(self):
+        self.enabled = False
+        self.spans: List[Span] = []
+        self._ids = itertools.count(1)
+        self._epoch = time.perf_counter()
+        self._lock = threading.Lock()
+        self._current: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar(
+            "current_span", default=None
+        )
+
+    def enable(self):
+        self.enabled = True
+        self.spans = []
+        self._epoch = time.perf_counter()
+
+    def now(self) -> float:
+        return (time.perf_counter() - self._epoch) * 1e6
+
+    @property
+    def current(self) -> Optional[Span]:
+        return self._current.get()
+
+    def start(self, name: str, category: str = "action", **args) -> Optional[Span]:
+        # For spans which don't end in the context they started in, e.g.
+        # commands, which end when their process exits
+        if not self.enabled:
+            return None
+        return Span(self, name, category, self.current, args)
+
+    @contextlib.contextmanager
+    def span(
+        self, name: str, category: str = "action", **args
+    ) -> Iterator[Optional[Span]]:
+        if not self.enabled:
+            yield None
+            return
+        span = Span(self, name, category, self.current, args)
+        token = self._current.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.args.setdefault("error", repr(e))
+            raise
+        finally:
+            self._current.reset(token)
+            span.finish()
+
+    def _finished(self, span: Span):
+        with self._lock:
+            self.spans.append(span)
+
+    def lanes(self) -> Dict[int, int]:
+        # Chrome's trace format nests slices by time on each thread ("lane"),
+        # but our spans come from concurrent tasks. Place each span on its
+        # parent's lane if it nests properly there, otherwise on the first
+        # lane where it does, so concurrent work shows up side by side.
+        stacks: List[List[Span]] = []
+        result: Dict[int, int] = {}
+        for span in sorted(self.spans, key=lambda s: (s.start, -(s.end or 0))):
+            preferred = result.get(span.parent.id) if span.parent else None
+            candidates = ([preferred] if preferred is not None else []) + list(
+                range(len(stacks))
+            )
+            for lane in candidates:
+                stack = stacks[lane]
+                while stack and (stack[-1].end or 0) <= span.start:
+                    stack.pop()
+                if not stack or (stack[-1].end or 0) >= (span.end or 0):
+                    break
+            else:
+                lane = len(stacks)
+                stacks.append([])
+            stacks[lane].append(span)
+            result[span.id] = lane
+        return result
+
+    def chrome_trace(self) -> Dict:
+        lanes = self.lanes()
+        pid = os.getpid()
+        events = []
+        for span in self.spans:
+            args = dict(span.args)
+            if span.parent:
+                args["parent"] = span.parent.name
+            events.append(
+                {
+                    "name": span.name,
+                    "cat": span.category,
+                    "ph": "X",
+                    "ts": round(span.start, 1),
+                    "dur": round(span.duration, 1),
+                    "pid": pid,
+                    "tid": lanes[span.id],
+                    "args": args,
+                }
+            )
+        events.sort(key=lambda e: e["ts"])
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write(self, path: Path):
+        path = Path(path).expanduser()
+        path.write_text(json.dumps(self.chrome_trace()))
+
+
+tracer = Tracer()
+
+
+def traced(func):
+    # Records each call of an async resource method as a span, named for the
+    # object it was called on
+    @functools.wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        if not tracer.enabled:
+            return await func(self, *args, **kwargs)
+        name = f"{getattr(self, 'name', type(self).__name__)}.{func.__name__}"
+        current = tracer.current
+        # Overrides which call super() would otherwise appear twice
+        if current is not None and current.name == name:
+            return await func(self, *args, **kwargs)
+        with tracer.span(name):
+            return await func(self, *args, **kwargs)
+
+    return wrapper